@@ -0,0 +1,111 @@
+# coding=utf-8
+"""Benchmark building the connections of convolution layers.
+
+Compares the vectorized connectivity builders in `snntoolbox.simulation.utils`
+with loop implementations, which the builders replaced. Run with::
+
+    python examples/benchmark_connectivity.py
+"""
+
+import timeit
+
+import numpy as np
+from tensorflow import keras
+
+from snntoolbox.simulation.utils import build_convolution, \
+    build_depthwise_convolution
+
+
+def build_convolution_loop(weights, ny, nx, y0, x0, sy, sx, py, px, mx, my,
+                           delay):
+    """Build the connections of a convolution layer using loops."""
+
+    connections = []
+    for fout in range(weights.shape[3]):
+        for y in range(y0, ny - y0, sy):
+            for x in range(x0, nx - x0, sx):
+                target = int((x - x0) / sx + (y - y0) / sy * mx +
+                             fout * mx * my)
+                for fin in range(weights.shape[2]):
+                    for k in range(-py, py + 1):
+                        if not 0 <= y + k < ny:
+                            continue
+                        for p in range(-px, px + 1):
+                            if not 0 <= x + p < nx:
+                                continue
+                            source = p + x + (y + k) * nx + fin * nx * ny
+                            connections.append((source, target,
+                                                weights[py - k, px - p, fin,
+                                                        fout], delay))
+    return connections
+
+
+def build_depthwise_convolution_loop(weights, ny, nx, y0, x0, sy, sx, py, px,
+                                     mx, my, delay):
+    """Build the connections of a depthwise convolution layer using loops."""
+
+    dm = weights.shape[-1]
+    connections = []
+    for fin in range(weights.shape[-2]):
+        for d in range(weights.shape[-1]):
+            for y in range(y0, ny - y0, sy):
+                for x in range(x0, nx - x0, sx):
+                    target = ((x - x0) // sx) + ((y - y0) // sy * mx) + \
+                        (d * mx * my) + (fin * dm * mx * my)
+                    for k in range(-py, py + 1):
+                        if not 0 <= y + k < ny:
+                            continue
+                        for p in range(-px, px + 1):
+                            if not 0 <= x + p < nx:
+                                continue
+                            source = x + p + ((y + k) * nx) + (fin * nx * ny)
+                            connections.append((source, target,
+                                                weights[py - k, px - p, fin,
+                                                        d], delay))
+    return connections
+
+
+def get_layer(layer, input_shape):
+    """Build ``layer`` on ``input_shape`` and set random weights."""
+
+    model = keras.models.Sequential([keras.layers.InputLayer(input_shape),
+                                     layer])
+    rng = np.random.RandomState(0)
+    layer.set_weights([rng.standard_normal(w.shape).astype(w.dtype)
+                       for w in model.get_weights()])
+    return layer
+
+
+def benchmark(name, build, build_loop, number=1):
+    t = timeit.timeit(build, number=number) / number
+    t_loop = timeit.timeit(build_loop, number=number) / number
+    print("{}: {:.3f} s (loops: {:.3f} s, speedup: {:.0f}x)".format(
+        name, t, t_loop, t_loop / t))
+
+
+def main(ny=28, nx=28, num_channels=32, delay=1.):
+
+    # Geometry of a 3x3 kernel with stride 1 and 'same' padding.
+    y0, my, py = 0, ny, 1
+    x0, mx, px = 0, nx, 1
+
+    layer = get_layer(keras.layers.Conv2D(
+        num_channels, 3, padding='same'), (ny, nx, num_channels))
+    weights = layer.get_weights()[0]
+    benchmark("Conv2D {}x{}x{}, 3x3 kernel".format(ny, nx, num_channels),
+              lambda: build_convolution(layer, delay),
+              lambda: build_convolution_loop(weights, ny, nx, y0, x0, 1, 1,
+                                             py, px, mx, my, delay))
+
+    layer = get_layer(keras.layers.DepthwiseConv2D(
+        3, padding='same'), (ny, nx, num_channels))
+    weights = layer.get_weights()[0]
+    benchmark("DepthwiseConv2D {}x{}x{}, 3x3 kernel".format(
+        ny, nx, num_channels),
+        lambda: build_depthwise_convolution(layer, delay),
+        lambda: build_depthwise_convolution_loop(
+            weights, ny, nx, y0, x0, 1, 1, py, px, mx, my, delay))
+
+
+if __name__ == '__main__':
+    main()
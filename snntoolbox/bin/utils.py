@@ -13,10 +13,12 @@ Important functions:
 @author: rbodo
 """
 
+import hashlib
 import os
+import tempfile
 from importlib import import_module
 
-from snntoolbox.parsing.model_libs.keras_input_lib import load
+from snntoolbox.parsing.model_libs.keras_input_lib import load, evaluate
 
 
 def run_pipeline(config, queue=None):
@@ -48,7 +50,6 @@ def run_pipeline(config, queue=None):
     """
 
     from snntoolbox.datasets.utils import get_dataset
-    from snntoolbox.conversion.utils import normalize_parameters
 
     num_to_test = config.getint('simulation', 'num_to_test')
 
@@ -64,43 +65,34 @@ def run_pipeline(config, queue=None):
     parsed_model = None
     if config.getboolean('tools', 'parse') and not is_stop(queue):
 
-        # __________________________ LOAD MODEL _____________________________ #
-
-        model_lib = import_module('snntoolbox.parsing.model_libs.' +
-                                  config.get('input', 'model_lib') +
-                                  '_input_lib')
-        input_model = model_lib.load(config.get('paths', 'path_wd'),
-                                     config.get('paths', 'filename_ann'))
-
-        # Evaluate input model.
-        if config.getboolean('tools', 'evaluate_ann') and not is_stop(queue):
-            print("Evaluating input model on {} samples...".format(
-                num_to_test))
-            acc = model_lib.evaluate(input_model['val_fn'],
-                                     config.getint('simulation', 'batch_size'),
-                                     num_to_test, **testset)
-            results = [acc]
-
-        # ____________________________ PARSE ________________________________ #
-
-        print("Parsing input model...")
-        model_parser = model_lib.ModelParser(input_model['model'], config)
-        model_parser.parse()
-        parsed_model = model_parser.build_parsed_model()
-
-        # ___________________________ NORMALIZE _____________________________ #
-
-        if config.getboolean('tools', 'normalize') and not is_stop(queue):
-            normalize_parameters(parsed_model, config, **normset)
-
-        # Evaluate parsed model.
-        if config.getboolean('tools', 'evaluate_ann') and not is_stop(queue):
-            print("Evaluating parsed model on {} samples...".format(
-                num_to_test))
-            score = model_parser.evaluate(
-                config.getint('simulation', 'batch_size'),
-                num_to_test, **testset)
-            results = [score[1]]
+        # A parsed (and normalized) model from a previous run is reused if
+        # the input model, the relevant settings and the normalization set
+        # are unchanged.
+        cache_filepath = get_parsed_model_cache_path(config, normset) \
+            if config.getboolean('tools', 'cache_parsed_model') else None
+
+        if cache_filepath is not None and os.path.isfile(cache_filepath):
+            print("Loading parsed model from cache {}...".format(
+                cache_filepath))
+            parsed_model = load(
+                os.path.dirname(cache_filepath),
+                os.path.splitext(os.path.basename(cache_filepath))[0],
+                filepath_custom_objects=config.get(
+                    'paths', 'filepath_custom_objects'))['model']
+
+            # Evaluate parsed model.
+            if config.getboolean('tools', 'evaluate_ann') and \
+                    not is_stop(queue):
+                print("Evaluating parsed model on {} samples...".format(
+                    num_to_test))
+                results = [evaluate(parsed_model.evaluate,
+                                    config.getint('simulation', 'batch_size'),
+                                    num_to_test, **testset)]
+        else:
+            parsed_model, score = parse_and_normalize(config, queue, normset,
+                                                      testset)
+            if score is not None:
+                results = [score]
 
         # Write parsed model to disk
         parsed_model.save(str(
@@ -108,6 +100,9 @@ def run_pipeline(config, queue=None):
                          config.get('paths', 'filename_parsed_model') +
                          '.h5')))
 
+        if cache_filepath is not None and not os.path.isfile(cache_filepath):
+            write_parsed_model_cache(parsed_model, cache_filepath)
+
     # _____________________________ CONVERT _________________________________ #
 
     if config.getboolean('tools', 'convert') and not is_stop(queue):
@@ -154,6 +149,168 @@ def run_pipeline(config, queue=None):
     return results
 
 
+def parse_and_normalize(config, queue, normset, testset):
+    """Load, parse and normalize the input model.
+
+    Parameters
+    ----------
+
+    config: configparser.ConfigParser
+        ConfigParser containing the user settings.
+
+    queue: Optional[Queue.Queue]
+        Event queue.
+
+    normset: dict
+        Normalization data set, or scale factors (see
+        `snntoolbox.datasets.utils.get_dataset`).
+
+    testset: dict
+        Test data set.
+
+    Returns
+    -------
+
+    parsed_model: keras.models.Model
+        The parsed model.
+
+    score: Optional[float]
+        Accuracy of the last evaluated model, if ``evaluate_ann`` is set.
+    """
+
+    from snntoolbox.conversion.utils import normalize_parameters
+
+    num_to_test = config.getint('simulation', 'num_to_test')
+    score = None
+
+    # ____________________________ LOAD MODEL _______________________________ #
+
+    model_lib = import_module('snntoolbox.parsing.model_libs.' +
+                              config.get('input', 'model_lib') +
+                              '_input_lib')
+    input_model = model_lib.load(config.get('paths', 'path_wd'),
+                                 config.get('paths', 'filename_ann'))
+
+    # Evaluate input model.
+    if config.getboolean('tools', 'evaluate_ann') and not is_stop(queue):
+        print("Evaluating input model on {} samples...".format(num_to_test))
+        score = model_lib.evaluate(input_model['val_fn'],
+                                   config.getint('simulation', 'batch_size'),
+                                   num_to_test, **testset)
+
+    # ______________________________ PARSE __________________________________ #
+
+    print("Parsing input model...")
+    model_parser = model_lib.ModelParser(input_model['model'], config)
+    model_parser.parse()
+    parsed_model = model_parser.build_parsed_model()
+
+    # _____________________________ NORMALIZE _______________________________ #
+
+    if config.getboolean('tools', 'normalize') and not is_stop(queue):
+        normalize_parameters(parsed_model, config, **normset)
+
+    # Evaluate parsed model.
+    if config.getboolean('tools', 'evaluate_ann') and not is_stop(queue):
+        print("Evaluating parsed model on {} samples...".format(num_to_test))
+        score = model_parser.evaluate(
+            config.getint('simulation', 'batch_size'),
+            num_to_test, **testset)[1]
+
+    return parsed_model, score
+
+
+def get_parsed_model_cache_path(config, normset):
+    """Get the path under which the parsed model is cached.
+
+    The file name is a hash of the input model files, the settings that affect
+    parsing and normalization, and the normalization set.
+
+    Parameters
+    ----------
+
+    config: configparser.ConfigParser
+        ConfigParser containing the user settings.
+
+    normset: dict
+        Normalization data set, or scale factors (see
+        `snntoolbox.datasets.utils.get_dataset`).
+
+    Returns
+    -------
+
+    : Optional[str]
+        Path of the cached ``.h5`` file in ``path_wd/parsed_model_cache``.
+        ``None`` if the normalization data set is a dataflow whose samples
+        cannot be identified.
+    """
+
+    from snntoolbox.conversion.utils import get_dataset_hash, \
+        get_normset_batches
+    from snntoolbox.utils.utils import get_input_model_hash
+
+    sha1 = hashlib.sha1(get_input_model_hash(config).encode())
+    settings = [sorted(config.items(section))
+                for section in ('input', 'conversion')]
+    settings.append([config.get(section, option) for section, option in [
+        ('simulation', 'batch_size'), ('cell', 'binarize_weights'),
+        ('cell', 'quantize_weights'), ('tools', 'normalize'),
+        ('output', 'use_simple_labels'), ('restrictions', 'spiking_layers'),
+        ('restrictions', 'snn_layers')]])
+    if config.getboolean('tools', 'normalize'):
+        # The number of loader threads does not affect the result.
+        settings.append(sorted(
+            item for item in config.items('normalization')
+            if item[0] not in {'num_workers', 'max_queue_size'}))
+        if 'scale_facs' in normset:
+            settings.append(sorted(normset['scale_facs'].items()))
+        elif 'x_norm' in normset:
+            settings.append(get_dataset_hash(normset['x_norm']))
+        elif 'dataflow' in normset:
+            # Covers the files of the selected samples and their modification
+            # times, so that changed images invalidate the cache.
+            dataset_hash = get_dataset_hash(get_normset_batches(
+                normset['dataflow'], config))
+            if dataset_hash is None:
+                print("Normalization data set cannot be identified. Not "
+                      "caching the parsed model.")
+                return
+            settings.append(dataset_hash)
+    sha1.update(repr(settings).encode())
+
+    return os.path.join(config.get('paths', 'path_wd'), 'parsed_model_cache',
+                        sha1.hexdigest() + '.h5')
+
+
+def write_parsed_model_cache(parsed_model, filepath):
+    """Store a parsed model in the cache.
+
+    The model is written to a temporary file first, so that an interrupted
+    run does not leave a corrupt entry behind.
+
+    Parameters
+    ----------
+
+    parsed_model: keras.models.Model
+        The parsed model.
+
+    filepath: str
+        Path of the cache entry (see `get_parsed_model_cache_path`).
+    """
+
+    directory = os.path.dirname(filepath)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_filepath = tempfile.mkstemp('.h5', dir=directory)
+    os.close(fd)
+    try:
+        parsed_model.save(tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
 def is_stop(queue):
     """Determine if the user pressed 'stop' in the GUI.
 
@@ -312,6 +469,14 @@ def update_setup(config_filepath):
         "Simulator '{}' not supported. Choose from {}".format(simulator,
                                                               simulators)
 
+    if simulator == 'brian2':
+        codegen_target = config.get('brian2', 'codegen_target')
+        codegen_targets = config_string_to_set_of_strings(
+            config.get('restrictions', 'brian2_codegen_targets'))
+        assert codegen_target in codegen_targets, \
+            "Brian2 code generation target '{}' not supported. Choose from " \
+            "{}.".format(codegen_target, codegen_targets)
+
     # Warn user that it is not possible to use Brian2 simulator by loading a
     # pre-converted network from disk.
     if simulator == 'brian2' and not config.getboolean('tools', 'convert'):
@@ -525,6 +690,20 @@ def update_setup(config_filepath):
     elif 'ttfs' in spike_code:
         config.set('cell', 'tau_refrac',
                    str(config.getint('simulation', 'duration')))
+    state_dtype = config.get('simulation', 'state_dtype')
+    state_dtypes = config_string_to_set_of_strings(config.get('restrictions',
+                                                              'state_dtypes'))
+    assert state_dtype in state_dtypes, \
+        "Unknown state dtype {} selected. Choose from {}.".format(
+            state_dtype, state_dtypes)
+    if state_dtype != 'float32' and not (
+            simulator == 'INI' and keras_backend == 'tensorflow' and
+            spike_code == 'temporal_mean_rate'):
+        import warnings
+        warnings.warn("The state dtype {} is only supported by the INI "
+                      "simulator with 'temporal_mean_rate' code and "
+                      "'tensorflow' backend. The state is kept in full "
+                      "precision.".format(state_dtype), RuntimeWarning)
     assert keras_backend != 'theano' or spike_code == 'temporal_mean_rate', \
         "Keras backend 'theano' only works when the 'spike_code' parameter " \
         "is set to 'temporal_mean_rate' in snntoolbox config."
@@ -558,7 +737,20 @@ def initialize_simulator(config):
         sim.setup(timestep=config.getfloat('simulation', 'dt'))
         return sim
     if simulator == 'brian2':
-        return import_module('brian2')
+        sim = import_module('brian2')
+        # Compiled code is kept in the working directory, so that it can be
+        # reused by later runs and by each step of a parameter sweep.
+        codegen_target = config.get('brian2', 'codegen_target')
+        cache_dir = os.path.join(config.get('paths', 'path_wd'),
+                                 'brian2_' + codegen_target)
+        if codegen_target == 'cpp_standalone':
+            sim.set_device('cpp_standalone', directory=cache_dir,
+                           build_on_run=False)
+        else:
+            sim.prefs.codegen.target = codegen_target
+            if codegen_target == 'cython':
+                sim.prefs.codegen.runtime.cython.cache_dir = cache_dir
+        return sim
     if simulator == 'loihi':
         import nxsdk.api.n2a as sim
         return sim
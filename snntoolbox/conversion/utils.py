@@ -12,6 +12,7 @@ from analog to spiking.
 @author: rbodo
 """
 
+import hashlib
 import os
 
 import json
@@ -19,6 +20,11 @@ from collections import OrderedDict
 from tensorflow.keras.models import Model
 import numpy as np
 
+from snntoolbox.datasets.utils import DataflowBatches
+
+
+ACTIVATIONS_MANIFEST = 'manifest.json'
+
 
 def normalize_parameters(model, config, **kwargs):
     """Normalize the parameters of a network.
@@ -42,8 +48,13 @@ def normalize_parameters(model, config, **kwargs):
     activ_dir = os.path.join(norm_dir, 'activations')
     if not os.path.exists(activ_dir):
         os.makedirs(activ_dir)
+    # Activations stored during a previous run are only reused if they stem
+    # from the same model and normalization data set.
+    model_hash = get_model_hash(model)
+    manifest = read_activations_manifest(activ_dir)
     # Store original weights for later plotting
-    if not os.path.isfile(os.path.join(activ_dir, 'weights.npz')):
+    if manifest.get('model_hash') != model_hash or \
+            not os.path.isfile(os.path.join(activ_dir, 'weights.npz')):
         weights = {}
         for layer in model.layers:
             w = layer.get_weights()
@@ -52,35 +63,29 @@ def normalize_parameters(model, config, **kwargs):
         np.savez_compressed(os.path.join(activ_dir, 'weights.npz'), **weights)
 
     batch_size = config.getint('simulation', 'batch_size')
+    plot_activations = 'normalization_activations' in \
+        eval(config.get('output', 'plot_vars'))
 
     # Either load scale factors from disk, or get normalization data set to
     # calculate them.
     x_norm = None
+    if 'x_norm' in kwargs:
+        x_norm = kwargs[str('x_norm')]
+    elif 'dataflow' in kwargs:
+        # The samples are not loaded into memory, but streamed through the
+        # network batch by batch while the next batches are loaded.
+        x_norm = get_normset_batches(kwargs[str('dataflow')], config)
     if 'scale_facs' in kwargs:
         scale_facs = kwargs[str('scale_facs')]
-    elif 'x_norm' in kwargs or 'dataflow' in kwargs:
-        if 'x_norm' in kwargs:
-            x_norm = kwargs[str('x_norm')]
-        elif 'dataflow' in kwargs:
-            x_norm = []
-            dataflow = kwargs[str('dataflow')]
-            num_samples_norm = config.getint('normalization', 'num_samples',
-                                             fallback='')
-            if num_samples_norm == '':
-                num_samples_norm = len(dataflow) * dataflow.batch_size
-            while len(x_norm) * batch_size < num_samples_norm:
-                x = dataflow.next()
-                if isinstance(x, tuple):  # Remove class label if present.
-                    x = x[0]
-                x_norm.append(x)
-            x_norm = np.concatenate(x_norm)
+    elif x_norm is not None:
         print("Using {} samples for normalization.".format(len(x_norm)))
         sizes = [
             len(x_norm) * np.array(layer.output_shape[1:]).prod() * 32 /
             (8 * 1e9) for layer in model.layers if len(layer.weights) > 0]
         size_str = ['{:.2f}'.format(s) for s in sizes]
-        print("INFO: Need {} GB for layer activations.\n".format(size_str) +
-              "May have to reduce size of data set used for normalization.")
+        print("INFO: Need {} GB of disk space for layer activations.\n".format(
+            size_str) + "May have to reduce size of data set used for "
+                        "normalization.")
         scale_facs = OrderedDict({model.layers[0].name: 1})
     else:
         import warnings
@@ -89,22 +94,35 @@ def normalize_parameters(model, config, **kwargs):
                       RuntimeWarning)
         return
 
+    # Without a normalization data set (i.e. when the scale factors were
+    # loaded), the stored activations are those of the data set from which
+    # the scale factors in ``norm_dir`` were computed.
+    dataset_hash = manifest.get('dataset_hash') if x_norm is None \
+        else get_dataset_hash(x_norm)
+    stored = manifest.get('layers', {}) \
+        if dataset_hash is not None and \
+        manifest.get('model_hash') == model_hash and \
+        manifest.get('dataset_hash') == dataset_hash else {}
+
     # If scale factors have not been computed in a previous run, do so now.
     if len(scale_facs) == 1:
         i = 0
         sparsity = []
-        for layer in model.layers:
-            # Skip if layer has no parameters
-            if len(layer.weights) == 0:
-                continue
-
-            activations = try_reload_activations(layer, model, x_norm,
-                                                 batch_size, activ_dir)
-            nonzero_activations = activations[np.nonzero(activations)]
-            sparsity.append(1 - nonzero_activations.size / activations.size)
-            del activations
+        # The activations of all layers are computed in a single pass, and
+        # only enter the percentile estimators one batch at a time.
+        layers = [layer for layer in model.layers if len(layer.weights) > 0]
+        num_bins = config.getint('normalization', 'num_histogram_bins')
+        estimators = OrderedDict((layer.name, PercentileEstimator(num_bins))
+                                 for layer in layers)
+        update_percentile_estimators(estimators, layers, model, x_norm,
+                                     batch_size, activ_dir, stored)
+        write_activations_manifest(activ_dir, model_hash, dataset_hash,
+                                   stored)
+        for layer in layers:
+            estimator = estimators.pop(layer.name)
+            sparsity.append(estimator.sparsity)
             perc = get_percentile(config, i)
-            scale_facs[layer.name] = get_scale_fac(nonzero_activations, perc)
+            scale_facs[layer.name] = estimator.percentile(perc)
             print("Scale factor: {:.2f}.".format(scale_facs[layer.name]))
             # Since we have calculated output activations here, check at this
             # point if the output is mostly negative, in which case we should
@@ -125,10 +143,15 @@ def normalize_parameters(model, config, **kwargs):
         # Write scale factors to disk
         filepath = os.path.join(norm_dir, config.get('normalization',
                                                      'percentile') + '.json')
-        from snntoolbox.utils.utils import confirm_overwrite
+        from snntoolbox.utils.utils import confirm_overwrite, \
+            get_input_model_hash
         if config.get('output', 'overwrite') or confirm_overwrite(filepath):
             with open(filepath, str('w')) as f:
                 json.dump(scale_facs, f)
+            # Record which input model the scale factors belong to, so that
+            # they are not reused after the model changed.
+            with open(os.path.splitext(filepath)[0] + '.sha1', 'w') as f:
+                f.write(get_input_model_hash(config))
         np.savez_compressed(os.path.join(norm_dir, 'activations', 'sparsity'),
                             sparsity=sparsity)
 
@@ -189,7 +212,7 @@ def normalize_parameters(model, config, **kwargs):
         layer.set_weights(parameters_norm)
 
     # Plot distributions of weights and activations before and after norm.
-    if 'normalization_activations' in eval(config.get('output', 'plot_vars')):
+    if plot_activations:
         from snntoolbox.simulation.plotting import plot_hist
         from snntoolbox.simulation.plotting import plot_max_activ_hist
 
@@ -203,6 +226,8 @@ def normalize_parameters(model, config, **kwargs):
 
         # Load original parsed model to get parameters before normalization
         weights = np.load(os.path.join(activ_dir, 'weights.npz'))
+        # The activations are handled one layer at a time, to limit the
+        # memory needed for plotting.
         for idx, layer in enumerate(model.layers):
             # Skip if layer has no parameters
             if len(layer.weights) == 0:
@@ -217,20 +242,23 @@ def normalize_parameters(model, config, **kwargs):
                            'weights_norm': parameters_norm.flatten()}
             plot_hist(weight_dict, 'Weight', label, norm_dir)
 
-            # Load activations of model before normalization
+            # Activations of model before and after normalization
             activations = try_reload_activations(layer, model, x_norm,
-                                                 batch_size, activ_dir)
+                                                 batch_size, activ_dir,
+                                                 stored)
 
-            if activations is None or x_norm is None:
+            if activations is None:
                 continue
 
-            # Compute activations with modified parameters
-            nonzero_activations = activations[np.nonzero(activations)]
-            activations_norm = get_activations_layer(model.input, layer.output,
-                                                     x_norm, batch_size)
-            activation_dict = {'Activations': nonzero_activations,
-                               'Activations_norm':
-                               activations_norm[np.nonzero(activations_norm)]}
+            activation_dict = {
+                'Activations': activations[np.nonzero(activations)]}
+            # The activations after normalization can only be computed if
+            # the normalization data set is available.
+            if x_norm is not None:
+                activations_norm = get_activations_layers(
+                    model.input, [layer.output], x_norm, batch_size)[0]
+                activation_dict['Activations_norm'] = \
+                    activations_norm[np.nonzero(activations_norm)]
             scale_fac = scale_facs[layer.name]
             plot_hist(activation_dict, 'Activation', label, norm_dir,
                       scale_fac)
@@ -241,6 +269,36 @@ def normalize_parameters(model, config, **kwargs):
     print('')
 
 
+def get_normset_batches(dataflow, config):
+    """Select the batches of a dataflow used for normalization.
+
+    Parameters
+    ----------
+
+    dataflow: keras.preprocessing.image.Iterator
+        Loads the normalization data set from disk.
+
+    config: configparser.ConfigParser
+        Settings.
+
+    Returns
+    -------
+
+    : DataflowBatches
+        The first ``num_samples`` samples of the dataflow (all if not given in
+        the ``[normalization]`` section).
+    """
+
+    num_samples_norm = config.getint('normalization', 'num_samples',
+                                     fallback='')
+    if num_samples_norm == '':
+        num_samples_norm = len(dataflow) * dataflow.batch_size
+    return DataflowBatches(
+        dataflow, num_samples_norm,
+        config.getint('normalization', 'num_workers'),
+        config.getint('normalization', 'max_queue_size'))
+
+
 def get_scale_fac(activations, percentile):
     """
     Determine the activation value at ``percentile`` of the layer distribution.
@@ -265,6 +323,353 @@ def get_scale_fac(activations, percentile):
     return np.percentile(activations, percentile) if activations.size else 1
 
 
+class PercentileEstimator(object):
+    """Estimate a percentile of the nonzero activations of a layer.
+
+    The activations are added one batch at a time, and summarized in a
+    histogram of ``num_bins`` bins of equal width. Whenever a batch falls
+    outside the current range of the histogram, the range is doubled by
+    merging pairs of neighboring bins, so the bin width stays below
+    ``4 * (max - min) / num_bins``. Each value is located within one bin, so
+    the estimated percentile is off by at most one bin width.
+
+    Parameters
+    ----------
+
+    num_bins: int
+        Number of histogram bins. If zero, all nonzero activations are kept in
+        memory to compute the exact percentile.
+
+    Attributes
+    ----------
+
+    counts: ndarray
+        Number of activations in each bin.
+    start: float
+        Lower edge of the first bin.
+    width: float
+        Width of each bin.
+    min, max: float
+        Smallest and largest nonzero activation seen so far.
+    num_zeros, size: int
+        Number of zero and of all activations seen so far.
+    """
+
+    def __init__(self, num_bins=0):
+        assert num_bins % 2 == 0, "Number of bins must be even."
+        self.num_bins = num_bins
+        self.counts = np.zeros(num_bins, 'int64')
+        self.start = self.width = None
+        self.min = np.inf
+        self.max = -np.inf
+        self.num_zeros = self.size = 0
+        self._values = []
+
+    def update(self, activations):
+        """Add a batch of activations."""
+
+        activations = np.asarray(activations)
+        values = activations[np.nonzero(activations)]
+        self.size += activations.size
+        self.num_zeros += activations.size - values.size
+        if values.size == 0:
+            return
+
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+        if self.num_bins == 0:
+            self._values.append(values)
+            return
+
+        if self.start is None:
+            self.start = self.min
+            self.width = ((self.max - self.min) or abs(self.max)) / \
+                self.num_bins
+        while self.min < self.start:
+            self._grow(downwards=True)
+        while self.max > self.start + self.width * self.num_bins:
+            self._grow(downwards=False)
+
+        idxs = ((values - self.start) / self.width).astype('int64')
+        self.counts += np.bincount(np.clip(idxs, 0, self.num_bins - 1),
+                                   minlength=self.num_bins)
+
+    def _grow(self, downwards):
+        """Double the range of the histogram."""
+
+        half = self.num_bins // 2
+        merged = self.counts.reshape(half, 2).sum(1)
+        self.counts[:] = 0
+        if downwards:
+            self.counts[half:] = merged
+            self.start -= self.width * self.num_bins
+        else:
+            self.counts[:half] = merged
+        self.width *= 2
+
+    @property
+    def sparsity(self):
+        """Fraction of activations that are zero."""
+
+        return self.num_zeros / self.size if self.size else 0
+
+    def percentile(self, percentile):
+        """Estimate the activation value at ``percentile``.
+
+        Parameters
+        ----------
+
+        percentile: float
+            Percentile at which to determine activation.
+
+        Returns
+        -------
+
+        : float
+            Estimated percentile of the nonzero activations, or 1 if all
+            activations are zero (see `get_scale_fac`).
+
+        Raises
+        ------
+
+        ValueError
+            If no activations were added, e.g. because the normalization set
+            is empty.
+        """
+
+        if self.size == 0:
+            raise ValueError("Cannot estimate percentile: No activations "
+                             "were added. Is the normalization data set "
+                             "empty?")
+
+        if self.num_bins == 0:
+            return get_scale_fac(np.concatenate(self._values) if self._values
+                                 else np.zeros(0), percentile)
+
+        num_values = self.size - self.num_zeros
+        if num_values == 0:
+            return 1
+        if percentile >= 100:
+            return self.max
+
+        # Interpolate between the two closest ranks, as in np.percentile.
+        rank = percentile / 100 * (num_values - 1)
+        lower, upper = self._get_value(int(np.floor(rank))), \
+            self._get_value(int(np.ceil(rank)))
+        return lower + (rank - np.floor(rank)) * (upper - lower)
+
+    def _get_value(self, rank):
+        """Estimate the value at ``rank`` among the sorted nonzero values.
+
+        The values within a bin are assumed to be spread evenly.
+        """
+
+        cumsum = np.cumsum(self.counts)
+        b = int(np.searchsorted(cumsum, rank, 'right'))
+        count_before = cumsum[b - 1] if b > 0 else 0
+        frac = (rank - count_before + 0.5) / self.counts[b]
+        value = self.start + (b + frac) * self.width
+        return float(np.clip(value, self.min, self.max))
+
+
+def update_percentile_estimators(estimators, layers, model, x_norm,
+                                 batch_size, activ_dir, stored):
+    """Add the activations of ``layers`` to their percentile estimators.
+
+    Activations stored during a previous run are read from disk, one batch at
+    a time. The others are computed in a single pass over ``x_norm``, and
+    written to uncompressed ``.npy`` files batch by batch.
+
+    Parameters
+    ----------
+
+    estimators: dict[str, PercentileEstimator]
+        The estimators of each layer, keyed by layer name.
+
+    layers: list[keras.layers.Layer]
+        The layers for which we want to estimate the percentiles.
+
+    model: keras.models.Model
+        The model containing ``layers``.
+
+    x_norm: Optional[Union[np.array, DataflowBatches]]
+        The normalization data set.
+
+    batch_size: int
+        Batch size
+
+    activ_dir: str
+        Directory where the activations are stored.
+
+    stored: dict
+        Manifest entries of the valid activations in ``activ_dir``, keyed by
+        layer name (see `read_activations_manifest`). Entries for the newly
+        computed activations are added.
+    """
+
+    missing = []
+    for layer in layers:
+        activations = load_activations(activ_dir, stored.get(layer.name))
+        if activations is None:
+            missing.append(layer)
+            continue
+        print("Loading activations of layer {} stored during a previous "
+              "run.".format(layer.name))
+        for start in range(0, len(activations), batch_size):
+            estimators[layer.name].update(
+                activations[start:start + batch_size])
+
+    if len(missing) == 0 or x_norm is None:
+        return
+
+    print("Calculating activations of layers {} ...".format(
+        [layer.name for layer in missing]))
+    num_samples = len(x_norm)
+    stores = None
+    start = 0
+    for activations_batch in iter_activations_layers(
+            model.input, [layer.output for layer in missing], x_norm,
+            batch_size):
+        if stores is None:
+            stores = [np.lib.format.open_memmap(
+                os.path.join(activ_dir, layer.name + '.npy'), 'w+',
+                activations.dtype, (num_samples,) + activations.shape[1:])
+                for layer, activations in zip(missing, activations_batch)]
+        stop = start + len(activations_batch[0])
+        for layer, activations, store in zip(missing, activations_batch,
+                                             stores):
+            estimators[layer.name].update(activations)
+            store[start:stop] = activations
+        start = stop
+
+    for layer, store in zip(missing, stores or []):
+        store.flush()
+        stored[layer.name] = {'filename': layer.name + '.npy',
+                              'shape': list(store.shape)}
+
+
+def get_model_hash(model):
+    """Compute a hash of the layer names and parameters of a model.
+
+    Parameters
+    ----------
+
+    model: keras.models.Model
+        The model.
+
+    Returns
+    -------
+
+    : str
+        SHA1 hex digest.
+    """
+
+    sha1 = hashlib.sha1()
+    for layer in model.layers:
+        sha1.update(layer.name.encode())
+        for w in layer.get_weights():
+            sha1.update(np.ascontiguousarray(w))
+    return sha1.hexdigest()
+
+
+def get_dataset_hash(x):
+    """Compute a hash of the samples in a data set.
+
+    Parameters
+    ----------
+
+    x: Union[np.array, DataflowBatches]
+        The samples. For a dataflow, the hash covers the file paths of the
+        samples and the preprocessing settings, rather than the image data.
+
+    Returns
+    -------
+
+    : Optional[str]
+        SHA1 hex digest. ``None`` if the samples of a dataflow cannot be
+        identified.
+    """
+
+    if isinstance(x, DataflowBatches):
+        description = x.get_description()
+        return None if description is None \
+            else hashlib.sha1(description.encode()).hexdigest()
+
+    sha1 = hashlib.sha1(repr((x.shape, x.dtype.str)).encode())
+    sha1.update(np.ascontiguousarray(x))
+    return sha1.hexdigest()
+
+
+def read_activations_manifest(activ_dir):
+    """Read the manifest of the activations stored in ``activ_dir``.
+
+    Parameters
+    ----------
+
+    activ_dir: str
+        Directory where the activations are stored.
+
+    Returns
+    -------
+
+    manifest: dict
+        Contains the ``model_hash`` and ``dataset_hash`` from which the
+        activations were computed, and under ``layers`` the ``filename`` and
+        ``shape`` of the activations of each layer. Empty if there is no
+        manifest.
+    """
+
+    filepath = os.path.join(activ_dir, ACTIVATIONS_MANIFEST)
+    if not os.path.isfile(filepath):
+        return {}
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def write_activations_manifest(activ_dir, model_hash, dataset_hash, layers):
+    """Write the manifest of the activations stored in ``activ_dir``.
+
+    See `read_activations_manifest` for a description of the contents.
+    """
+
+    with open(os.path.join(activ_dir, ACTIVATIONS_MANIFEST), 'w') as f:
+        json.dump({'model_hash': model_hash, 'dataset_hash': dataset_hash,
+                   'layers': layers}, f, indent=2)
+
+
+def load_activations(activ_dir, entry):
+    """Memory-map the activations of a layer stored in ``activ_dir``.
+
+    Parameters
+    ----------
+
+    activ_dir: str
+        Directory where the activations are stored.
+
+    entry: Optional[dict]
+        Manifest entry of the layer (see `read_activations_manifest`).
+
+    Returns
+    -------
+
+    activations: Optional[np.memmap]
+        The activations, read from disk only where accessed. ``None`` if not
+        available.
+    """
+
+    if entry is None:
+        return
+    try:
+        activations = np.load(os.path.join(activ_dir, entry['filename']),
+                              mmap_mode='r')
+    except IOError:
+        return
+    if list(activations.shape) != entry['shape']:
+        return
+    return activations
+
+
 def get_percentile(config, layer_idx=None):
     """Get percentile at which to draw the maximum activation of a layer.
 
@@ -358,6 +763,41 @@ def get_activations_layer(layer_in, layer_out, x, batch_size=None):
     return Model(layer_in, layer_out).predict(x, batch_size)
 
 
+def get_activations_layers(layer_in, layers_out, x, batch_size=None):
+    """
+    Get activations of several layers in a single pass over the data set.
+
+    Parameters
+    ----------
+
+    layer_in: keras.layers.Layer
+        The input to the network.
+
+    layers_out: list[keras.layers.Layer]
+        The layers for which we want to get the activations.
+
+    x: Union[np.array, DataflowBatches]
+        The samples to compute activations for (see
+        `iter_activations_layers`).
+
+    batch_size: Optional[int]
+        Batch size
+
+    Returns
+    -------
+
+    activations: list[ndarray]
+        The activations of cells in each of the ``layers_out``.
+    """
+
+    if len(layers_out) == 0:
+        return []
+
+    batches = list(iter_activations_layers(layer_in, layers_out, x,
+                                           batch_size))
+    return [np.concatenate(activations) for activations in zip(*batches)]
+
+
 def get_activations_batch(ann, x_batch):
     """Compute layer activations of an ANN.
 
@@ -399,19 +839,101 @@ def get_activations_batch(ann, x_batch):
     return activations_batch
 
 
-def try_reload_activations(layer, model, x_norm, batch_size, activ_dir):
-    try:
-        activations = np.load(os.path.join(activ_dir,
-                                           layer.name + '.npz'))['arr_0']
-    except IOError:
-        if x_norm is None:
-            return
+def iter_activations_layers(layer_in, layers_out, x, batch_size=None):
+    """
+    Generate the activations of several layers, one batch at a time.
+
+    Like `get_activations_layers`, but only the activations of the current
+    batch are held in memory.
+
+    Parameters
+    ----------
+
+    layer_in: keras.layers.Layer
+        The input to the network.
 
-        print("Calculating activations of layer {} ...".format(layer.name))
-        activations = get_activations_layer(model.input, layer.output, x_norm,
-                                            batch_size)
-        print("Writing activations to disk...")
-        np.savez_compressed(os.path.join(activ_dir, layer.name), activations)
+    layers_out: list[keras.layers.Layer]
+        The layers for which we want to get the activations.
+
+    x: Union[np.array, DataflowBatches]
+        The samples to compute activations for (see `get_activations_layer`).
+        An array is split into batches of ``batch_size`` samples; the last
+        batch holds the remaining samples and may be smaller. A
+        `DataflowBatches` object yields its own batches, which are loaded in
+        parallel.
+
+    batch_size: Optional[int]
+        Batch size
+
+    Yields
+    ------
+
+    activations_batch: list[ndarray]
+        The activations of cells in each of the ``layers_out`` for one batch.
+    """
+
+    if batch_size is None:
+        batch_size = 10
+
+    if isinstance(x, DataflowBatches):
+        batches = x
     else:
-        print("Loading activations stored during a previous run.")
-    return np.array(activations)
+        batches = (x[start:start + batch_size] for start in
+                   range(0, len(x), batch_size))
+
+    model = Model(layer_in, layers_out)
+    for x_batch in batches:
+        activations_batch = model.predict_on_batch(x_batch)
+        # A model with a single output does not return a list.
+        if len(layers_out) == 1:
+            activations_batch = [activations_batch]
+        yield [np.asarray(activations) for activations in activations_batch]
+
+
+def try_reload_activations(layer, model, x_norm, batch_size, activ_dir,
+                           stored):
+    """Load layer activations from disk, or compute them if not available.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.Layer
+        The layer for which we want to get the activations.
+
+    model: keras.models.Model
+        The model containing ``layer``.
+
+    x_norm: Optional[Union[np.array, DataflowBatches]]
+        The normalization data set.
+
+    batch_size: int
+        Batch size
+
+    activ_dir: str
+        Directory where the activations are stored.
+
+    stored: dict
+        Manifest entries of the valid activations in ``activ_dir``, keyed by
+        layer name (see `read_activations_manifest`).
+
+    Returns
+    -------
+
+    activations: Optional[Union[np.memmap, ndarray]]
+        The activations of ``layer``. Memory-mapped if they were stored
+        during a previous run. ``None`` if they are neither stored on disk nor
+        can be computed.
+    """
+
+    activations = load_activations(activ_dir, stored.get(layer.name))
+    if activations is not None:
+        print("Loading activations of layer {} stored during a previous "
+              "run.".format(layer.name))
+        return activations
+
+    if x_norm is None:
+        return
+
+    print("Calculating activations of layer {} ...".format(layer.name))
+    return get_activations_layers(model.input, [layer.output], x_norm,
+                                  batch_size)[0]
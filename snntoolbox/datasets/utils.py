@@ -15,11 +15,13 @@ For details see
 
 import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from configparser import NoOptionError
 import numpy as np
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from snntoolbox.utils.utils import import_helpers
+from snntoolbox.utils.utils import import_helpers, get_input_model_hash
 
 
 def get_dataset(config):
@@ -125,11 +127,11 @@ def get_dataset(config):
                 **dataflow_kwargs).next()[0]
             datagen.fit(x_orig)
         if is_normset_needed:
-            shuffle = dataflow_kwargs.get('shuffle')
-            dataflow_kwargs['shuffle'] = True
-            normset['dataflow'] = \
-                datagen.flow_from_directory(**dataflow_kwargs)
-            dataflow_kwargs['shuffle'] = shuffle
+            # A fixed seed selects the same samples for normalization in
+            # every run, so that results stored on disk can be reused.
+            normset['dataflow'] = datagen.flow_from_directory(**dict(
+                dataflow_kwargs, shuffle=True,
+                seed=dataflow_kwargs.get('seed', 0)))
         if is_testset_needed:
             testset = {
                 'dataflow': datagen.flow_from_directory(**dataflow_kwargs)}
@@ -175,6 +177,17 @@ def try_get_normset_from_scalefacs(config):
     filepath = os.path.join(newpath, config.get('normalization',
                                                 'percentile') + '.json')
     if os.path.isfile(filepath):
+        # Scale factors are only valid for the input model they were
+        # computed from (see `normalize_parameters`).
+        hashpath = os.path.splitext(filepath)[0] + '.sha1'
+        model_hash = None
+        if os.path.isfile(hashpath):
+            with open(hashpath) as f:
+                model_hash = f.read().strip()
+        if model_hash != get_input_model_hash(config):
+            print("Scale factors on disk were computed for a different input "
+                  "model. Recalculating.")
+            return {}
         print("Loading scale factors from disk instead of recalculating.")
         with open(filepath) as f:
             return {'scale_facs': json.load(f)}
@@ -182,6 +195,100 @@ def try_get_normset_from_scalefacs(config):
     return {}
 
 
+class DataflowBatches(object):
+    """Iterate over the first batches of a dataflow, loading them in parallel.
+
+    The batches are loaded by a pool of worker threads (image decoding and
+    preprocessing release the GIL), at most ``max_queue_size`` batches ahead
+    of the consumer. Each iteration yields the same samples in the same order,
+    so that the batches can be streamed through the network several times
+    without holding the data set in memory.
+
+    Parameters
+    ----------
+
+    dataflow: keras.preprocessing.image.Iterator
+        Loads images from disk and processes them on the fly.
+    num_samples: int
+        Number of samples to draw. Rounded up to full batches, but limited to
+        one pass over the dataflow.
+    num_workers: int
+        Number of threads that load batches.
+    max_queue_size: int
+        Maximum number of batches loaded ahead.
+    """
+
+    def __init__(self, dataflow, num_samples, num_workers=1,
+                 max_queue_size=10):
+        self.dataflow = dataflow
+        self.num_batches = min(len(dataflow),
+                               int(np.ceil(num_samples / dataflow.batch_size)))
+        self.num_workers = max(1, num_workers)
+        self.max_queue_size = max(1, max_queue_size)
+        # Fix the (possibly shuffled) order of samples before the workers
+        # access the dataflow concurrently.
+        if getattr(dataflow, 'index_array', None) is None and \
+                hasattr(dataflow, '_set_index_array'):
+            if getattr(dataflow, 'shuffle', False) and \
+                    getattr(dataflow, 'seed', None) is not None:
+                dataflow.index_array = np.random.RandomState(
+                    dataflow.seed).permutation(dataflow.n)
+            else:
+                dataflow._set_index_array()
+
+    def __len__(self):
+        return min(self.num_batches * self.dataflow.batch_size,
+                   self.dataflow.n)
+
+    def __iter__(self):
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            queue = deque()
+            for idx in range(self.num_batches):
+                if len(queue) == self.max_queue_size:
+                    yield queue.popleft().result()
+                queue.append(executor.submit(self.get_batch, idx))
+            while queue:
+                yield queue.popleft().result()
+
+    def get_batch(self, idx):
+        """Load the samples of batch ``idx``, without class labels."""
+
+        x = self.dataflow[idx]
+        if isinstance(x, tuple):  # Remove class label if present.
+            x = x[0]
+        return x
+
+    def get_description(self):
+        """Describe the samples that the batches contain.
+
+        Returns
+        -------
+
+        : Optional[str]
+            The sorted file paths of the samples, together with the size and
+            modification time of each file, and the settings of the image
+            preprocessing. The order of the samples is left out, because a
+            shuffled dataflow draws them in a different order in every run,
+            which does not affect normalization. ``None`` if the dataflow
+            does not load files.
+        """
+
+        filepaths = getattr(self.dataflow, 'filepaths', None)
+        index_array = getattr(self.dataflow, 'index_array', None)
+        if filepaths is None or index_array is None:
+            return
+        generator = getattr(self.dataflow, 'image_data_generator', None)
+        settings = sorted((key, value) for key, value in
+                          vars(generator).items() if isinstance(
+                              value, (bool, int, float, str, tuple))) \
+            if generator is not None else []
+        samples = []
+        for i in index_array[:len(self)]:
+            stat = os.stat(filepaths[i])
+            samples.append((filepaths[i], stat.st_size, stat.st_mtime))
+        return repr((sorted(samples), self.dataflow.image_shape, settings))
+
+
 def to_categorical(y, nb_classes):
     """Convert class vector to binary class matrix.
 
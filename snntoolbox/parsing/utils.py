@@ -1261,31 +1261,15 @@ def get_fanout_array(layer_pre, layer_post, is_depthwise_conv=False):
     shape = layer_pre.output_shape
     if 'Input' in get_type(layer_pre):
         shape = fix_input_layer_shape(shape)
-    fanout = np.zeros(shape[1:])
-
-    for y_pre in range(fanout.shape[0 + ax]):
-        y_post = [int((y_pre + py) / sy)]
-        wy = (y_pre + py) % sy
-        i = 1
-        while wy + i * sy < ky:
-            y = y_post[0] - i
-            if 0 <= y < ny:
-                y_post.append(y)
-            i += 1
-        for x_pre in range(fanout.shape[1 + ax]):
-            x_post = [int((x_pre + px) / sx)]
-            wx = (x_pre + px) % sx
-            i = 1
-            while wx + i * sx < kx:
-                x = x_post[0] - i
-                if 0 <= x < nx:
-                    x_post.append(x)
-                i += 1
-
-            if ax:
-                fanout[:, y_pre, x_pre] = len(x_post) * len(y_post)
-            else:
-                fanout[y_pre, x_pre, :] = len(x_post) * len(y_post)
+    shape = shape[1:]
+
+    # Number of output rows and columns that receive input from each row and
+    # column of the pre-synaptic layer.
+    fanout_y = get_fanout_per_axis(shape[0 + ax], ny, ky, sy, py)
+    fanout_x = get_fanout_per_axis(shape[1 + ax], nx, kx, sx, px)
+    fanout = np.outer(fanout_y, fanout_x).astype(float)
+    fanout = np.broadcast_to(fanout[None] if ax else fanout[:, :, None],
+                             shape).copy()
 
     if not is_depthwise_conv:
         fanout *= nz
@@ -1293,6 +1277,41 @@ def get_fanout_array(layer_pre, layer_post, is_depthwise_conv=False):
     return fanout
 
 
+def get_fanout_per_axis(n_pre, n_post, k, stride, padding):
+    """Number of post-synaptic positions a neuron projects to along one axis.
+
+    Parameters
+    ----------
+
+    n_pre: int
+        Size of the pre-synaptic feature map along this axis.
+    n_post: int
+        Size of the post-synaptic feature map along this axis.
+    k: int
+        Kernel size.
+    stride: int
+        Convolution stride.
+    padding: int
+        Zero-padding.
+
+    Returns
+    -------
+
+    fanout: ndarray
+        Fan-out of each pre-synaptic position along this axis.
+    """
+
+    # The first post-synaptic position is always counted; further ones are
+    # counted if the kernel still covers the neuron and they lie inside the
+    # feature map.
+    first, offset = np.divmod(np.arange(n_pre) + padding, stride)
+    i = np.arange(1, (k - 1) // stride + 1)
+    post = first[:, None] - i
+    valid = (offset[:, None] + i * stride < k) & (0 <= post) & (post < n_post)
+
+    return 1 + np.count_nonzero(valid, 1)
+
+
 def get_type(layer):
     """Get type of Keras layer.
 
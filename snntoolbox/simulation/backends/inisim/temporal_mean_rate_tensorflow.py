@@ -15,12 +15,14 @@ import os
 
 import json
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras.layers import Dense, Flatten, AveragePooling2D, \
     MaxPooling2D, Conv2D, DepthwiseConv2D, ZeroPadding2D, Reshape, Layer, \
     Concatenate
 
 from snntoolbox.parsing.utils import get_inbound_layers
+from snntoolbox.simulation.utils import SpikeEvents
 
 # Experimental
 clamp_var = False
@@ -35,12 +37,17 @@ class SpikeLayer(Layer):
         self.layer_type = self.class_name
         self.dt = self.config.getfloat('simulation', 'dt')
         self.duration = self.config.getint('simulation', 'duration')
+        self.num_timesteps = int(self.duration / self.dt)
         self.tau_refrac = self.config.getfloat('cell', 'tau_refrac')
         self._v_thresh = self.config.getfloat('cell', 'v_thresh')
         self.v_thresh = None
-        self.time = None
+        self.time = self.time_offset = None
         self.mem = self.spiketrain = self.impulse = self.spikecounts = None
         self.refrac_until = self.max_spikerate = None
+        self.spiketrain_buffer = self.mem_buffer = None
+        self.spike_event_buffer = self.spike_value_buffer = None
+        self.num_spike_events = None
+        self.fanout = self.synaptic_operations_buffer = None
         if clamp_var:
             self.spikerate = self.var = None
 
@@ -76,6 +83,23 @@ class SpikeLayer(Layer):
         self.stateful = True
         self._floatx = tf.keras.backend.floatx()
 
+        # The membrane potential can be stored at reduced precision, or as
+        # fixed-point number with a threshold quantized to the same grid.
+        self._state_dtype = tf.as_dtype(
+            self.config.get('simulation', 'state_dtype'))
+        self._mem_scale = self._mem_limits = None
+        if self._state_dtype.is_integer:
+            self._mem_scale = \
+                2. ** -self.config.getint('simulation', 'state_fraction_bits')
+            self._v_thresh = float(np.round(self._v_thresh / self._mem_scale) *
+                                   self._mem_scale)
+            # Largest float32 values that still fit into the integer type.
+            info = np.iinfo(self._state_dtype.as_numpy_dtype)
+            self._mem_limits = tuple(
+                np.nextafter(np.float32(x), np.float32(0))
+                if np.float32(x) != x else np.float32(x)
+                for x in (info.min, info.max))
+
     def reset(self, sample_idx):
         """Reset layer variables."""
 
@@ -131,10 +155,154 @@ class SpikeLayer(Layer):
 
         if self.spiketrain is not None:
             self.spiketrain.assign(tf.cast(tf.not_equal(output_spikes, 0),
-                                           self._floatx) * self.time)
+                                           self._floatx) *
+                                   self.get_sample_time())
+
+        self.record()
 
         return tf.cast(output_spikes, self._floatx)
 
+    def record(self):
+        """Write state variables of current time step to recording buffers.
+
+        The buffers stay on the device during the simulation and are read out
+        only once per batch, instead of copying the spike trains and membrane
+        potentials to the host at every time step.
+        """
+
+        idx = self.get_timestep() % self.num_timesteps
+        if self.spiketrain_buffer is not None:
+            self.spiketrain_buffer[idx].assign(self.spiketrain)
+        if self.spike_event_buffer is not None:
+            self.record_spike_events(idx)
+        if self.mem_buffer is not None:
+            self.mem_buffer[idx].assign(self.get_mem())
+        if self.synaptic_operations_buffer is not None:
+            spikes = tf.cast(tf.not_equal(self.spiketrain, 0), 'int32')
+            self.synaptic_operations_buffer[idx].assign(tf.reduce_sum(
+                spikes * self.fanout, list(range(1, len(spikes.shape)))))
+
+    def record_spike_events(self, idx):
+        """Append the spikes of the current time step to the event buffers.
+
+        Used instead of the dense ``spiketrain_buffer`` if
+        ``sparse_spiketrains`` is set, so that memory scales with the number
+        of spikes rather than with the number of time steps. The buffers
+        double their capacity whenever they run full.
+
+        Parameters
+        ----------
+
+        idx: tf.Tensor
+            Index of the current time step.
+        """
+
+        neuron_idxs = tf.where(tf.not_equal(self.spiketrain, 0))
+        values = tf.gather_nd(self.spiketrain, neuron_idxs)
+        events = tf.concat([tf.fill([tf.shape(neuron_idxs)[0], 1],
+                                    tf.cast(idx, 'int64')), neuron_idxs], 1)
+        start = self.num_spike_events.read_value()
+        stop = start + tf.shape(neuron_idxs, out_type='int64')[0]
+        capacity = tf.shape(self.spike_value_buffer, out_type='int64')[0]
+
+        def grow():
+            num_new = tf.maximum(capacity, stop - capacity)
+            self.spike_event_buffer.assign(tf.concat([
+                self.spike_event_buffer,
+                tf.zeros([num_new, tf.shape(events)[1]], 'int64')], 0))
+            self.spike_value_buffer.assign(tf.concat([
+                self.spike_value_buffer,
+                tf.zeros([num_new], self.spike_value_buffer.dtype)], 0))
+            return num_new
+
+        tf.cond(stop > capacity, grow, lambda: tf.constant(0, 'int64'))
+        self.spike_event_buffer[start:stop].assign(events)
+        self.spike_value_buffer[start:stop].assign(values)
+        self.num_spike_events.assign(stop)
+
+    def set_fanout(self, fanout):
+        """Set the number of outgoing synapses used to count operations.
+
+        Parameters
+        ----------
+
+        fanout: Union[int, ndarray]
+            Number of outgoing connections per neuron. Can be a single
+            integer, or an array of the layer shape (without batch dimension)
+            if the fanout varies from neuron to neuron.
+        """
+
+        if self.fanout is not None:
+            self.fanout.assign(tf.broadcast_to(tf.cast(fanout, 'int32'),
+                                               self.fanout.shape))
+
+    def get_synaptic_operations(self):
+        """Read out the synaptic operations counted during simulation.
+
+        Returns
+        -------
+
+        synaptic_operations_b_t: Optional[ndarray]
+            Number of synaptic operations caused by the spikes of this layer,
+            if counted. Shape: (`batch_size`, ``num_timesteps``)
+        """
+
+        if self.synaptic_operations_buffer is None:
+            return
+        return np.transpose(self.synaptic_operations_buffer.numpy())
+
+    def get_recorded_vars(self, sparse=False):
+        """Read out the recording buffers.
+
+        Parameters
+        ----------
+
+        sparse: Optional[bool]
+            If ``True``, only the spike events are extracted on the device and
+            transferred to the host, and the spike trains are returned as
+            `SpikeEvents`.
+
+        Returns
+        -------
+
+        spiketrains_b_l_t: Optional[Union[ndarray, SpikeEvents]]
+            Spike trains of the layer over the simulation time, if recorded.
+            Shape: (`batch_size`, ``layer_shape``, ``num_timesteps``)
+        mem_b_l_t: Optional[ndarray]
+            Membrane potentials of the layer over the simulation time, if
+            recorded. Same shape as ``spiketrains_b_l_t``.
+        """
+
+        if self.spike_event_buffer is not None:
+            num_events = int(self.num_spike_events.numpy())
+            events = self.spike_event_buffer[:num_events].numpy()
+            values = self.spike_value_buffer[:num_events].numpy()
+            shape = [int(s) for s in self.output_shape]
+            spiketrains_b_l_t = SpikeEvents(
+                shape + [self.num_timesteps],
+                np.ravel_multi_index(tuple(events[:, 1:].T), shape),
+                events[:, 0], values)
+            if not sparse:
+                spiketrains_b_l_t = spiketrains_b_l_t.to_dense()
+        elif self.spiketrain_buffer is None:
+            spiketrains_b_l_t = None
+        elif sparse:
+            idxs = tf.where(tf.not_equal(self.spiketrain_buffer, 0))
+            values = tf.gather_nd(self.spiketrain_buffer, idxs).numpy()
+            idxs = idxs.numpy()
+            shape = self.spiketrain_buffer.shape.as_list()
+            spiketrains_b_l_t = SpikeEvents(
+                shape[1:] + shape[:1],
+                np.ravel_multi_index(tuple(idxs[:, 1:].T), shape[1:]),
+                idxs[:, 0], values)
+        else:
+            spiketrains_b_l_t = \
+                np.moveaxis(self.spiketrain_buffer.numpy(), 0, -1)
+        mem_b_l_t = None if self.mem_buffer is None else \
+            np.moveaxis(self.mem_buffer.numpy(), 0, -1)
+
+        return spiketrains_b_l_t, mem_b_l_t
+
     def update_payload(self, residuals, spikes):
         """Update payloads.
 
@@ -198,6 +366,8 @@ class SpikeLayer(Layer):
     def get_new_mem(self):
         """Add input to membrane potential."""
 
+        mem = self.get_mem()
+
         # Destroy impulse if in refractory period
         masked_impulse = self.impulse if self.tau_refrac == 0 else \
             tf.where(tf.greater(self.refrac_until, self.time),
@@ -210,18 +380,18 @@ class SpikeLayer(Layer):
             # avoid a transient response.
             new_mem = tf.cond(tf.less(tf.reduce_mean(self.var), 1e-4) +
                               tf.greater(self.time, self.duration / 2),
-                              lambda: self.mem + masked_impulse,
-                              lambda: self.mem)
+                              lambda: mem + masked_impulse,
+                              lambda: mem)
         elif hasattr(self, 'clamp_idx'):
             # Set clamp-duration by a specific delay from layer to layer.
             new_mem = tf.cond(tf.less(self.time, self.clamp_idx),
-                              lambda: self.mem,
-                              lambda: self.mem + masked_impulse)
+                              lambda: mem,
+                              lambda: mem + masked_impulse)
         elif v_clip:
             # Clip membrane potential to prevent too strong accumulation.
-            new_mem = tf.clip_by_value(self.mem + masked_impulse, -3, 3)
+            new_mem = tf.clip_by_value(mem + masked_impulse, -3, 3)
         else:
-            new_mem = self.mem + masked_impulse
+            new_mem = mem + masked_impulse
 
         if self.config.getboolean('cell', 'leak'):
             # Todo: Implement more flexible version of leak!
@@ -253,7 +423,60 @@ class SpikeLayer(Layer):
             new = tf.where(tf.not_equal(spikes, 0), mem % self.v_thresh, mem)
         else:  # self.config.get('cell', 'reset') == 'Reset to zero':
             new = tf.where(tf.not_equal(spikes, 0), tf.zeros_like(mem), mem)
-        self.mem.assign(new)
+        self.set_mem(new)
+
+    def get_mem(self):
+        """Get membrane potential.
+
+        Returns
+        -------
+
+        mem: tf.Tensor
+            Membrane potential as floating point tensor, independently of the
+            precision it is stored at (see ``state_dtype``).
+        """
+
+        mem = tf.cast(self.mem, self._floatx)
+        if self._mem_scale is not None:
+            mem *= self._mem_scale
+        return mem
+
+    def set_mem(self, mem):
+        """Store membrane potential at the precision given by ``state_dtype``.
+
+        Parameters
+        ----------
+
+        mem: tf.Tensor
+            Membrane potential as floating point tensor.
+        """
+
+        self.mem.assign(self.quantize_mem(mem))
+
+    def quantize_mem(self, mem):
+        """Convert membrane potential to the data type it is stored in.
+
+        Integer states are fixed-point numbers with ``state_fraction_bits``
+        fractional bits, rounded to the nearest value and saturated at the
+        range of the data type.
+
+        Parameters
+        ----------
+
+        mem: tf.Tensor
+            Membrane potential as floating point tensor.
+
+        Returns
+        -------
+
+        mem: tf.Tensor
+            Membrane potential of type ``state_dtype``.
+        """
+
+        if self._mem_scale is not None:
+            mem = tf.clip_by_value(tf.round(mem / self._mem_scale),
+                                   *self._mem_limits)
+        return tf.cast(mem, self._state_dtype)
 
     def get_new_thresh(self):
         """Get new threshhold."""
@@ -282,6 +505,41 @@ class SpikeLayer(Layer):
 
         return self.time.eval
 
+    def get_timestep(self):
+        """Get index of current simulation time step.
+
+        Returns
+        -------
+
+        timestep: tf.Tensor
+            Integer index of current time step, starting at zero.
+        """
+
+        return tf.cast(tf.round(self.time / self.dt), 'int32') - 1
+
+    def get_sample_time(self):
+        """Get simulation time of each sample in the batch.
+
+        Equals the simulation time `get_time`, unless the states of individual
+        samples were reset (see `reset_spikevars`), in which case their time
+        counts from the reset on.
+
+        Returns
+        -------
+
+        time: tf.Tensor
+            Current simulation time of each sample, broadcastable to the
+            output shape of the layer.
+        """
+
+        return self._expand_sample_dim(self.time - self.time_offset)
+
+    def _expand_sample_dim(self, x):
+        """Reshape a tensor of shape (`batch_size`,) to broadcast over the
+        neurons of the layer."""
+
+        return tf.reshape(x, [-1] + [1] * (len(self.mem.shape) - 1))
+
     def set_time(self, time):
         """Set simulation time variable.
 
@@ -294,6 +552,29 @@ class SpikeLayer(Layer):
 
         self.time.assign(time)
 
+    def shift_time(self, shift):
+        """Move the origin of the simulation time.
+
+        The simulation time, the times at which individual samples were reset
+        (see `get_sample_time`), and the end of the refractory periods are all
+        moved by the same amount, so that the time of each sample is
+        unchanged.
+
+        Parameters
+        ----------
+
+        shift: float
+            Amount by which to decrease the simulation time. Must not exceed
+            the time since the oldest running sample was reset.
+        """
+
+        self.time.assign_sub(shift)
+        self.time_offset.assign(self.time_offset - shift)
+        if self.tau_refrac > 0:
+            # Zero marks neurons that are not refractory.
+            self.refrac_until.assign(
+                tf.maximum(self.refrac_until - shift, 0))
+
     def init_membrane_potential(self, output_shape=None, mode='zero'):
         """Initialize membrane potential.
 
@@ -338,22 +619,71 @@ class SpikeLayer(Layer):
         return init_mem
 
     @tf.function
-    def reset_spikevars(self, sample_idx):
+    def reset_spikevars(self, sample_idx, mask=None):
         """
         Reset variables present in spiking layers. Can be turned off for
         instance when a video sequence is tested.
+
+        Parameters
+        ----------
+
+        sample_idx: tf.Tensor
+            Index of the sample that has just been simulated. Together with
+            ``reset_between_nth_sample``, it determines whether the membrane
+            potential and the simulation time are reset. When resetting
+            individual samples (see ``mask``), this is a tensor of shape
+            (`batch_size`,) counting the samples of each slot in the batch.
+        mask: Optional[tf.Tensor]
+            Boolean tensor of shape (`batch_size`,). If given, only the states
+            of the selected samples are reset, while the other samples of the
+            batch are left untouched, as are the global simulation time and
+            the recording buffers. Instead, the time of the selected samples
+            restarts (see `get_sample_time`). Used to refill or multiplex
+            individual slots of a batch.
         """
 
         mod = self.config.getint('simulation', 'reset_between_nth_sample')
         mod = mod if mod else sample_idx + 1
         do_reset = sample_idx % mod == 0
+
+        if mask is not None:
+            do_reset = tf.logical_and(mask, do_reset)
+            self.time_offset.assign(tf.where(do_reset, self.time,
+                                             self.time_offset))
+            do_reset = self._expand_sample_dim(do_reset)
+            mask = self._expand_sample_dim(mask)
+            zeros = tf.zeros(self.output_shape, self._floatx)
+            self.set_mem(tf.where(do_reset, self.init_membrane_potential(),
+                                  self.get_mem()))
+            if self.tau_refrac > 0:
+                self.refrac_until.assign(tf.where(mask, zeros,
+                                                  self.refrac_until))
+            if self.spiketrain is not None:
+                self.spiketrain.assign(tf.where(mask, zeros, self.spiketrain))
+            if self.payloads:
+                self.payloads.assign(tf.where(mask, zeros, self.payloads))
+                self.payloads_sum.assign(tf.where(mask, zeros,
+                                                  self.payloads_sum))
+            return
+
         if do_reset:
-            self.mem.assign(self.init_membrane_potential())
+            self.set_mem(self.init_membrane_potential())
             self.time.assign(self.dt)
+            self.time_offset.assign(tf.zeros_like(self.time_offset))
         if self.tau_refrac > 0:
             self.refrac_until.assign(tf.zeros(self.output_shape, self._floatx))
         if self.spiketrain is not None:
             self.spiketrain.assign(tf.zeros(self.output_shape, self._floatx))
+        if self.spiketrain_buffer is not None:
+            self.spiketrain_buffer.assign(
+                tf.zeros_like(self.spiketrain_buffer))
+        if self.num_spike_events is not None:
+            self.num_spike_events.assign(0)
+        if self.mem_buffer is not None:
+            self.mem_buffer.assign(tf.zeros_like(self.mem_buffer))
+        if self.synaptic_operations_buffer is not None:
+            self.synaptic_operations_buffer.assign(
+                tf.zeros_like(self.synaptic_operations_buffer))
         if self.payloads:
             self.payloads.assign(tf.zeros(self.output_shape, self._floatx))
             self.payloads_sum.assign(tf.zeros(self.output_shape, self._floatx))
@@ -376,10 +706,13 @@ class SpikeLayer(Layer):
             self.v_thresh = tf.Variable(self._v_thresh, name='v_thresh',
                                         trainable=False)
         if self.mem is None:
-            self.mem = tf.Variable(self.init_membrane_potential(output_shape),
-                                   name='v_mem', trainable=False)
+            self.mem = tf.Variable(
+                self.quantize_mem(self.init_membrane_potential(output_shape)),
+                name='v_mem', trainable=False)
         if self.time is None:
             self.time = tf.Variable(self.dt, name='dt', trainable=False)
+            self.time_offset = tf.Variable(tf.zeros(output_shape[:1]),
+                                           name='time_offset', trainable=False)
         # To save memory and computations, allocate only where needed:
         if self.tau_refrac > 0 and self.tau_refrac_until is None:
             self.refrac_until = tf.Variable(
@@ -391,6 +724,37 @@ class SpikeLayer(Layer):
                get_log_keys(self.config))) and self.spiketrain is None:
             self.spiketrain = tf.Variable(tf.zeros(output_shape),
                                           trainable=False, name='spiketrains')
+            if self.config.getboolean('output', 'sparse_spiketrains'):
+                # Start with room for one time step of all neurons firing.
+                capacity = int(np.prod(output_shape))
+                self.spike_event_buffer = tf.Variable(
+                    tf.zeros([capacity, len(output_shape) + 1], 'int64'),
+                    trainable=False, name='spike_event_buffer',
+                    shape=tf.TensorShape([None, len(output_shape) + 1]))
+                self.spike_value_buffer = tf.Variable(
+                    tf.zeros([capacity]), trainable=False,
+                    name='spike_value_buffer', shape=tf.TensorShape([None]))
+                self.num_spike_events = tf.Variable(
+                    0, dtype='int64', trainable=False,
+                    name='num_spike_events')
+            else:
+                self.spiketrain_buffer = tf.Variable(
+                    tf.zeros([self.num_timesteps] + list(output_shape)),
+                    trainable=False, name='spiketrain_buffer')
+        if any({'operations', 'synaptic_operations_b_t'} &
+               (get_plot_keys(self.config) | get_log_keys(self.config))) \
+                and self.synaptic_operations_buffer is None:
+            self.fanout = tf.Variable(tf.zeros(output_shape[1:], 'int32'),
+                                      trainable=False, name='fanout')
+            self.synaptic_operations_buffer = tf.Variable(
+                tf.zeros([self.num_timesteps, output_shape[0]], 'int32'),
+                trainable=False, name='synaptic_operations_buffer')
+        if ('mem_n_b_l_t' in get_log_keys(self.config) or
+                'v_mem' in get_plot_keys(self.config)) \
+                and self.mem_buffer is None:
+            self.mem_buffer = tf.Variable(
+                tf.zeros([self.num_timesteps] + list(output_shape)),
+                trainable=False, name='mem_buffer')
         if self.online_normalization and self.spikecounts is None:
             self.spikecounts = tf.Variable(tf.zeros(output_shape),
                                            trainable=False, name='spikecounts')
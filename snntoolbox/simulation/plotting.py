@@ -14,7 +14,7 @@ from snntoolbox.utils.utils import get_pearson_coefficients, extract_label, \
     wilson_score
 from snntoolbox.conversion.utils import get_activations_batch
 from snntoolbox.simulation.utils import get_sample_activity_from_batch, \
-    spiketrains_to_rates
+    spiketrains_to_rates, SpikeEvents
 
 
 def output_graphs(plot_vars, config, path=None, idx=0, data_format=None):
@@ -782,12 +782,12 @@ def plot_spiketrains(layer, dt, path=None, data_format=None):
     Parameters
     ----------
 
-    layer: tuple[np.array, str]
+    layer: tuple[Union[np.array, SpikeEvents], str]
         ``(spiketimes, label)``.
 
         ``spiketimes`` is a 2D array where the first index runs over the number
         of neurons in the layer, and the second index contains the spike times
-        of the specific neuron.
+        of the specific neuron. Can also be given as `SpikeEvents`.
 
         ``label`` is a string specifying both the layer type and the index,
         e.g. ``'3Dense'``.
@@ -806,17 +806,27 @@ def plot_spiketrains(layer, dt, path=None, data_format=None):
     data = layer[0]
     duration = data.shape[-1]
 
-    if data_format == 'channels_last' and data.ndim == 4:
-        data = np.moveaxis(data, 2, 0)
-
-    nz = np.reshape(data, (-1, duration)).nonzero()
+    if isinstance(data, SpikeEvents):
+        neuron_idxs = data.neuron_idxs
+        if data_format == 'channels_last' and data.ndim == 4:
+            idxs = np.unravel_index(neuron_idxs, data.shape[:-1])
+            neuron_idxs = np.ravel_multi_index(
+                (idxs[2], idxs[0], idxs[1]),
+                [data.shape[i] for i in [2, 0, 1]])
+        nz = (neuron_idxs, data.timesteps)
+        t_min = np.min(data.values, initial=0)
+    else:
+        if data_format == 'channels_last' and data.ndim == 4:
+            data = np.moveaxis(data, 2, 0)
+        nz = np.reshape(data, (-1, duration)).nonzero()
+        t_min = np.min(data)
 
     plt.figure()
     plt.scatter(nz[1] * dt, nz[0], s=1, linewidths=0, color='b')
     plt.title('Spiketrains \n of layer {}'.format(layer[1]))
     plt.xlabel('time [ms]')
     plt.ylabel('neuron index')
-    plt.xlim(min([dt, np.min(data)]), (duration + 1) * dt)
+    plt.xlim(min([dt, t_min]), (duration + 1) * dt)
     if path is not None:
         filename = '7Spiketrains'
         plt.savefig(os.path.join(path, filename), bbox_inches='tight')
@@ -1046,6 +1056,9 @@ def plot_spikecount_vs_time(spiketrains_n_b_l_t, duration, dt, path=None):
                  spiketrains_n_b_l_t[0][0].shape[-1])
     spikecounts_b_t = np.zeros(b_t_shape)
     for n in range(len(spiketrains_n_b_l_t)):  # Loop over layers
+        if isinstance(spiketrains_n_b_l_t[n][0], SpikeEvents):
+            spikecounts_b_t += spiketrains_n_b_l_t[n][0].get_spikecounts_b_t()
+            continue
         spiketrains_b_l_t = np.not_equal(spiketrains_n_b_l_t[n][0], 0)
         reduction_axes = tuple(np.arange(1, spiketrains_b_l_t.ndim-1))
         spikecounts_b_t += np.sum(spiketrains_b_l_t, reduction_axes)
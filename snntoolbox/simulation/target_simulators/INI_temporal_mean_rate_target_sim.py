@@ -4,14 +4,17 @@
 @author: rbodo
 """
 
+import itertools
 import os
 import sys
 
+import tensorflow as tf
 from tensorflow import keras
 import numpy as np
 
 from snntoolbox.parsing.utils import get_inbound_layers_with_params
-from snntoolbox.simulation.utils import AbstractSNN, remove_name_counter
+from snntoolbox.simulation.utils import AbstractSNN, remove_name_counter, \
+    get_layer_synaptic_operations
 
 remove_classifier = False
 
@@ -42,6 +45,27 @@ class SNN(AbstractSNN):
         self._spiking_layers = {}
         self._input_images = None
         self._binary_activation = None
+        self._is_fused = self.config.getboolean('simulation',
+                                                'fused_simulation')
+        self._has_recorders = False
+        self._early_exit_margin = self.config.getint('simulation',
+                                                     'early_exit_margin')
+        self._early_exit_patience = self.config.getint('simulation',
+                                                       'early_exit_patience')
+        self._is_refill = self.config.getboolean('simulation', 'batch_refill')
+        self._state_dtype = self.config.get('simulation', 'state_dtype')
+        self._is_float_reference = self.config.getboolean(
+            'simulation', 'float_reference') and self._state_dtype != 'float32'
+        # State of the batch slots when refilling the batch (see
+        # `simulate_stream`). Persists between batches.
+        self._slot_x_b_l = self._slot_y_b_l = self._slot_output_b_l_t = None
+        self._slot_t_b = self._slot_streak_b = self._slot_is_active_b = None
+        self._slot_num_samples_b = None
+        self._slot_num_steps = 0
+        # Time step at which the simulation time of the layers is zero (see
+        # `_refill_slots`).
+        self._slot_step_origin = 0
+        self._finished_samples = []
 
     @property
     def is_parallelizable(self):
@@ -130,10 +154,64 @@ class SNN(AbstractSNN):
                     keras.backend.set_value(
                         layer.b0, keras.backend.get_value(layer.bias))
 
+        self._init_recording()
+
+    def run(self, x_test=None, y_test=None, dataflow=None, **kwargs):
+
+        top1acc_total = AbstractSNN.run(self, x_test, y_test, dataflow,
+                                        **kwargs)
+
+        if self._is_float_reference:
+            top1acc_float = self._run_float_reference(x_test, y_test, dataflow,
+                                                      **kwargs)
+            print("Accuracy with {} state: {:.2%}, with float32 state: {:.2%} "
+                  "(difference: {:+.2%}).\n".format(
+                    self._state_dtype, top1acc_total, top1acc_float,
+                    top1acc_total - top1acc_float))
+
+        return top1acc_total
+
+    def _run_float_reference(self, x_test=None, y_test=None, dataflow=None,
+                             **kwargs):
+        """Simulate the network again with float32 neuron state.
+
+        Used to report the effect of a reduced precision ``state_dtype`` on
+        the accuracy. Logging and plotting is turned off for this run.
+
+        Returns
+        -------
+
+        top1acc_total: float
+            Accuracy of the reference network.
+        """
+
+        overrides = {('simulation', 'state_dtype'): 'float32',
+                     ('output', 'log_vars'): '{}',
+                     ('output', 'plot_vars'): '{}'}
+        settings = {key: self.config.get(*key) for key in overrides}
+        log_dir = kwargs.get(str('path'), self.config.get(
+            'paths', 'log_dir_of_current_run'))
+        kwargs[str('path')] = os.path.join(log_dir, 'float32_reference')
+
+        print("Simulating reference network with float32 state...\n")
+        try:
+            for key, value in overrides.items():
+                self.config.set(*key, value)
+            reference = SNN(self.config, self.queue)
+            reference.build(self.parsed_model)
+            if hasattr(dataflow, 'reset'):
+                dataflow.reset()
+            return reference.run(x_test, y_test, dataflow, **kwargs)
+        finally:
+            for key, value in settings.items():
+                self.config.set(*key, value)
+
     def simulate(self, **kwargs):
 
         from snntoolbox.utils.utils import echo
-        from snntoolbox.simulation.utils import get_layer_synaptic_operations
+
+        if self._is_fused:
+            return self.simulate_fused(**kwargs)
 
         input_b_l = kwargs[str('x_b_l')] * self._dt
 
@@ -148,6 +226,8 @@ class SNN(AbstractSNN):
 
         # Loop through simulation time.
         self._input_spikecount = 0
+        num_steps = 0
+        streak_b = np.zeros(self.batch_size, int)
         for sim_step_int in range(num_timesteps):
             sim_step = (sim_step_int + 1) * self._dt
             self.set_time(sim_step)
@@ -158,6 +238,14 @@ class SNN(AbstractSNN):
             elif self._is_aedat_input:
                 input_b_l = kwargs[str('dvs_gen')].next_eventframe_batch()
 
+            # The batch keeps its size until all samples are decided, but
+            # decided samples receive no more input, so that they stop
+            # causing synaptic operations.
+            if self._early_exit_margin > 0:
+                is_running_b = streak_b < self._early_exit_patience
+                input_b_l = input_b_l * np.reshape(
+                    is_running_b, (-1,) + (1,) * (input_b_l.ndim - 1))
+
             if self._is_early_stopping and np.count_nonzero(input_b_l) == 0:
                 print("\nInput empty: Finishing simulation {} steps early."
                       "".format(self._num_timesteps - sim_step_int))
@@ -174,41 +262,19 @@ class SNN(AbstractSNN):
             else:
                 output_b_l_t[:, :, sim_step_int] = out_spikes > 0
 
-            # Record neuron variables.
-            i = j = 0
-            for layer in self.snn.layers:
-                # Excludes Input, Flatten, Concatenate, etc:
-                if hasattr(layer, 'spiketrain') \
-                        and layer.spiketrain is not None:
-                    spiketrains_b_l = keras.backend.get_value(layer.spiketrain)
-                    if self.spiketrains_n_b_l_t is not None:
-                        self.spiketrains_n_b_l_t[i][0][
-                            Ellipsis, sim_step_int] = spiketrains_b_l
-                    if self.synaptic_operations_b_t is not None:
-                        self.synaptic_operations_b_t[:, sim_step_int] += \
-                            get_layer_synaptic_operations(spiketrains_b_l,
-                                                          self.fanout[i + 1])
-                    if self.neuron_operations_b_t is not None:
-                        self.neuron_operations_b_t[:, sim_step_int] += \
-                            self.num_neurons_with_bias[i + 1]
-                    i += 1
-                if hasattr(layer, 'mem') and self.mem_n_b_l_t is not None:
-                    self.mem_n_b_l_t[j][0][Ellipsis, sim_step_int] = \
-                        keras.backend.get_value(layer.mem)
-                    j += 1
-
-            if 'input_b_l_t' in self._log_keys:
-                self.input_b_l_t[Ellipsis, sim_step_int] = input_b_l
-            if self._poisson_input or self._is_aedat_input:
-                if self.synaptic_operations_b_t is not None:
-                    self.synaptic_operations_b_t[:, sim_step_int] += \
-                        get_layer_synaptic_operations(input_b_l,
-                                                      self.fanout[0])
-            else:
-                if self.neuron_operations_b_t is not None:
-                    if sim_step_int == 0:
-                        self.neuron_operations_b_t[:, 0] += self.fanin[1] * \
-                            self.num_neurons[1] * np.ones(self.batch_size) * 2
+            # Freeze the output of samples that have already been decided.
+            if self._early_exit_margin > 0:
+                output_b_l_t[streak_b >= self._early_exit_patience, :,
+                             sim_step_int] = 0
+
+            num_steps = sim_step_int + 1
+
+            # Record neuron variables. If the layers keep their own recording
+            # buffers, they are read out once after the simulation instead.
+            if not self._has_recorders:
+                self._record_layer_vars(sim_step_int)
+
+            self._record_input(input_b_l, sim_step_int)
 
             spike_sums_b_l = np.sum(output_b_l_t, 2)
             undecided_b = np.sum(spike_sums_b_l, 1) == 0
@@ -223,9 +289,552 @@ class SNN(AbstractSNN):
                 sys.stdout.write('\r{:>7.2%}'.format(current_acc))
                 sys.stdout.flush()
 
+            if self._early_exit_margin > 0:
+                streak_b = self._update_decisions(spike_sums_b_l, streak_b,
+                                                  sim_step_int)
+                if all(streak_b >= self._early_exit_patience):
+                    print("\nAll samples decided: Finishing simulation {} "
+                          "steps early.".format(
+                              self._num_timesteps - num_steps))
+                    break
+
+        if self._has_recorders:
+            self._read_recorders(num_steps)
+
+        self._check_remaining_events(kwargs.get(str('dvs_gen')))
+
+        return np.cumsum(output_b_l_t, 2)
+
+    def simulate_stream(self, samples, **kwargs):
+        """Simulate the test samples while keeping the batch full.
+
+        With ``batch_refill`` enabled, each slot of the batch runs its own
+        sample. When a sample is finished (after ``duration``, or as soon as it
+        is decided when ``early_exit_margin`` is set), the neurons of its slot
+        are reset and the slot is refilled with the next sample from the
+        stream, while the other samples keep running. The method returns once
+        `batch_size` samples are finished; samples that are still running are
+        continued in the next call.
+
+        See `AbstractSNN.simulate_stream` for parameters and return values.
+        The samples of a returned batch are ordered by the time they finished.
+        """
+
+        if not self._is_refill:
+            return AbstractSNN.simulate_stream(self, samples, **kwargs)
+
+        if self._slot_x_b_l is None:
+            self._slot_x_b_l = np.zeros(self.snn.input_shape,
+                                        keras.backend.floatx())
+            self._slot_output_b_l_t = np.zeros(
+                (self.batch_size, self.num_classes, self._num_timesteps))
+            self._slot_t_b = np.zeros(self.batch_size, int)
+            self._slot_streak_b = np.zeros(self.batch_size, int)
+            self._slot_is_active_b = np.zeros(self.batch_size, bool)
+            self._slot_num_samples_b = np.zeros(self.batch_size, int)
+
+        while len(self._finished_samples) < self.batch_size:
+            self._refill_slots(samples)
+            if not np.any(self._slot_is_active_b):
+                break
+            self._slot_num_steps += 1
+            self.set_time((self._slot_num_steps - self._slot_step_origin) *
+                          self._dt)
+
+            if self._poisson_input:
+                input_b_l = self.get_poisson_frame_batch(self._slot_x_b_l)
+            else:
+                input_b_l = self._slot_x_b_l * self._dt
+
+            out_spikes = self.snn.predict_on_batch(input_b_l)
+
+            is_active_b = self._slot_is_active_b
+            idxs = np.flatnonzero(is_active_b)
+            self._slot_output_b_l_t[idxs, :, self._slot_t_b[idxs]] = \
+                out_spikes[idxs] > 0
+            self._slot_t_b[idxs] += 1
+
+            is_done_b = is_active_b & (self._slot_t_b >= self._num_timesteps)
+            if self._early_exit_margin > 0:
+                self._slot_streak_b = self._update_decisions(
+                    np.sum(self._slot_output_b_l_t, 2), self._slot_streak_b)
+                is_done_b |= is_active_b & \
+                    (self._slot_streak_b >= self._early_exit_patience)
+
+            for i in np.flatnonzero(is_done_b):
+                self._finished_samples.append((
+                    self._slot_x_b_l[i].copy(), self._slot_y_b_l[i].copy(),
+                    np.cumsum(self._slot_output_b_l_t[i], 1),
+                    self._slot_t_b[i] * self._dt))
+                self._slot_x_b_l[i] = 0
+            self._slot_is_active_b[is_done_b] = False
+
+        num_samples = min(len(self._finished_samples), self.batch_size)
+        if num_samples == 0:
+            return None
+        finished = self._finished_samples[:num_samples]
+        self._finished_samples = self._finished_samples[num_samples:]
+
+        x_b_l = np.zeros_like(self._slot_x_b_l)
+        y_b_l = np.zeros_like(self._slot_y_b_l)
+        output_b_l_t = np.zeros_like(self._slot_output_b_l_t)
+        x_b_l[:num_samples], y_b_l[:num_samples], \
+            output_b_l_t[:num_samples], latency_b = \
+            [np.stack(a) for a in zip(*finished)]
+        if self.latency_b is not None:
+            self.latency_b[:num_samples] = latency_b
+
+        print("Finished {} samples after {} time steps.".format(
+            num_samples, self._slot_num_steps))
+
+        return x_b_l, y_b_l, output_b_l_t, num_samples
+
+    def _refill_slots(self, samples):
+        """Put the next samples from the stream into the free batch slots.
+
+        The neurons of the refilled slots are reset (subject to
+        ``reset_between_nth_sample``, counted per slot), while the samples in
+        the other slots keep running.
+
+        Afterwards, the time origin of the layers is moved to the start of the
+        oldest running sample. The simulation time thus stays below
+        ``duration`` on streams of any length, instead of growing with the
+        number of samples (and losing precision in ``float32``).
+
+        Parameters
+        ----------
+
+        samples: Iterator
+            Yields tuples ``(x, y)`` of an input sample and its label.
+        """
+
+        idxs = np.flatnonzero(np.logical_not(self._slot_is_active_b))
+        new_samples = list(itertools.islice(samples, len(idxs)))
+        if len(new_samples) == 0:
+            return
+        idxs = idxs[:len(new_samples)]
+
+        x_b_l, y_b_l = [np.stack(a) for a in zip(*new_samples)]
+        if self._slot_y_b_l is None:
+            self._slot_y_b_l = np.zeros((self.batch_size,) + y_b_l.shape[1:],
+                                        y_b_l.dtype)
+        self._slot_x_b_l[idxs] = x_b_l
+        self._slot_y_b_l[idxs] = y_b_l
+        self._slot_output_b_l_t[idxs] = 0
+        self._slot_t_b[idxs] = 0
+        self._slot_streak_b[idxs] = 0
+        self._slot_is_active_b[idxs] = True
+
+        # Each slot counts its own samples, so that the reset period
+        # (``reset_between_nth_sample``) applies to the sequence of samples
+        # running in a slot.
+        sample_idx_b = np.maximum(self._slot_num_samples_b - 1, 0)
+        self._slot_num_samples_b[idxs] += 1
+        mask = tf.constant(np.isin(np.arange(self.batch_size), idxs))
+        for layer in self.snn.layers[1:]:
+            if hasattr(layer, 'reset_spikevars'):
+                layer.reset_spikevars(tf.constant(sample_idx_b), mask)
+
+        is_active_b = self._slot_is_active_b
+        shift = np.min(self._slot_num_steps - self._slot_t_b[is_active_b]) - \
+            self._slot_step_origin
+        if shift > 0:
+            self._slot_step_origin += shift
+            for layer in self.snn.layers[1:]:
+                if hasattr(layer, 'shift_time'):
+                    layer.shift_time(float(shift * self._dt))
+
+    def simulate_fused(self, **kwargs):
+        """Simulate the whole duration of a batch in a single graph call.
+
+        In contrast to `simulate`, the loop over time steps (including setting
+        the simulation time of each layer, generating the input and collecting
+        the output spikes) is compiled into one ``tf.while_loop``, so the
+        simulation is not slowed down by dispatching every time step from
+        Python.
+
+        Returns
+        -------
+
+        output_b_l_t: ndarray
+            Array of shape (`batch_size`, `num_classes`, ``num_timesteps``),
+            containing the cumulative number of output spikes.
+        """
+
+        x_b_l = kwargs[str('x_b_l')]
+
+        num_timesteps = self._get_timestep_at_spikecount(x_b_l * self._dt)
+
+        num_steps, output_t_b_l, input_t_b_l, spikecount = self._run_fused(
+            tf.constant(x_b_l, keras.backend.floatx()),
+            tf.constant(num_timesteps))
+        num_steps = int(num_steps)
+        self._input_spikecount = int(spikecount)
+
+        output_b_l_t = np.zeros((self.batch_size, self.num_classes,
+                                 self._num_timesteps))
+        output_b_l_t[Ellipsis, :num_steps] = np.moveaxis(
+            output_t_b_l.numpy()[:num_steps], 0, -1)
+
+        # The decisions were taken in the graph already; replay them to get
+        # the decision time of each sample.
+        streak_b = np.zeros(self.batch_size, int)
+        if self._early_exit_margin > 0:
+            spike_sums_b_l = np.cumsum(output_b_l_t, 2)
+            for t in range(num_steps):
+                streak_b = self._update_decisions(spike_sums_b_l[Ellipsis, t],
+                                                  streak_b, t)
+
+        if all(streak_b >= self._early_exit_patience) and \
+                self._early_exit_margin > 0 and num_steps < num_timesteps:
+            print("\nAll samples decided: Finishing simulation {} steps "
+                  "early.".format(self._num_timesteps - num_steps))
+        elif num_steps < num_timesteps:
+            print("\nInput empty: Finishing simulation {} steps early."
+                  "".format(self._num_timesteps - num_steps))
+        if input_t_b_l is not None:
+            for t, input_b_l in enumerate(input_t_b_l.numpy()[:num_steps]):
+                self._record_input(input_b_l, t)
+        elif self.neuron_operations_b_t is not None and num_steps > 0:
+            self._record_input(None, 0)
+        self._read_recorders(num_steps)
+
+        spike_sums_b_l = np.sum(output_b_l_t, 2)
+        undecided_b = np.sum(spike_sums_b_l, 1) == 0
+        guesses_b = np.where(undecided_b, -1, np.argmax(spike_sums_b_l, 1))
+        print("Accuracy of batch: {:.2%}".format(
+            np.mean(kwargs[str('truth_b')] == guesses_b)))
+
+        self._check_remaining_events()
+
+        return np.cumsum(output_b_l_t, 2)
+
+    @tf.function
+    def _run_fused(self, x_b_l, num_timesteps):
+        """Graph-compiled simulation loop used by `simulate_fused`.
+
+        Parameters
+        ----------
+
+        x_b_l: tf.Tensor
+            The input frame. Shape: (`batch_size`, ``layer_shape``).
+        num_timesteps: tf.Tensor
+            Maximum number of time steps to simulate.
+
+        Returns
+        -------
+
+        num_steps: tf.Tensor
+            Number of time steps that were actually simulated (can be smaller
+            than ``num_timesteps`` when stopping early).
+        output_t_b_l: tf.Tensor
+            Output spikes. Shape: (``num_steps``, `batch_size`,
+            `num_classes`).
+        input_t_b_l: Optional[tf.Tensor]
+            Input to the network, if ``input_b_l_t`` is recorded. Shape:
+            (``num_steps``, `batch_size`, ``layer_shape``).
+        spikecount: tf.Tensor
+            Number of Poisson input spikes generated per sample.
+        """
+
+        floatx = keras.backend.floatx()
+        layers = [layer for layer in self.snn.layers[1:]
+                  if layer.get_time() is not None]
+        record_input = 'input_b_l_t' in self._log_keys or \
+            (self._poisson_input and self.synaptic_operations_b_t is not None)
+        max_spikecount = self._num_poisson_events_per_sample
+        x_max = tf.reduce_max(x_b_l)
+        output_shape = self.snn.output_shape
+        margin = self._early_exit_margin
+        patience = self._early_exit_patience
+
+        def get_input(spikecount):
+            if not self._poisson_input:
+                return x_b_l * self._dt, spikecount
+            # Same as `get_poisson_frame_batch`, but using the tensorflow
+            # random number generator.
+            spike_snapshot = tf.random.uniform(tf.shape(x_b_l)) * \
+                self.rescale_fac * x_max
+            input_b_l = tf.cast(spike_snapshot <= tf.abs(x_b_l), floatx)
+            if max_spikecount >= 0:
+                input_b_l *= tf.cast(spikecount < max_spikecount, floatx)
+            spikecount += tf.cast(tf.math.count_nonzero(input_b_l),
+                                  tf.int32) // self.batch_size
+            return input_b_l * x_max * tf.sign(x_b_l), spikecount
+
+        def step(t, is_empty, spikecount, outputs, inputs, spike_sums_b_l,
+                 streak_b):
+            sim_step = tf.cast(t + 1, floatx) * self._dt
+            for layer in layers:
+                layer.set_time(sim_step)
+
+            input_b_l, spikecount = get_input(spikecount)
+            if margin > 0:
+                # Decided samples receive no more input (see `simulate`).
+                is_running_b = tf.cast(streak_b < patience, floatx)
+                input_b_l *= tf.reshape(
+                    is_running_b, [-1] + [1] * (len(x_b_l.shape) - 1))
+
+            if self._is_early_stopping:
+                is_empty = tf.equal(tf.math.count_nonzero(input_b_l), 0)
+                out_spikes = tf.cond(
+                    is_empty, lambda: tf.zeros(output_shape, floatx),
+                    lambda: self.snn(input_b_l, training=False))
+            else:
+                out_spikes = self.snn(input_b_l, training=False)
+
+            out_spikes = tf.cast(out_spikes > 0, floatx)
+            if margin > 0:
+                # Freeze the output of samples that have been decided, and
+                # count for how many consecutive steps the spike count of the
+                # leading class exceeds the second one by ``margin``.
+                out_spikes *= tf.cast(streak_b < patience, floatx)[:, None]
+                spike_sums_b_l += out_spikes
+                top2_b = tf.math.top_k(spike_sums_b_l, 2).values
+                streak_b = tf.where(top2_b[:, 0] - top2_b[:, 1] >= margin,
+                                    streak_b + 1, 0)
+
+            outputs = outputs.write(t, out_spikes)
+            if record_input:
+                inputs = inputs.write(t, input_b_l)
+
+            return (tf.where(is_empty, t, t + 1), is_empty, spikecount,
+                    outputs, inputs, spike_sums_b_l, streak_b)
+
+        def is_running(t, is_empty, spikecount, outputs, inputs,
+                       spike_sums_b_l, streak_b):
+            return tf.logical_and(
+                tf.logical_and(t < num_timesteps, tf.logical_not(is_empty)),
+                tf.logical_not(tf.reduce_all(streak_b >= patience))
+                if margin > 0 else True)
+
+        outputs = tf.TensorArray(floatx, size=0, dynamic_size=True)
+        inputs = tf.TensorArray(floatx, size=0, dynamic_size=True)
+        num_steps, _, spikecount, outputs, inputs, _, _ = tf.while_loop(
+            is_running, step, [tf.constant(0), tf.constant(False),
+                               tf.constant(0), outputs, inputs,
+                               tf.zeros(output_shape, floatx),
+                               tf.zeros(output_shape[:1], tf.int32)])
+
+        return (num_steps, outputs.stack(),
+                inputs.stack() if record_input else None, spikecount)
+
+    def set_connectivity(self):
+
+        connectivity = AbstractSNN.set_connectivity(self)
+
+        # Layers that count their synaptic operations on the device need to
+        # know the fanout of their neurons.
+        i = 0
+        for layer in self.snn.layers:
+            if getattr(layer, 'spiketrain', None) is not None:
+                if hasattr(layer, 'set_fanout'):
+                    layer.set_fanout(self.fanout[i + 1])
+                i += 1
+
+        return connectivity
+
+    def _init_recording(self):
+        """Check how layer variables can be recorded during simulation.
+
+        The layers of the tensorflow backend keep their spike trains and
+        membrane potentials in recording buffers on the device. Other backends
+        are read out at every time step, which rules out the fused simulation
+        loop.
+        """
+
+        self._has_recorders = all(hasattr(layer, 'spiketrain_buffer')
+                                  for layer in self.snn.layers
+                                  if hasattr(layer, 'spiketrain'))
+
+        if self._is_fused and not self._is_fusable():
+            print("SNN toolbox WARNING: Fused simulation does not support "
+                  "DVS input, or recording of layer variables with this "
+                  "backend. Falling back on step-wise simulation.")
+            self._is_fused = False
+
+        if self._is_refill and not self._is_refillable():
+            print("SNN toolbox WARNING: Refilling the batch is not supported "
+                  "with fused simulation, DVS input, a limited number of "
+                  "Poisson input events, online normalization, clamping, or "
+                  "recording of layer variables. Falling back on fixed "
+                  "batches.")
+            self._is_refill = False
+
+    def _update_decisions(self, spike_sums_b_l, streak_b, sim_step_int=None):
+        """Check which samples have reached a confident classification.
+
+        A sample is decided once the spike count of the leading output neuron
+        exceeds that of the runner-up by ``early_exit_margin`` for
+        ``early_exit_patience`` consecutive time steps. The output of decided
+        samples is frozen from then on.
+
+        Parameters
+        ----------
+
+        spike_sums_b_l: ndarray
+            Number of output spikes of each sample up to the current time
+            step. Shape: (`batch_size`, `num_classes`)
+        streak_b: ndarray
+            Number of consecutive time steps each sample has exceeded the
+            margin before the current step.
+        sim_step_int: Optional[int]
+            Current time step. Used to log the decision time; if ``None``,
+            nothing is logged.
+
+        Returns
+        -------
+
+        streak_b: ndarray
+            Updated number of consecutive time steps. Samples with
+            ``streak_b >= early_exit_patience`` are decided.
+        """
+
+        top2_b = np.sort(spike_sums_b_l, 1)[:, -2:]
+        streak_b = np.where(top2_b[:, 1] - top2_b[:, 0] >=
+                            self._early_exit_margin, streak_b + 1, 0)
+
+        if self.latency_b is not None and sim_step_int is not None:
+            is_new_b = streak_b == self._early_exit_patience
+            self.latency_b[is_new_b] = (sim_step_int + 1) * self._dt
+
+        return streak_b
+
+    def _is_fusable(self):
+        """Whether the simulation loop can be compiled into a single graph.
+
+        The DVS input generator runs in Python, and layers without recording
+        buffers are read out at every time step, so in these cases we need to
+        simulate step by step.
+        """
+
+        if self._is_aedat_input or remove_classifier:
+            return False
+
+        return self._has_recorders or not (
+            any({'spiketrains', 'spikerates', 'correlation', 'spikecounts',
+                 'hist_spikerates_activations', 'operations',
+                 'v_mem'} & self._plot_keys) or
+            any({'spiketrains_n_b_l_t', 'mem_n_b_l_t',
+                 'synaptic_operations_b_t',
+                 'neuron_operations_b_t'} & self._log_keys))
+
+    def _is_refillable(self):
+        """Whether finished samples can be replaced while the batch runs.
+
+        Refilling a slot resets the neurons of a single sample. This rules out
+        anything that depends on the state of the whole batch, or is logged
+        over the time steps of a batch.
+        """
+
+        if self._is_fused or self._is_aedat_input or remove_classifier or \
+                not self._has_recorders:
+            return False
+
+        if self._poisson_input and self._num_poisson_events_per_sample >= 0:
+            return False
+
+        if any(hasattr(layer, 'clamp_idx') or
+               getattr(layer, 'online_normalization', False)
+               for layer in self.snn.layers):
+            return False
+
+        return not (
+            any({'spiketrains', 'spikerates', 'correlation', 'spikecounts',
+                 'hist_spikerates_activations', 'operations',
+                 'v_mem'} & self._plot_keys) or
+            any({'spiketrains_n_b_l_t', 'mem_n_b_l_t', 'input_b_l_t',
+                 'synaptic_operations_b_t',
+                 'neuron_operations_b_t'} & self._log_keys))
+
+    def _record_layer_vars(self, sim_step_int):
+        """Copy the layer variables of the current time step to the host."""
+
+        i = j = 0
+        for layer in self.snn.layers:
+            # Excludes Input, Flatten, Concatenate, etc:
+            if hasattr(layer, 'spiketrain') \
+                    and layer.spiketrain is not None:
+                spiketrains_b_l = keras.backend.get_value(layer.spiketrain)
+                if self.spiketrains_n_b_l_t is not None:
+                    self.spiketrains_n_b_l_t[i][0][
+                        Ellipsis, sim_step_int] = spiketrains_b_l
+                if self.synaptic_operations_b_t is not None:
+                    self.synaptic_operations_b_t[:, sim_step_int] += \
+                        get_layer_synaptic_operations(spiketrains_b_l,
+                                                      self.fanout[i + 1])
+                if self.neuron_operations_b_t is not None:
+                    self.neuron_operations_b_t[:, sim_step_int] += \
+                        self.num_neurons_with_bias[i + 1]
+                i += 1
+            if hasattr(layer, 'mem') and self.mem_n_b_l_t is not None:
+                self.mem_n_b_l_t[j][0][Ellipsis, sim_step_int] = \
+                    keras.backend.get_value(layer.mem)
+                j += 1
+
+    def init_recording_array(self, shape, sparse=False):
+        """Allocate a host array to record a layer variable into.
+
+        If the layers keep their own recording buffers on the device, the host
+        arrays are only filled in by `_read_recorders` after the simulation.
+        """
+
+        if self._has_recorders:
+            return None
+
+        return AbstractSNN.init_recording_array(self, shape, sparse)
+
+    def _read_recorders(self, num_steps):
+        """Read out the recording buffers of all layers after simulation.
+
+        Parameters
+        ----------
+
+        num_steps: int
+            Number of time steps that were simulated.
+        """
+
+        i = j = 0
+        for layer in self.snn.layers:
+            if not hasattr(layer, 'get_recorded_vars'):
+                continue
+            spiketrains_b_l_t, mem_b_l_t = layer.get_recorded_vars(
+                self._sparse_spiketrains)
+            if spiketrains_b_l_t is not None:
+                if self.spiketrains_n_b_l_t is not None:
+                    self.spiketrains_n_b_l_t[i] = (
+                        spiketrains_b_l_t, self.spiketrains_n_b_l_t[i][1])
+                if self.synaptic_operations_b_t is not None:
+                    self.synaptic_operations_b_t += \
+                        layer.get_synaptic_operations()
+                if self.neuron_operations_b_t is not None:
+                    self.neuron_operations_b_t[:, :num_steps] += \
+                        self.num_neurons_with_bias[i + 1]
+                i += 1
+            if mem_b_l_t is not None:
+                self.mem_n_b_l_t[j] = (mem_b_l_t, self.mem_n_b_l_t[j][1])
+                j += 1
+
+    def _record_input(self, input_b_l, sim_step_int):
+        """Record the input and count the operations it causes."""
+
+        if 'input_b_l_t' in self._log_keys:
+            self.input_b_l_t[Ellipsis, sim_step_int] = input_b_l
+        if self._poisson_input or self._is_aedat_input:
+            if self.synaptic_operations_b_t is not None:
+                self.synaptic_operations_b_t[:, sim_step_int] += \
+                    get_layer_synaptic_operations(input_b_l, self.fanout[0])
+        else:
+            if self.neuron_operations_b_t is not None:
+                if sim_step_int == 0:
+                    self.neuron_operations_b_t[:, 0] += self.fanin[1] * \
+                        self.num_neurons[1] * np.ones(self.batch_size) * 2
+
+    def _check_remaining_events(self, dvs_gen=None):
+        """Warn if not all input events of a batch have been processed."""
+
         if self._is_aedat_input:
-            remaining_events = \
-                kwargs[str('dvs_gen')].remaining_events_of_current_batch()
+            remaining_events = dvs_gen.remaining_events_of_current_batch()
         elif self._poisson_input and self._num_poisson_events_per_sample > 0:
             remaining_events = self._num_poisson_events_per_sample - \
                 self._input_spikecount
@@ -236,10 +845,12 @@ class SNN(AbstractSNN):
                   "finished, but {} input events were not processed. Consider "
                   "increasing the simulation time.".format(remaining_events))
 
-        return np.cumsum(output_b_l_t, 2)
-
     def reset(self, sample_idx):
 
+        # When refilling the batch, the slots are reset individually.
+        if self._is_refill:
+            return
+
         for layer in self.snn.layers[1:]:  # Skip input layer
             layer.reset(sample_idx)
 
@@ -261,6 +872,7 @@ class SNN(AbstractSNN):
 
         try:
             self.snn = keras.models.load_model(filepath, custom_layers)
+            self._init_recording()
         except KeyError:
             raise NotImplementedError(
                 "Loading SNN for INIsim is not supported yet.")
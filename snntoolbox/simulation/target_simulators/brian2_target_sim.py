@@ -12,7 +12,8 @@ from tensorflow.keras.models import load_model
 
 from snntoolbox.parsing.utils import get_type
 from snntoolbox.simulation.utils import AbstractSNN, get_shape_from_label, \
-    build_convolution, build_pooling, get_ann_ops
+    build_convolution, build_pooling, get_ann_ops, get_dense_connections, \
+    get_flatten_permutation
 from snntoolbox.utils.utils import confirm_overwrite
 
 
@@ -50,6 +51,19 @@ class SNN(AbstractSNN):
 
     snn: brian2.Network
         The spiking network.
+
+    Notes
+    -----
+
+    If ``replicate_batch`` is set, each layer holds one copy of its neurons
+    per sample in a batch, so that a whole batch is simulated in one run.
+
+    With the ``cpp_standalone`` code generation target, the network is
+    compiled once, on the first call to `simulate`. The inputs and cell
+    parameters are then passed to each run of the compiled binary, so that
+    neither new samples nor a parameter sweep trigger a rebuild. Each run
+    starts from the initial state, i.e. the network is reset after every
+    batch.
     """
 
     def __init__(self, config, queue=None):
@@ -63,30 +77,47 @@ class SNN(AbstractSNN):
             self.v_reset = 'v = v - v_thresh'
         else:
             self.v_reset = 'v = v_reset'
+        # The cell parameters are variables of the neuron groups rather than
+        # constants in the generated code, so that changing them does not
+        # require recompiling the network.
         self.eqs = '''dv/dt = bias : 1
-                      bias : hertz'''
+                      bias : hertz
+                      v_thresh : 1 (shared)
+                      v_reset : 1 (shared)'''
+        # Max pooling: Pass on only those spikes that increase the maximum
+        # spike count of the input neurons in a pooling window.
+        self._maxpool_gating = config.getboolean('simulation',
+                                                 'maxpool_gating')
+        self.gating_eqs = 'count_max : 1'
+        self.gating_on_pre = '''count += 1
+                                is_max = int(count > count_max_post)
+                                v_post += w * is_max
+                                count_max_post += is_max'''
         self.spikemonitors = []
         self.statemonitors = []
         self.snn = None
         self._input_layer = None
         self._cell_params = None
+        self._standalone = \
+            config.get('brian2', 'codegen_target') == 'cpp_standalone'
+        self._is_compiled = False
 
         # Track the output layer spikes.
         self.output_spikemonitor = None
 
     @property
     def is_parallelizable(self):
-        return False
+        return self.config.getboolean('brian2', 'replicate_batch')
 
     def add_input_layer(self, input_shape):
 
         if self._poisson_input:
             self.layers.append(self.sim.PoissonGroup(
-                np.prod(input_shape[1:]), rates=0*self.sim.Hz,
+                np.prod(input_shape), rates=0*self.sim.Hz,
                 dt=self._dt*self.sim.ms))
         else:
             self.layers.append(self.sim.NeuronGroup(
-                np.prod(input_shape[1:]), model=self.eqs, method='euler',
+                np.prod(input_shape), model=self.eqs, method='euler',
                 reset=self.v_reset, threshold=self.threshold,
                 dt=self._dt * self.sim.ms))
         self.layers[0].add_attribute('label')
@@ -105,12 +136,19 @@ class SNN(AbstractSNN):
                 (layer.name, get_shape_from_label(self.layers[-1].label)))
             return
 
+        if self._is_gated(layer):
+            eqs = self.eqs + '\n' + self.gating_eqs
+            model, on_pre = 'w:1\ncount:1', self.gating_on_pre
+        else:
+            eqs, model, on_pre = self.eqs, 'w:1', 'v+=w'
+
         self.layers.append(self.sim.NeuronGroup(
-            np.prod(layer.output_shape[1:]), model=self.eqs, method='euler',
+            self.batch_size * np.prod(layer.output_shape[1:]), model=eqs,
+            method='euler',
             reset=self.v_reset, threshold=self.threshold,
             dt=self._dt * self.sim.ms))
         self.connections.append(self.sim.Synapses(
-            self.layers[-2], self.layers[-1], 'w:1', on_pre='v+=w',
+            self.layers[-2], self.layers[-1], model, on_pre=on_pre,
             dt=self._dt * self.sim.ms))
         self.layers[-1].add_attribute('label')
         self.layers[-1].label = layer.name
@@ -134,70 +172,101 @@ class SNN(AbstractSNN):
         self.set_biases(biases)
 
         delay = self.config.getfloat('cell', 'delay')
-        connections = []
-
+        source_idxs = None
         if len(self.flatten_shapes) == 1:
             print("Swapping data_format of Flatten layer.")
             flatten_name, shape = self.flatten_shapes.pop()
-            if self.data_format == 'channels_last':
-                y_in, x_in, f_in = shape
-            else:
-                f_in, y_in, x_in = shape
-            for i in range(weights.shape[0]):  # Input neurons
-                # Sweep across channel axis of feature map. Assumes that each
-                # consecutive input neuron lies in a different channel. This is
-                # the case for channels_last, but not for channels_first.
-                f = i % f_in
-                # Sweep across height of feature map. Increase y by one if all
-                # rows along the channel axis were seen.
-                y = i // (f_in * x_in)
-                # Sweep across width of feature map.
-                x = (i // f_in) % x_in
-                new_i = f * x_in * y_in + x_in * y + x
-                for j in range(weights.shape[1]):  # Output neurons
-                    connections.append((new_i, j, weights[i, j], delay))
+            source_idxs = get_flatten_permutation(shape, self.data_format)
         elif len(self.flatten_shapes) > 1:
             raise RuntimeWarning("Not all Flatten layers have been consumed.")
-        else:
-            for i in range(weights.shape[0]):
-                for j in range(weights.shape[1]):
-                    connections.append((i, j, weights[i, j], delay))
+        connections = get_dense_connections(
+            weights, delay, source_idxs,
+            chunk_size=self._connection_chunk_size)
 
-        connections = np.array(connections)
-
-        self.connections[-1].connect(i=connections[:, 0].astype('int64'),
-                                     j=connections[:, 1].astype('int64'))
-
-        self.connections[-1].w = connections[:, 2]
+        self.connect(connections)
 
     def build_convolution(self, layer, weights=None):
 
         delay = self.config.getfloat('cell', 'delay')
         transpose_kernel = \
             self.config.get('simulation', 'keras_backend') == 'tensorflow'
-        conns, biases = build_convolution(layer, delay, transpose_kernel)
-        connections = np.array(conns)
+        connections, biases = build_convolution(
+            layer, delay, transpose_kernel, self._connectivity_cache,
+            chunk_size=self._connection_chunk_size)
 
         self.set_biases(biases)
 
         print("Connecting layer...")
 
-        self.connections[-1].connect(i=connections[:, 0].astype('int64'),
-                                     j=connections[:, 1].astype('int64'))
+        self.connect(connections, weights)
+
+    def get_prefetch_layers(self):
+
+        layers = self.parsed_model.layers[1:]
 
-        w = connections[:, 2] if weights is None else weights.flatten()
-        self.connections[-1].w = w
+        return layers, [None] * len(layers)
 
     def build_pooling(self, layer, weights=None):
 
         delay = self.config.getfloat('cell', 'delay')
-        connections = np.array(build_pooling(layer, delay))
+        connections = build_pooling(layer, delay,
+                                    1 if self._is_gated(layer) else None,
+                                    self._connectivity_cache)
+
+        self.connect(connections, weights)
+
+    def connect(self, connections, weights=None):
+        """Create the synapses of the current layer.
+
+        Parameters
+        ----------
+
+        connections: Union[ndarray, Iterator[ndarray]]
+            Array of shape (``num_connections``, 4) with the source and target
+            neuron indices and the weight of each synapse in the first three
+            columns, or an iterator over consecutive blocks of such rows. The
+            synapses of each block are appended to the ``Synapses`` object
+            before the next block is generated. Each block is connected once
+            per replica of the network (see ``replicate_batch``).
+        weights: Optional[ndarray]
+            Weights to use instead of those in ``connections``, e.g. when
+            loading a stored model.
+        """
+
+        if isinstance(connections, np.ndarray):
+            connections = [connections]
+        if weights is not None:
+            weights = weights.ravel()
+
+        synapses = self.connections[-1]
+        num_replicas = self.batch_size
+        num_pre = len(synapses.source) // num_replicas
+        num_post = len(synapses.target) // num_replicas
+        replicas = np.arange(num_replicas)[:, None]
+        # The standalone device cannot index synapses before they exist, so
+        # the weights are assigned at once after connecting all blocks.
+        standalone_weights = []
+        start = 0
+        for chunk in connections:
+            stop = start + len(chunk)
+            i = chunk[:, 0].astype('int64') + replicas * num_pre
+            j = chunk[:, 1].astype('int64') + replicas * num_post
+            synapses.connect(i=i.ravel(), j=j.ravel())
+            w = np.tile(chunk[:, 2] if weights is None
+                        else weights[start:stop], num_replicas)
+            if self._standalone:
+                standalone_weights.append(w)
+            else:
+                synapses.w[num_replicas * start:num_replicas * stop] = w
+            start = stop
+
+        if self._standalone:
+            synapses.w = np.concatenate(standalone_weights)
 
-        self.connections[-1].connect(i=connections[:, 0].astype('int64'),
-                                     j=connections[:, 1].astype('int64'))
+    def _is_gated(self, layer):
+        """Whether to approximate max pooling by gating the input spikes."""
 
-        w = connections[:, 2] if weights is None else weights.flatten()
-        self.connections[-1].w = w
+        return self._maxpool_gating and get_type(layer) == 'MaxPooling2D'
 
     def compile(self):
 
@@ -205,7 +274,8 @@ class SNN(AbstractSNN):
         spikemonitors = self.spikemonitors + [self.output_spikemonitor]
         self.snn = self.sim.Network(self.layers, self.connections,
                                     spikemonitors, self.statemonitors)
-        self.snn.store()
+        if not self._standalone:
+            self.snn.store()
 
         # Set input layer
         for obj in self.snn.objects:
@@ -217,21 +287,55 @@ class SNN(AbstractSNN):
 
         inputs = kwargs[str('x_b_l')].flatten() / self.sim.ms
         if self._poisson_input:
-            self._input_layer.rates = inputs / self.rescale_fac
+            input_name, inputs = 'rates', inputs / self.rescale_fac
         elif self._is_aedat_input:
             # TODO: Implement by using brian2.SpikeGeneratorGroup.
             raise NotImplementedError
         else:
-            self._input_layer.bias = inputs
+            input_name = 'bias'
 
-        self.snn.run(self._duration * self.sim.ms, namespace=self._cell_params,
-                     report='stdout', report_period=10 * self.sim.ms)
+        if self._standalone:
+            self.run_standalone({getattr(self._input_layer, input_name):
+                                 inputs})
+        else:
+            setattr(self._input_layer, input_name, inputs)
+            self.snn.run(self._duration * self.sim.ms, report='stdout',
+                         report_period=10 * self.sim.ms)
 
         output_b_l_t = self.get_recorded_vars(self.layers)
 
         return output_b_l_t
 
+    def run_standalone(self, run_args):
+        """Run the network compiled by the ``cpp_standalone`` device.
+
+        The network is compiled on the first call. Later calls only execute
+        the binary with new initial values.
+
+        Parameters
+        ----------
+
+        run_args: dict
+            Maps variables (e.g. the input rates) to the values they take at
+            the start of the run. The cell parameters are added here.
+        """
+
+        device = self.sim.get_device()
+        if not self._is_compiled:
+            self.snn.run(self._duration * self.sim.ms, report='stdout',
+                         report_period=10 * self.sim.ms)
+            device.build(directory=os.path.join(
+                self.config.get('paths', 'path_wd'), 'brian2_cpp_standalone'),
+                run=False)
+            self._is_compiled = True
+
+        run_args.update(self._cell_params)
+        device.run(run_args=run_args)
+
     def reset(self, sample_idx):
+        if self._standalone:
+            # Every run of the compiled network starts from the initial state.
+            return
         mod = self.config.getint('simulation', 'reset_between_nth_sample')
         mod = mod if mod else sample_idx + 1
         if sample_idx % mod == 0:
@@ -244,6 +348,11 @@ class SNN(AbstractSNN):
 
     def save(self, path, filename):
 
+        if self._standalone:
+            print("The weights of a network compiled in standalone mode can "
+                  "only be read after running it. Not saving weights.")
+            return
+
         print("Saving weights ...")
         for i, connection in enumerate(self.connections):
             filepath = os.path.join(path,
@@ -257,7 +366,12 @@ class SNN(AbstractSNN):
                     os.makedirs(directory)
                 print("Store weights of layer {} to file {}".format(
                     self.layers[i + 1].label, filepath))
-                np.savez(filepath, self.connections[i].w)
+                w = connection.w[:]
+                if self.batch_size > 1:
+                    # Store the weights of the first replica only.
+                    num_pre = len(connection.source) // self.batch_size
+                    w = w[connection.i[:] < num_pre]
+                np.savez(filepath, w)
 
     def load(self, path, filename):
 
@@ -320,10 +434,22 @@ class SNN(AbstractSNN):
         self.is_built = True
 
     def init_cells(self):
-        self._cell_params = {
-            'v_thresh': self.config.getfloat('cell', 'v_thresh'),
-            'v_reset': self.config.getfloat('cell', 'v_reset'),
-            'tau_m': self.config.getfloat('cell', 'tau_m') * self.sim.ms}
+        cell_params = {'v_thresh': self.config.getfloat('cell', 'v_thresh'),
+                       'v_reset': self.config.getfloat('cell', 'v_reset')}
+        groups = [layer for layer in self.layers
+                  if 'v_thresh' in layer.variables]
+
+        if self._standalone:
+            self._cell_params = {getattr(group, key): value
+                                 for group in groups
+                                 for key, value in cell_params.items()}
+            return
+
+        for group in groups:
+            for key, value in cell_params.items():
+                setattr(group, key, value)
+        # Restoring the network between samples keeps the new parameters.
+        self.snn.store()
 
     def get_spiketrains(self, **kwargs):
         j = self._spiketrains_container_counter
@@ -339,17 +465,18 @@ class SNN(AbstractSNN):
         i = len(self.spikemonitors) - 1 if kwargs[str('monitor_index')] == -1 \
             else kwargs[str('monitor_index')] + 1
         spiketrain_dict = self.spikemonitors[i].spike_trains()
-        spiketrains_flat = np.array([spiketrain_dict[key] / self.sim.ms for key
-                                     in spiketrain_dict.keys()])
-        spiketrains_b_l_t = \
-            self.reshape_flattened_spiketrains(spiketrains_flat, shape)
+        spiketrains_flat = [spiketrain_dict[key] / self.sim.ms for key
+                            in spiketrain_dict.keys()]
+        spiketrains_b_l_t = self.reshape_flattened_spiketrains(
+            spiketrains_flat, shape, sparse=self._sparse_spiketrains)
         return spiketrains_b_l_t
 
     def get_spiketrains_input(self):
-        shape = list(self.parsed_model.input_shape) + [self._num_timesteps]
+        shape = [self.batch_size] + list(self.parsed_model.input_shape[1:]) \
+            + [self._num_timesteps]
         spiketrain_dict = self.spikemonitors[0].spike_trains()
-        spiketrains_flat = np.array([spiketrain_dict[key] / self.sim.ms for key
-                                     in spiketrain_dict.keys()])
+        spiketrains_flat = [spiketrain_dict[key] / self.sim.ms for key
+                            in spiketrain_dict.keys()]
         spiketrains_b_l_t = \
             self.reshape_flattened_spiketrains(spiketrains_flat, shape)
         return spiketrains_b_l_t
@@ -357,8 +484,8 @@ class SNN(AbstractSNN):
     def get_spiketrains_output(self):
         shape = [self.batch_size, self.num_classes, self._num_timesteps]
         spiketrain_dict = self.output_spikemonitor.spike_trains()
-        spiketrains_flat = np.array([spiketrain_dict[key] / self.sim.ms for key
-                                     in spiketrain_dict.keys()])
+        spiketrains_flat = [spiketrain_dict[key] / self.sim.ms for key
+                            in spiketrain_dict.keys()]
         spiketrains_b_l_t = \
             self.reshape_flattened_spiketrains(spiketrains_flat, shape)
         return spiketrains_b_l_t
@@ -379,6 +506,7 @@ class SNN(AbstractSNN):
     def set_biases(self, biases):
         """Set biases."""
         if any(biases):
+            biases = np.tile(biases, self.batch_size)
             assert self.layers[-1].bias.shape == biases.shape, \
                 "Shape of biases and network do not match."
             self.layers[-1].bias = biases / self.sim.ms
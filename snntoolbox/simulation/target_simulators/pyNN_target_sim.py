@@ -10,12 +10,17 @@ import os
 import sys
 import time
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 from six.moves import cPickle
 
+from snntoolbox.parsing.utils import get_type
 from snntoolbox.utils.utils import confirm_overwrite, is_module_installed
-from snntoolbox.simulation.utils import AbstractSNN, get_shape_from_label
+from snntoolbox.simulation.utils import AbstractSNN, get_shape_from_label, \
+    get_dense_connections, get_flatten_permutation, write_connections_npy, \
+    read_connections_npy, update_connection_manifest, \
+    read_connection_manifest, reset_connection_manifest
 from snntoolbox.bin.utils import config_string_to_set_of_strings
 
 
@@ -39,6 +44,11 @@ class SNN(AbstractSNN):
     cellparams: dict
         Neuron cell parameters determining properties of the spiking neurons in
         pyNN simulators.
+
+    relays: list[pyNN.Population]
+        Relay neurons of the winner-take-all circuits that approximate max
+        pooling (see ``maxpool_gating``). They are not part of ``layers``,
+        so they are neither recorded nor counted as layers.
     """
 
     def __init__(self, config, queue=None):
@@ -46,6 +56,7 @@ class SNN(AbstractSNN):
         AbstractSNN.__init__(self, config, queue)
 
         self.layers = []
+        self.relays = []
         self.connections = []
         self.cellparams = {key: config.getfloat('cell', key) for key in
                            config_string_to_set_of_strings(config.get(
@@ -55,6 +66,9 @@ class SNN(AbstractSNN):
                   "reserved for the biases and should not be set globally.")
             self.cellparams.pop('i_offset')
         self.change_padding = False
+        self._binary_export = config.getboolean('output', 'binary_export')
+        self._maxpool_gating = config.getboolean('simulation',
+                                                 'maxpool_gating')
 
     @property
     def is_parallelizable(self):
@@ -116,38 +130,19 @@ class SNN(AbstractSNN):
 
         self.set_biases(np.array(biases, 'float64'))
         delay = self.config.getfloat('cell', 'delay')
-        connections = []
+        source_idxs = None
         if len(self.flatten_shapes) == 1:
             print("Swapping data_format of Flatten layer.")
             flatten_name, shape = self.flatten_shapes.pop()
-            if self.data_format == 'channels_last':
-                y_in, x_in, f_in = shape
-            else:
-                f_in, y_in, x_in = shape
-            for i in range(weights.shape[0]):  # Input neurons
-                # Sweep across channel axis of feature map. Assumes that each
-                # consecutive input neuron lies in a different channel. This is
-                # the case for channels_last, but not for channels_first.
-                f = i % f_in
-                # Sweep across height of feature map. Increase y by one if all
-                # rows along the channel axis were seen.
-                y = i // (f_in * x_in)
-                # Sweep across width of feature map.
-                x = (i // f_in) % x_in
-                new_i = f * x_in * y_in + x_in * y + x
-                for j in range(weights.shape[1]):  # Output neurons
-                    connections.append((new_i, j, weights[i, j], delay))
+            source_idxs = get_flatten_permutation(shape, self.data_format)
         elif len(self.flatten_shapes) > 1:
             raise RuntimeWarning("Not all Flatten layers have been consumed.")
-        else:
-            for i in range(weights.shape[0]):
-                for j in range(weights.shape[1]):
-                    connections.append((i, j, weights[i, j], delay))
+        connections = get_dense_connections(
+            weights, delay, source_idxs,
+            chunk_size=self._connection_chunk_size)
 
         if self.config.getboolean('tools', 'simulate'):
-            self.connections.append(self.sim.Projection(
-                self.layers[-2], self.layers[-1],
-                self.sim.FromListConnector(connections, ['weight', 'delay'])))
+            self.connect(connections)
 
     def build_convolution(self, layer):
         from snntoolbox.simulation.utils import build_convolution
@@ -167,25 +162,127 @@ class SNN(AbstractSNN):
         delay = self.config.getfloat('cell', 'delay')
         transpose_kernel = \
             self.config.get('simulation', 'keras_backend') == 'tensorflow'
-        connections, biases = build_convolution(layer, delay, transpose_kernel)
+        connections, biases = build_convolution(
+            layer, delay, transpose_kernel, self._connectivity_cache,
+            chunk_size=self._connection_chunk_size)
 
         self.set_biases(biases)
 
         if self.config.getboolean('tools', 'simulate'):
-            self.connections.append(self.sim.Projection(
-                self.layers[-2], self.layers[-1],
-                self.sim.FromListConnector(connections, ['weight', 'delay'])))
+            self.connect(connections)
+
+    def get_prefetch_layers(self):
+
+        # ZeroPadding layers are removed when building the pyNN model, and
+        # applied in the next convolution layer instead (see `add_layer` and
+        # `build_convolution`). The prefetched connectivity has to include the
+        # padding to be found in the cache.
+        layers, paddings = [], []
+        change_padding = False
+        for layer in self.parsed_model.layers[1:]:
+            if 'ZeroPadding' in layer.__class__.__name__:
+                change_padding = True
+                continue
+            padding = None
+            if change_padding and \
+                    get_type(layer) in {'Conv2D', 'DepthwiseConv2D'}:
+                change_padding = False
+                padding = 'ZeroPadding'
+            layers.append(layer)
+            paddings.append(padding)
+
+        return layers, paddings
 
     def build_pooling(self, layer):
         from snntoolbox.simulation.utils import build_pooling
 
+        if self._is_gated(layer):
+            self.build_max_pooling(layer)
+            return
+
         delay = self.config.getfloat('cell', 'delay')
-        connections = build_pooling(layer, delay)
+        connections = build_pooling(layer, delay,
+                                    cache_dir=self._connectivity_cache)
         if self.config.getboolean('tools', 'simulate'):
             self.connections.append(self.sim.Projection(
                 self.layers[-2], self.layers[-1],
                 self.sim.FromListConnector(connections, ['weight', 'delay'])))
 
+    def build_max_pooling(self, layer):
+        """Approximate a max pooling layer by a winner-take-all circuit.
+
+        The relay neurons of the circuit (see
+        `snntoolbox.simulation.utils.build_max_pooling`) form a separate
+        population between the previous layer and the pooling layer.
+
+        Parameters
+        ----------
+
+        layer: keras.layers.MaxPooling2D
+            Parsed model layer.
+        """
+
+        from snntoolbox.simulation.utils import build_max_pooling
+
+        delay = self.config.getfloat('cell', 'delay')
+        input_connections, lateral_connections, output_connections = \
+            build_max_pooling(layer, delay,
+                              cache_dir=self._connectivity_cache)
+        if not self.config.getboolean('tools', 'simulate'):
+            return
+
+        relay = self.sim.Population(len(input_connections),
+                                    self.sim.IF_curr_exp, self.cellparams,
+                                    label=layer.name + '_relay')
+        relay.initialize(v=relay.get('v_rest'))
+        self.relays.append(relay)
+        self.connections += [
+            self.sim.Projection(
+                self.layers[-2], relay, self.sim.FromListConnector(
+                    input_connections, ['weight', 'delay'])),
+            self.sim.Projection(
+                relay, relay, self.sim.FromListConnector(
+                    lateral_connections, ['weight', 'delay']),
+                receptor_type='inhibitory',
+                label='{0}→{0}_lateral'.format(relay.label)),
+            self.sim.Projection(
+                relay, self.layers[-1], self.sim.FromListConnector(
+                    output_connections, ['weight', 'delay']))]
+
+    def _is_gated(self, layer):
+        """Whether to approximate max pooling by a winner-take-all circuit."""
+
+        return self._maxpool_gating and get_type(layer) == 'MaxPooling2D'
+
+    def connect(self, connections):
+        """Project the previous layer onto the current one.
+
+        Parameters
+        ----------
+
+        connections: Union[ndarray, Iterator[ndarray]]
+            Array of shape (``num_connections``, 4), where each row contains
+            the source neuron index, the target neuron index, the connection
+            strength (weight), and the synaptic ``delay``. If an iterator
+            over consecutive blocks of such rows is given, each block becomes
+            a separate projection, labeled with its position, so that only one
+            block has to be held in memory at a time. When saving the model as
+            text, the blocks are merged again (see `save_connections`).
+        """
+
+        if isinstance(connections, np.ndarray):
+            self.connections.append(self.sim.Projection(
+                self.layers[-2], self.layers[-1],
+                self.sim.FromListConnector(connections, ['weight', 'delay'])))
+            return
+
+        for k, chunk in enumerate(connections):
+            self.connections.append(self.sim.Projection(
+                self.layers[-2], self.layers[-1],
+                self.sim.FromListConnector(chunk, ['weight', 'delay']),
+                label='{}→{}_{}'.format(self.layers[-2].label,
+                                        self.layers[-1].label, k)))
+
     def compile(self):
 
         pass
@@ -243,12 +340,32 @@ class SNN(AbstractSNN):
     def load(self, path, filename):
 
         self.layers = self.load_assembly(path, filename)
+        if self._binary_export and self.is_manifest_valid(path):
+            self.load_connections(path)
+            return
+        relays = {relay.label: relay for relay in self.relays}
         for i in range(len(self.layers) - 1):
+            pre = self.layers[i]
+            relay = relays.get(self.layers[i + 1].label + '_relay')
+            if relay is not None:
+                # Winner-take-all circuit of a max pooling layer.
+                filepath = os.path.join(path, relay.label)
+                self.connections += [
+                    self.sim.Projection(pre, relay,
+                                        self.sim.FromFileConnector(filepath)),
+                    self.sim.Projection(
+                        relay, relay,
+                        self.sim.FromFileConnector(filepath + '_lateral'),
+                        receptor_type='inhibitory')]
+                relay.set(**self.cellparams)
+                relay.initialize(v=relay.get('v_rest'))
+                pre = relay
             filepath = os.path.join(path, self.layers[i + 1].label)
             assert os.path.isfile(filepath), \
                 "Connections were not found at specified location."
-            self.sim.Projection(self.layers[i], self.layers[i + 1],
-                                self.sim.FromFileConnector(filepath))
+            self.connections.append(self.sim.Projection(
+                pre, self.layers[i + 1],
+                self.sim.FromFileConnector(filepath)))
             self.layers[i + 1].set(**self.cellparams)
             self.layers[i + 1].initialize(v=self.layers[i + 1].get('v_rest'))
             # Biases should be already be loaded from the assembly file.
@@ -330,7 +447,7 @@ class SNN(AbstractSNN):
             kwargs[str('monitor_index')] + 1
         spiketrains_flat = self.layers[i].get_data().segments[-1].spiketrains
         spiketrains_b_l_t = self.reshape_flattened_spiketrains(
-            spiketrains_flat, shape)
+            spiketrains_flat, shape, sparse=self._sparse_spiketrains)
         return spiketrains_b_l_t
 
     def get_spiketrains_input(self):
@@ -384,7 +501,7 @@ class SNN(AbstractSNN):
         s = {}
         labels = []
         variables = ['size', 'structure', 'label']
-        for population in self.layers:
+        for population in self.layers + self.relays:
             labels.append(population.label)
             data = {}
             for variable in variables:
@@ -395,7 +512,9 @@ class SNN(AbstractSNN):
             if population.label != 'InputLayer':
                 data['i_offset'] = population.get('i_offset')
             s[population.label] = data
-        s['labels'] = labels  # List of population labels describing the net.
+        # List of population labels describing the net.
+        s['labels'] = labels[:len(self.layers)]
+        s['relays'] = labels[len(self.layers):]
         s['variables'] = variables  # List of variable names.
         s['size'] = len(self.layers)  # Number of populations in assembly.
         cPickle.dump(s, open(filepath, 'wb'), -1)
@@ -420,17 +539,139 @@ class SNN(AbstractSNN):
 
             Text files containing the layer connections. Each file is named
             after the layer it connects to, e.g. ``layer2.txt`` if connecting
-            layer1 to layer2.
+            layer1 to layer2. If ``binary_export`` is set, the connections are
+            written to ``.npy`` files instead (see `write_connections`).
         """
 
         print("Saving connections...")
 
+        if self._binary_export:
+            reset_connection_manifest(path)
+            for projection in self.connections:
+                label = projection.label.partition('→')[-1]
+                if self.config.getboolean('output', 'overwrite') or \
+                        confirm_overwrite(os.path.join(path, label + '.npy')):
+                    self.write_connections(
+                        path, label,
+                        projection.get(['weight', 'delay'], 'list'),
+                        projection.pre.label, projection.post.label,
+                        projection.receptor_type)
+            return
+
         # Iterate over layers to save each projection in a separate txt file.
+        # A layer that was connected in chunks (see `connect`) has several
+        # projections, which are appended to the same file. Projections of a
+        # population onto itself (see `build_max_pooling`) get their own file.
+        projections = OrderedDict()
         for projection in self.connections:
-            filepath = os.path.join(path, projection.label.partition('→')[-1])
-            if self.config.getboolean('output', 'overwrite') or \
-                    confirm_overwrite(filepath):
-                projection.save('connections', filepath)
+            label = projection.post.label
+            if projection.pre is projection.post:
+                label += '_lateral'
+            projections.setdefault(label, []).append(projection)
+        for label, chunks in projections.items():
+            filepath = os.path.join(path, label)
+            if not (self.config.getboolean('output', 'overwrite') or
+                    confirm_overwrite(filepath)):
+                continue
+            if len(chunks) == 1:
+                chunks[0].save('connections', filepath)
+                continue
+            with open(filepath, 'w') as f:
+                for k, projection in enumerate(chunks):
+                    # noinspection PyTypeChecker
+                    np.savetxt(f, np.reshape(
+                        projection.get(['weight', 'delay'], 'list'), (-1, 4)),
+                        ['%d', '%d', '%.18f', '%.3f'],
+                        header="columns = ['i', 'j', 'weight', 'delay']"
+                        if k == 0 else '')
+
+    def write_connections(self, path, label, connections, pre, post,
+                          receptor_type='excitatory'):
+        """Write the connections of a projection to disk.
+
+        If ``binary_export`` is set, the connections are stored as structured
+        array in ``<label>.npy`` and registered in a manifest, from which
+        `load_connections` restores the projections. Otherwise, they are
+        written to a text file ``<label>``.
+
+        Parameters
+        ----------
+
+        path: str
+            Path to directory where connections are saved.
+        label: str
+            Label of the projection.
+        connections: Union[ndarray, list[tuple]]
+            Array of shape (``num_connections``, 4), or list of tuples,
+            containing the source neuron index, the target neuron index, the
+            connection strength (weight), and the synaptic delay.
+        pre: str
+            Label of the pre-synaptic layer.
+        post: str
+            Label of the post-synaptic layer.
+        receptor_type: str
+            Receptor type of the projection.
+        """
+
+        filepath = os.path.join(path, label)
+        if self._binary_export:
+            write_connections_npy(filepath + '.npy', connections)
+            update_connection_manifest(path, label, filename=label + '.npy',
+                                       pre=pre, post=post,
+                                       receptor_type=receptor_type)
+        else:
+            # noinspection PyTypeChecker
+            np.savetxt(filepath, np.reshape(connections, (-1, 4)),
+                       ['%d', '%d', '%.18f', '%.3f'],
+                       header="columns = ['i', 'j', 'weight', 'delay']")
+
+    def is_manifest_valid(self, path):
+        """Check that a connection manifest belongs to the loaded assembly.
+
+        Parameters
+        ----------
+
+        path: str
+            Path to directory where connections were saved with
+            `write_connections` in binary format.
+
+        Returns
+        -------
+
+        : bool
+            ``True`` if the manifest in ``path`` connects only layers of the
+            assembly, and every layer except the input receives a projection.
+        """
+
+        manifest = read_connection_manifest(path)
+        labels = {layer.label for layer in self.layers + self.relays}
+        pre = {entry['pre'] for entry in manifest.values()}
+        post = {entry['post'] for entry in manifest.values()}
+        return bool(manifest) and pre | post <= labels and \
+            post == labels - {self.layers[0].label}
+
+    def load_connections(self, path):
+        """Restore the projections registered in a connection manifest.
+
+        Parameters
+        ----------
+
+        path: str
+            Path to directory where connections were saved with
+            `write_connections` in binary format.
+        """
+
+        layers = {layer.label: layer for layer in self.layers + self.relays}
+        for label, entry in read_connection_manifest(path).items():
+            connections = read_connections_npy(os.path.join(path,
+                                                            entry['filename']))
+            self.connections.append(self.sim.Projection(
+                layers[entry['pre']], layers[entry['post']],
+                self.sim.FromListConnector(connections, ['weight', 'delay']),
+                receptor_type=entry['receptor_type'], label=label))
+        for layer in self.layers[1:] + self.relays:
+            layer.set(**self.cellparams)
+            layer.initialize(v=layer.get('v_rest'))
 
     def save_biases(self, path):
         """Write biases of a neural network to disk.
@@ -456,7 +697,10 @@ class SNN(AbstractSNN):
                     continue
                 if np.isscalar(biases):
                     continue
-                np.savetxt(filepath, biases)
+                if self._binary_export:
+                    np.save(filepath + '.npy', biases)
+                else:
+                    np.savetxt(filepath, biases)
 
     def load_assembly(self, path, filename):
         """Load the populations in an assembly.
@@ -494,7 +738,7 @@ class SNN(AbstractSNN):
 
         # Iterate over populations in assembly
         layers = []
-        for label in s['labels']:
+        for label in s['labels'] + s.get('relays', []):
             celltype = getattr(self.sim, s[label]['celltype'])
             population = self.sim.Population(s[label]['size'], celltype,
                                              celltype.default_parameters,
@@ -508,7 +752,10 @@ class SNN(AbstractSNN):
                 population.set(i_offset=s[label]['i_offset'])
             layers.append(population)
 
-        return layers
+        # The relays of winner-take-all circuits are kept apart from layers.
+        self.relays = layers[len(s['labels']):]
+
+        return layers[:len(s['labels'])]
 
     def set_spiketrain_stats_input(self):
         AbstractSNN.set_spiketrain_stats_input(self)
@@ -21,7 +21,8 @@ from snntoolbox.simulation.target_simulators.pyNN_target_sim import \
 from snntoolbox.simulation.target_simulators.pyNN_target_sim import \
     get_shape_from_label
 from snntoolbox.simulation.utils import build_convolution, \
-    build_depthwise_convolution, build_1d_convolution, build_pooling
+    build_depthwise_convolution, build_1d_convolution, build_pooling, \
+    get_dense_connections, get_flatten_permutation, reset_connection_manifest
 from snntoolbox.utils.utils import confirm_overwrite
 
 
@@ -50,6 +51,12 @@ class SNN(PYSNN):
     def setup_layers(self, batch_shape):
         '''Iterates over all layers to instantiate them in the simulator.'''
 
+        # Without simulation, the connections are exported to ``path_wd``
+        # while building (see `build_dense`).
+        if self._binary_export and \
+                not self.config.getboolean('tools', 'simulate'):
+            reset_connection_manifest(self.config.get('paths', 'path_wd'))
+
         self.add_input_layer(batch_shape)
 
         for layer in self.parsed_model.layers[1:]:
@@ -132,6 +139,7 @@ class SNN(PYSNN):
 
         self.set_biases(np.array(biases, 'float64'))
         delay = self.config.getfloat('cell', 'delay')
+        source_idxs = None
         if len(self.flatten_shapes) == 1:
             flatten_name, shape = self.flatten_shapes.pop()
             y_in = 1
@@ -164,32 +172,18 @@ class SNN(PYSNN):
                 else:
                     print(
                         "The input weight matrix did not have the expected dimesnions")
-            exc_connections = []
-            inh_connections = []
-            for i in range(weights.shape[0]):  # Input neurons
-                # Sweep across channel axis of feature map. Assumes that each
-                # consecutive input neuron lies in a different channel. This is
-                # the case for channels_last, but not for channels_first.
-                f = i % f_in
-                # Sweep across height of feature map. Increase y by one if all
-                # rows along the channel axis were seen.
-                y = i // (f_in * x_in)
-                # Sweep across width of feature map.
-                x = (i // f_in) % x_in
-                new_i = f * x_in * y_in + x_in * y + x
-                for j in range(weights.shape[1]):  # Output neurons
-                    c = (new_i, j, weights[i, j], delay)
-                    if c[2] > 0.0:
-                        exc_connections.append(c)
-                    elif c[2] < 0.0:
-                        inh_connections.append(c)
+            # Sweep across the input neurons, assuming that each consecutive
+            # input neuron lies in a different channel. This is the case for
+            # channels_last, but not for channels_first.
+            source_idxs = get_flatten_permutation((y_in, x_in, f_in),
+                                                  'channels_last')
         elif len(self.flatten_shapes) > 1:
             raise RuntimeWarning("Not all Flatten layers have been consumed.")
-        else:
-            exc_connections = [(i, j, weights[i, j], delay)
-                               for i, j in zip(*np.nonzero(weights > 0))]
-            inh_connections = [(i, j, weights[i, j], delay)
-                               for i, j in zip(*np.nonzero(weights < 0))]
+
+        # Only the nonzero (e.g. unmasked) weights become synapses.
+        exc_connections, inh_connections = get_dense_connections(
+            weights, delay, source_idxs, split_sign=True)
+        self.report_synapses_per_core(exc_connections, inh_connections)
 
         if self.config.getboolean('tools', 'simulate'):
             self.connections.append(self.sim.Projection(
@@ -208,16 +202,14 @@ class SNN(PYSNN):
         else:
             # The spinnaker implementation of Projection.save() is not working
             # yet, so we do save the connections manually here.
-            filepath = os.path.join(self.config.get('paths', 'path_wd'),
-                                    self.layers[-1].label)
-            # noinspection PyTypeChecker
-            np.savetxt(filepath + '_excitatory', np.array(exc_connections),
-                       ['%d', '%d', '%.18f', '%.3f'],
-                       header="columns = ['i', 'j', 'weight', 'delay']")
-            # noinspection PyTypeChecker
-            np.savetxt(filepath + '_inhibitory', np.array(inh_connections),
-                       ['%d', '%d', '%.18f', '%.3f'],
-                       header="columns = ['i', 'j', 'weight', 'delay']")
+            path = self.config.get('paths', 'path_wd')
+            label = self.layers[-1].label
+            self.write_connections(path, label + '_excitatory',
+                                   exc_connections, self.layers[-2].label,
+                                   label, 'excitatory')
+            self.write_connections(path, label + '_inhibitory',
+                                   inh_connections, self.layers[-2].label,
+                                   label, 'inhibitory')
 
     def build_convolution(self, layer):
 
@@ -237,24 +229,30 @@ class SNN(PYSNN):
         transpose_kernel = \
             self.config.get('simulation', 'keras_backend') == 'tensorflow'
 
+        # Excitatory and inhibitory connections are built directly from the
+        # nonzero weights, so that memory scales with the number of synapses
+        # of masked (Sparse) layers.
         if get_type(layer) in ['Conv2D', 'SparseConv2D']:
-            weights, biases = build_convolution(layer, delay, transpose_kernel)
+            connections, biases = build_convolution(
+                layer, delay, transpose_kernel, self._connectivity_cache,
+                split_sign=True)
         elif get_type(layer) in ['DepthwiseConv2D', 'SparseDepthwiseConv2D']:
-            weights, biases = build_depthwise_convolution(
-                layer, delay, transpose_kernel)
+            connections, biases = build_depthwise_convolution(
+                layer, delay, transpose_kernel, self._connectivity_cache,
+                split_sign=True)
         elif get_type(layer) == 'Conv1D':
-            weights, biases = build_1d_convolution(layer, delay)
+            connections, biases = build_1d_convolution(
+                layer, delay, self._connectivity_cache, split_sign=True)
         else:
-            ValueError("Layer {} of type {} unrecognised here. "
-                       "How did you get into this function?".format(
-                           layer.name, get_type(layer)
-                       ))
+            raise ValueError("Layer {} of type {} unrecognised here. "
+                             "How did you get into this function?".format(
+                                 layer.name, get_type(layer)))
 
         self.set_biases(biases)
-        weights = self.scale_weights(weights)
-
-        exc_connections = [c for c in weights if c[2] > 0]
-        inh_connections = [c for c in weights if c[2] < 0]
+        exc_connections, inh_connections = connections
+        exc_connections[:, 2] = self.scale_weights(exc_connections[:, 2])
+        inh_connections[:, 2] = self.scale_weights(inh_connections[:, 2])
+        self.report_synapses_per_core(exc_connections, inh_connections)
 
         if self.config.getboolean('tools', 'simulate'):
             self.connections.append(self.sim.Projection(
@@ -271,23 +269,44 @@ class SNN(PYSNN):
         else:
             # The spinnaker implementation of Projection.save() is not working
             # yet, so we do save the connections manually here.
-            filepath = os.path.join(self.config.get('paths', 'path_wd'),
-                                    self.layers[-1].label)
-            # noinspection PyTypeChecker
-            np.savetxt(filepath + '_excitatory', np.array(exc_connections),
-                       ['%d', '%d', '%.18f', '%.3f'],
-                       header="columns = ['i', 'j', 'weight', 'delay']")
-            # noinspection PyTypeChecker
-            np.savetxt(filepath + '_inhibitory', np.array(inh_connections),
-                       ['%d', '%d', '%.18f', '%.3f'],
-                       header="columns = ['i', 'j', 'weight', 'delay']")
+            path = self.config.get('paths', 'path_wd')
+            label = self.layers[-1].label
+            self.write_connections(path, label + '_excitatory',
+                                   exc_connections, self.layers[-2].label,
+                                   label, 'excitatory')
+            self.write_connections(path, label + '_inhibitory',
+                                   inh_connections, self.layers[-2].label,
+                                   label, 'inhibitory')
+
+    def get_prefetch_layers(self):
+
+        # Mirrors the handling of ZeroPadding layers in `setup_layers`.
+        layers, paddings = [], []
+        change_padding = False
+        for layer in self.parsed_model.layers[1:]:
+            layer_type = get_type(layer)
+            if layer_type == 'ZeroPadding':
+                change_padding = True
+                continue
+            padding = None
+            if change_padding and layer_type in {
+                    'Conv1D', 'Conv2D', 'DepthwiseConv2D', 'SparseConv2D',
+                    'SparseDepthwiseConv2D'}:
+                change_padding = False
+                padding = 'ZeroPadding'
+            layers.append(layer)
+            paddings.append(padding)
+
+        return layers, paddings
 
     def build_pooling(self, layer):
 
         delay = self.config.getfloat('cell', 'delay')
 
-        weights = build_pooling(layer, delay)
-        weights = self.scale_weights(weights)
+        weights = build_pooling(layer, delay,
+                                cache_dir=self._connectivity_cache)
+        weights[:, 2] = self.scale_weights(weights[:, 2])
+        self.report_synapses_per_core(weights)
         if self.config.getboolean('tools', 'simulate'):
             self.connections.append(self.sim.Projection(
                 self.layers[-2], self.layers[-1],
@@ -298,12 +317,36 @@ class SNN(PYSNN):
         else:
             # The spinnaker implementation of Projection.save() is not working
             # yet, so we do save the connections manually here.
-            filepath = os.path.join(self.config.get('paths', 'path_wd'),
-                                    self.layers[-1].label)
-            # noinspection PyTypeChecker
-            np.savetxt(filepath, np.array(connections),
-                       ['%d', '%d', '%.18f', '%.3f'],
-                       header="columns = ['i', 'j', 'weight', 'delay']")
+            self.write_connections(self.config.get('paths', 'path_wd'),
+                                   self.layers[-1].label, weights,
+                                   self.layers[-2].label,
+                                   self.layers[-1].label)
+
+    def report_synapses_per_core(self, *connections):
+        """Print the number of synapses targeting each core.
+
+        The neurons of the current layer are distributed over cores in chunks
+        of ``number_of_neurons_per_core``. Each core has to hold the synapses
+        targeting its neurons, so the maximum count indicates whether a layer
+        will fit before running the simulation.
+
+        Parameters
+        ----------
+
+        connections: ndarray
+            Connection arrays of the projections into the current layer.
+        """
+
+        neurons_per_core = self.config.getint('spinnaker',
+                                              'number_of_neurons_per_core')
+        num_cores = int(np.ceil(self.layers[-1].size / neurons_per_core))
+        targets = np.concatenate([c[:, 1] for c in connections])
+        synapses_per_core = np.bincount(
+            targets.astype('int64') // neurons_per_core, minlength=num_cores)
+        print("Synapses per core in layer {}: {} (max), {:.0f} (mean) on {} "
+              "cores with {} neurons each.".format(
+                  self.layers[-1].label, np.max(synapses_per_core),
+                  np.mean(synapses_per_core), num_cores, neurons_per_core))
 
     def save(self, path, filename):
 
@@ -330,16 +373,30 @@ class SNN(PYSNN):
 
             Text files containing the layer connections. Each file is named
             after the layer it connects to, e.g. ``layer2.txt`` if connecting
-            layer1 to layer2.
+            layer1 to layer2. If ``binary_export`` is set, the connections are
+            written to ``.npy`` files instead (see `write_connections`).
         """
 
         print("Saving connections...")
 
+        if self._binary_export:
+            reset_connection_manifest(path)
+
         # Iterate over layers to save each projection in a separate txt file.
         for projection in self.connections:
-            filepath = os.path.join(path, projection._projection_edge.label)
-            if self.config.getboolean('output', 'overwrite') or \
-                    confirm_overwrite(filepath):
+            label = projection._projection_edge.label
+            filepath = os.path.join(path, label)
+            if self._binary_export:
+                filepath += '.npy'
+            if not (self.config.getboolean('output', 'overwrite') or
+                    confirm_overwrite(filepath)):
+                continue
+            if self._binary_export:
+                self.write_connections(
+                    path, label, projection.get(['weight', 'delay'], 'list'),
+                    projection.pre.label, projection.post.label,
+                    projection.receptor_type)
+            else:
                 projection.save('connections', filepath)
 
     def simulate(self, **kwargs):
@@ -419,7 +476,7 @@ class SNN(PYSNN):
         spiketrains_flat = self.layers[i].get_data(
             'spikes').segments[-1].spiketrains
         spiketrains_b_l_t = self.reshape_flattened_spiketrains(
-            spiketrains_flat, shape)
+            spiketrains_flat, shape, sparse=self._sparse_spiketrains)
         return spiketrains_b_l_t
 
     def get_vmem(self, **kwargs):
@@ -10,8 +10,13 @@ another simulator is added to the toolbox (see :ref:`extending`).
 """
 import warnings
 
+import hashlib
+import itertools
+import json
 import os
+import shutil
 import sys
+import tempfile
 from abc import abstractmethod
 import numpy as np
 from tensorflow import keras
@@ -40,6 +45,7 @@ class AbstractSNN:
 
         build
         run
+        simulate_stream
         get_recorded_vars
 
     Relevant methods that in most cases will have to be overwritten include:
@@ -86,7 +92,9 @@ class AbstractSNN:
         times of the specific neuron, and the first indices run over the number
         of neurons in the layer: (batch_size, n_chnls, n_rows, n_cols,
         duration). ``label`` is a string specifying both the layer type and the
-        index, e.g. ``'03Conv2D_32x64x64'``.
+        index, e.g. ``'03Conv2D_32x64x64'``. If ``sparse_spiketrains`` is
+        set in the ``[output]`` section of the config, ``spiketimes`` is a
+        `SpikeEvents` object holding only the spike events.
     activations_n_b_l: list[tuple[np.array, str]]
         Activations of the ANN.
     mem_n_b_l_t: list[tuple[np.array, str]]
@@ -99,6 +107,11 @@ class AbstractSNN:
     top5err_b_t: ndarray
         Top-5 error of SNN over time. Shape:
         (`batch_size`, ``_num_timesteps``).
+    latency_b: ndarray
+        Simulation time at which the SNN reached a confident decision for each
+        sample (see ``early_exit_margin``). Samples that were not decided
+        before the end of the simulation are assigned the full duration.
+        Shape: (`batch_size`,).
     synaptic_operations_b_t: ndarray
         Number of synaptic operations of SNN over time. Shape:
         (`batch_size`, ``_num_timesteps``)
@@ -150,7 +163,7 @@ class AbstractSNN:
         self.spiketrains_n_b_l_t = self.activations_n_b_l = None
         self.spikerates_n_b_l = None
         self.input_b_l_t = self.mem_n_b_l_t = None
-        self.top1err_b_t = self.top5err_b_t = None
+        self.top1err_b_t = self.top5err_b_t = self.latency_b = None
         self.synaptic_operations_b_t = self.operations_ann = None
         self.neuron_operations_b_t = None
         self.top1err_ann = self.top5err_ann = None
@@ -175,6 +188,16 @@ class AbstractSNN:
         self._num_poisson_events_per_sample = \
             self.config.getint('input', 'num_poisson_events_per_sample')
         self._input_spikecount = 0
+        self._sparse_spiketrains = self.config.getboolean(
+            'output', 'sparse_spiketrains')
+        self._connectivity_cache = None
+        if self.config.getboolean('simulation', 'cache_connectivity'):
+            self._connectivity_cache = os.path.join(
+                self.config.get('paths', 'path_wd'), 'connectivity_cache')
+        self._num_build_workers = self.config.getint('simulation',
+                                                     'num_build_workers')
+        self._connection_chunk_size = get_connection_chunk_size(
+            self.config.getfloat('simulation', 'max_connection_memory'))
 
         self._plot_keys = get_plot_keys(self.config)
         self._log_keys = get_log_keys(self.config)
@@ -276,6 +299,26 @@ class AbstractSNN:
 
         pass
 
+    def get_prefetch_layers(self):
+        """Get the layers whose connectivity can be generated in advance.
+
+        Used by `build` to generate the connectivity of several layers in
+        parallel (see ``num_build_workers``). Only simulators that build their
+        layers from the connectivity cache (see `get_cached_connectivity`)
+        need to overwrite this method.
+
+        Returns
+        -------
+
+        layers: list[keras.layers.Layer]
+            Parsed model layers.
+        paddings: list[Optional[str]]
+            The padding that each layer is built with, if it differs from the
+            ``padding`` attribute of the layer (see `get_connectivity_args`).
+        """
+
+        return [], []
+
     @abstractmethod
     def compile(self):
         """Compile the spiking network."""
@@ -300,6 +343,54 @@ class AbstractSNN:
 
         pass
 
+    def simulate_stream(self, samples, **kwargs):
+        """Simulate the next batch of samples drawn from a stream.
+
+        Takes the next `batch_size` samples from ``samples`` and passes them
+        on to `simulate`. If the stream runs out before the batch is full, the
+        batch is padded with zeros, so that the last samples of the test set
+        are simulated as well. Simulators that are able to reset individual
+        samples of a batch can override this method to refill a slot as soon
+        as its sample is finished.
+
+        Parameters
+        ----------
+
+        samples: Iterator
+            Yields tuples ``(x, y)`` of an input sample and its label.
+        kwargs: dict
+            Keyword arguments passed on to `simulate`.
+
+        Returns
+        -------
+
+        batch: Optional[tuple]
+            ``None`` if the stream is exhausted. Otherwise a tuple
+            ``(x_b_l, y_b_l, output_b_l_t, num_samples)``, where the input
+            samples ``x_b_l``, their labels ``y_b_l`` and the output
+            ``output_b_l_t`` of `simulate` have `batch_size` entries, of which
+            the first ``num_samples`` are valid.
+        """
+
+        batch = list(itertools.islice(samples, self.batch_size))
+        num_samples = len(batch)
+        if num_samples == 0:
+            return None
+
+        x_b_l, y_b_l = [np.stack(a) for a in zip(*batch)]
+        if num_samples < self.batch_size:
+            pad = self.batch_size - num_samples
+            x_b_l = np.concatenate([x_b_l, np.zeros((pad,) + x_b_l.shape[1:],
+                                                    x_b_l.dtype)])
+            y_b_l = np.concatenate([y_b_l, np.zeros((pad,) + y_b_l.shape[1:],
+                                                    y_b_l.dtype)])
+
+        kwargs[str('truth_b')] = np.argmax(y_b_l, axis=1)
+        kwargs[str('x_b_l')] = x_b_l
+        output_b_l_t = self.simulate(**kwargs)
+
+        return x_b_l, y_b_l, output_b_l_t, num_samples
+
     @abstractmethod
     def reset(self, sample_idx):
         """Reset network variables.
@@ -435,8 +526,26 @@ class AbstractSNN:
 
         self.preprocessing(**kwargs)
 
+        # Generate the connectivity of all layers in parallel. It is handed
+        # over to the sequential build via the connectivity cache, which is
+        # temporary unless ``cache_connectivity`` is set.
+        tmp_cache_dir = None
+        layers, paddings = self.get_prefetch_layers()
+        if self._num_build_workers and layers:
+            if self._connectivity_cache is None:
+                self._connectivity_cache = tmp_cache_dir = tempfile.mkdtemp()
+            prefetch_connectivity(
+                layers, self._connectivity_cache,
+                self._num_build_workers if self._num_build_workers > 0
+                else None, paddings)
+
         # Iterate over layers to create spiking neurons and connections.
-        self.setup_layers(batch_shape)
+        try:
+            self.setup_layers(batch_shape)
+        finally:
+            if tmp_cache_dir is not None:
+                shutil.rmtree(tmp_cache_dir)
+                self._connectivity_cache = None
 
         print("Compiling spiking model...\n")
         self.compile()
@@ -514,11 +623,13 @@ class AbstractSNN:
                                                self.config)
 
         # Divide the test set into batches and run all samples in a batch in
-        # parallel.
-        num_batches = \
-            self.config.getint('simulation', 'num_to_test') // self.batch_size
+        # parallel. The last batch may be partially filled.
+        num_to_test = self.config.getint('simulation', 'num_to_test')
+        num_batches = int(np.ceil(num_to_test / self.batch_size))
+        samples = get_sample_stream(x_test, y_test, dataflow, num_to_test)
 
         # Initialize intermediate variables for computing statistics.
+        num_samples_seen = 0
         top5score_moving = 0
         score1_ann = 0
         score5_ann = 0
@@ -570,18 +681,9 @@ class AbstractSNN:
         # Simulate the SNN on a batch of samples in parallel.
         for batch_idx in range(num_batches):
 
-            # Get a batch of samples
-            x_b_l = None
-            y_b_l = None
-            if x_test is not None:
-                batch_idxs = range(self.batch_size * batch_idx,
-                                   self.batch_size * (batch_idx + 1))
-                x_b_l = x_test[batch_idxs, :]
-                if y_test is not None:
-                    y_b_l = y_test[batch_idxs, :]
-            elif dataflow is not None:
-                x_b_l, y_b_l = dataflow.next()
-            elif self._is_aedat_input:
+            # Get a batch of samples and run the network on it for the
+            # duration of the simulation.
+            if self._is_aedat_input:
                 try:
                     data_batch_kwargs['dvs_gen'].next_sequence_batch()
                     y_b_l = data_batch_kwargs['dvs_gen'].y_b
@@ -591,20 +693,23 @@ class AbstractSNN:
                 # Generate frames so we can compare with ANN.
                 x_b_l = data_batch_kwargs['dvs_gen'].get_frame_batch()
 
-            # Effective batch size could be smaller than user-specified
-            # self.batch_size if dataset size not an integer multiple.
-            if len(x_b_l) < self.batch_size:
-                continue
+                data_batch_kwargs['truth_b'] = np.argmax(y_b_l, axis=1)
+                data_batch_kwargs['x_b_l'] = x_b_l
 
-            truth_b = np.argmax(y_b_l, axis=1)
-
-            data_batch_kwargs['truth_b'] = truth_b
-            data_batch_kwargs['x_b_l'] = x_b_l
+                print("\nStarting new simulation...\n")
+                output_b_l_t = self.simulate(**data_batch_kwargs)
+                num_samples = self.batch_size
+            else:
+                print("\nStarting new simulation...\n")
+                batch = self.simulate_stream(samples, **data_batch_kwargs)
+                if batch is None:
+                    break
+                x_b_l, y_b_l, output_b_l_t, num_samples = batch
 
-            # Main step: Run the network on a batch of samples for the duration
-            # of the simulation.
-            print("\nStarting new simulation...\n")
-            output_b_l_t = self.simulate(**data_batch_kwargs)
+            # Only the first `num_samples` samples of a batch are valid; the
+            # rest is padding of the last batch.
+            truth_b = np.argmax(y_b_l[:num_samples], axis=1)
+            output_b_l_t = output_b_l_t[:num_samples]
 
             # Halt if model is to be serialised only.
             if self.config.getboolean('tools', 'serialise_only'):
@@ -623,6 +728,7 @@ class AbstractSNN:
             # Get classification error of current batch, for each time step.
             self.top1err_b_t = guesses_b_t != np.broadcast_to(
                 np.expand_dims(truth_b, -1), guesses_b_t.shape)
+            self.top5err_b_t = np.empty_like(self.top1err_b_t)
             for t in range(self._num_timesteps):
                 self.top5err_b_t[:, t] = np.logical_not(
                     in_top_k(output_b_l_t[:, :, t], truth_b, self.top_k))
@@ -632,7 +738,7 @@ class AbstractSNN:
             guesses_d += list(guesses_b_t[:, -1])
 
             # Print current accuracy.
-            num_samples_seen = (batch_idx + 1) * self.batch_size
+            num_samples_seen += num_samples
             top1acc_moving = np.mean(np.array(truth_d) == np.array(guesses_d))
             top5score_moving += sum(in_top_k(output_b_l_t[:, :, -1], truth_b,
                                              self.top_k))
@@ -643,10 +749,13 @@ class AbstractSNN:
                   "".format(self.top_k, top1acc_moving, top5acc_moving))
 
             # Evaluate ANN on the same batch as SNN for a direct comparison.
-            score = self.parsed_model.evaluate(
-                x_b_l, y_b_l, self.parsed_model.input_shape[0], verbose=0)
-            score1_ann += score[1] * self.batch_size
-            score5_ann += score[2] * self.batch_size
+            # The parsed model has a fixed batch size, so the padding of the
+            # last batch is run as well, but not counted.
+            output_ann_b_l = \
+                self.parsed_model.predict_on_batch(x_b_l)[:num_samples]
+            score1_ann += np.sum(np.argmax(output_ann_b_l, 1) == truth_b)
+            score5_ann += np.sum(in_top_k(output_ann_b_l, truth_b,
+                                          self.top_k))
             self.top1err_ann = 1 - score1_ann / num_samples_seen
             self.top5err_ann = 1 - score5_ann / num_samples_seen
             print("Moving accuracy of ANN (top-1, top-{}): {:.2%}, {:.2%}."
@@ -711,12 +820,15 @@ class AbstractSNN:
             log_vars['top1err_ann'] = self.top1err_ann
             log_vars['top5err_ann'] = self.top5err_ann
             log_vars['operations_ann'] = self.operations_ann / 1e6
-            log_vars['input_image_b_l'] = x_b_l
+            log_vars['input_image_b_l'] = x_b_l[:num_samples]
             log_vars['true_classes_b'] = truth_b
             if self.spiketrains_n_b_l_t is not None:
                 log_vars['avg_rate'] = self.get_avg_rate_from_trains()
                 print("Average spike rate: {} spikes per simulation time step."
                       "".format(log_vars['avg_rate']))
+            if self.latency_b is not None:
+                print("Average decision latency: {} ms.".format(
+                    np.mean(self.latency_b[:num_samples])))
             np.savez_compressed(os.path.join(path_log_vars, str(batch_idx)),
                                 **log_vars)
 
@@ -843,8 +955,9 @@ class AbstractSNN:
                 if not is_spiking(layer, self.config):
                     continue
                 shape = list(layer.output_shape) + [self._num_timesteps]
-                self.spiketrains_n_b_l_t.append((np.zeros(shape, 'float32'),
-                                                 layer.name))
+                self.spiketrains_n_b_l_t.append((
+                    self.init_recording_array(shape, self._sparse_spiketrains),
+                    layer.name))
 
         if self.config.get('conversion', 'spike_code') == 'temporal_pattern':
             self.spikerates_n_b_l = []
@@ -862,13 +975,16 @@ class AbstractSNN:
             self.neuron_operations_b_t = np.zeros((self.batch_size,
                                                    self._num_timesteps))
 
+        if 'latency_b' in self._log_keys:
+            self.latency_b = np.full(self.batch_size, float(self._duration))
+
         if 'mem_n_b_l_t' in self._log_keys or 'v_mem' in self._plot_keys:
             self.mem_n_b_l_t = []
             for layer in self.parsed_model.layers:
                 if not is_spiking(layer, self.config):
                     continue
                 shape = list(layer.output_shape) + [self._num_timesteps]
-                self.mem_n_b_l_t.append((np.zeros(shape, 'float32'),
+                self.mem_n_b_l_t.append((self.init_recording_array(shape),
                                          layer.name))
 
         self.top1err_b_t = np.empty((self.batch_size, self._num_timesteps),
@@ -884,9 +1000,12 @@ class AbstractSNN:
 
         if self.spiketrains_n_b_l_t is not None:
             for n in range(len(self.spiketrains_n_b_l_t)):
-                self.spiketrains_n_b_l_t[n] = (
-                    np.zeros_like(self.spiketrains_n_b_l_t[n][0]),
-                    self.spiketrains_n_b_l_t[n][1])
+                spiketrains_b_l_t, label = self.spiketrains_n_b_l_t[n]
+                if spiketrains_b_l_t is not None:
+                    spiketrains_b_l_t = self.init_recording_array(
+                        spiketrains_b_l_t.shape,
+                        isinstance(spiketrains_b_l_t, SpikeEvents))
+                self.spiketrains_n_b_l_t[n] = (spiketrains_b_l_t, label)
 
         if self.synaptic_operations_b_t is not None:
             self.synaptic_operations_b_t = np.zeros_like(
@@ -896,18 +1015,58 @@ class AbstractSNN:
             self.neuron_operations_b_t = np.zeros_like(
                 self.neuron_operations_b_t)
 
+        if self.latency_b is not None:
+            self.latency_b = np.full_like(self.latency_b, self._duration)
+
         if self.mem_n_b_l_t is not None:
             for n in range(len(self.mem_n_b_l_t)):
-                self.mem_n_b_l_t[n] = (np.zeros_like(self.mem_n_b_l_t[n][0]),
-                                       self.mem_n_b_l_t[n][1])
+                mem_b_l_t, label = self.mem_n_b_l_t[n]
+                if mem_b_l_t is not None:
+                    mem_b_l_t = self.init_recording_array(mem_b_l_t.shape)
+                self.mem_n_b_l_t[n] = (mem_b_l_t, label)
+
+    def init_recording_array(self, shape, sparse=False):
+        """Allocate a host array to record a layer variable into.
+
+        Simulators that keep the recordings on the device and read them out
+        after the simulation can return ``None`` here, so that the memory is
+        not allocated twice.
+
+        Parameters
+        ----------
+
+        shape: list[int]
+            Shape of the recorded variable, including the time dimension.
+        sparse: Optional[bool]
+            If ``True``, return empty `SpikeEvents` instead of a dense array.
+
+        Returns
+        -------
+
+        : Optional[Union[ndarray, SpikeEvents]]
+            Array filled with zeros.
+        """
+
+        return SpikeEvents(shape) if sparse else np.zeros(shape, 'float32')
 
     def set_connectivity(self):
         """
         Set connectivity statistics needed to compute the number of operations
         in the network. This includes e.g. the members `fanin`, `fanout`,
         `num_neurons`, `num_neurons_with_bias`.
+
+        The statistics are stored next to the parsed model, and reloaded from
+        there as long as the parsed model and the relevant settings are
+        unchanged (see `get_connectivity_hash`).
         """
 
+        filepath = os.path.join(
+            self.config.get('paths', 'path_wd'),
+            self.config.get('paths', 'filename_parsed_model') +
+            '_connectivity.npz')
+        if self.load_connectivity(filepath):
+            return self.num_neurons, self.num_neurons_with_bias, self.fanin
+
         self.fanin = [0]
         self.fanout = [get_fanout(self.parsed_model.layers[0], self.config)]
         self.num_neurons = [np.product(self.parsed_model.input_shape[1:])]
@@ -935,8 +1094,94 @@ class AbstractSNN:
                 self.num_synapses += np.sum(self.fanout[i])
         self.num_synapses = int(self.num_synapses)
 
+        self.save_connectivity(filepath)
+
         return self.num_neurons, self.num_neurons_with_bias, self.fanin
 
+    def get_connectivity_hash(self):
+        """Compute the key under which the connectivity statistics are stored.
+
+        The key covers the layers and parameters of the parsed model, and the
+        settings that determine which layers are spiking and how they are
+        connected.
+
+        Returns
+        -------
+
+        : str
+            SHA1 hex digest.
+        """
+
+        from snntoolbox.conversion.utils import get_model_hash
+
+        sha1 = hashlib.sha1(get_model_hash(self.parsed_model).encode())
+        sha1.update(repr([(get_type(layer), layer.output_shape)
+                          for layer in self.parsed_model.layers]).encode())
+        sha1.update(repr([
+            self.config.get('restrictions', 'spiking_layers'),
+            sorted(self.config.items('conversion'))]).encode())
+        return sha1.hexdigest()
+
+    def save_connectivity(self, filepath):
+        """Write the connectivity statistics (see `set_connectivity`) to disk.
+
+        Parameters
+        ----------
+
+        filepath: str
+            Path of the ``.npz`` file.
+        """
+
+        if not os.path.isdir(os.path.dirname(filepath)):
+            return
+
+        fanout = {'fanout_{}'.format(i): f for i, f in enumerate(self.fanout)}
+        np.savez(filepath, fanin=self.fanin, num_neurons=self.num_neurons,
+                 num_neurons_with_bias=self.num_neurons_with_bias,
+                 num_synapses=self.num_synapses,
+                 connectivity_hash=self.get_connectivity_hash(), **fanout)
+
+    def load_connectivity(self, filepath):
+        """Load the connectivity statistics (see `set_connectivity`).
+
+        Parameters
+        ----------
+
+        filepath: str
+            Path of the ``.npz`` file written by `save_connectivity`.
+
+        Returns
+        -------
+
+        : bool
+            ``False`` if the file does not exist or was computed for a
+            different model or different settings, in which case the
+            statistics have to be recomputed.
+        """
+
+        if not os.path.isfile(filepath):
+            return False
+
+        with np.load(filepath) as f:
+            if 'connectivity_hash' not in f.files or \
+                    str(f['connectivity_hash']) != \
+                    self.get_connectivity_hash():
+                return False
+            print("Loading connectivity statistics from {}.".format(filepath))
+            self.fanin = f['fanin'].tolist()
+            self.num_neurons = f['num_neurons'].tolist()
+            self.num_neurons_with_bias = f['num_neurons_with_bias'].tolist()
+            self.num_synapses = int(f['num_synapses'])
+            # Fan-out is a scalar, or an array for convolution layers with
+            # stride > 1.
+            self.fanout = []
+            for i in range(len(self.num_neurons)):
+                fanout = f['fanout_{}'.format(i)]
+                self.fanout.append(fanout.item() if fanout.ndim == 0
+                                   else fanout)
+
+        return True
+
     def get_recorded_vars(self, layers):
         """Retrieve neuron variables recorded during simulation.
 
@@ -981,15 +1226,7 @@ class AbstractSNN:
 
         # For each time step, get number of spikes of all neurons in the output
         # layer.
-        shape = (self.batch_size, self.num_classes, self._num_timesteps)
-        output_b_l_t = np.zeros(shape, 'int32')
-        spiketrains_b_l_t = self.get_spiketrains_output()
-        for b in range(shape[0]):
-            for ll in range(shape[1]):
-                for t in range(shape[2]):
-                    output_b_l_t[b, ll, t] = np.count_nonzero(
-                        spiketrains_b_l_t[b, ll, :t + 1])
-        return output_b_l_t
+        return get_cumulative_spikecounts(self.get_spiketrains_output())
 
     def reset_container_counters(self):
         self._mem_container_counter = 0
@@ -1054,7 +1291,7 @@ class AbstractSNN:
         Parameters
         ----------
 
-        spiketrains_b_l_t: ndarray
+        spiketrains_b_l_t: Union[ndarray, SpikeEvents]
             A batch of spikes for a layer over the simulation time.
             Shape: (`batch_size`, ``layer_shape``, ``num_timesteps``)
 
@@ -1062,6 +1299,10 @@ class AbstractSNN:
 
         i = self._spiketrains_container_counter
 
+        if self._sparse_spiketrains and \
+                not isinstance(spiketrains_b_l_t, SpikeEvents):
+            spiketrains_b_l_t = SpikeEvents.from_dense(spiketrains_b_l_t)
+
         # Add spike trains to log variables.
         if self.spiketrains_n_b_l_t is not None:
             self.spiketrains_n_b_l_t[i] = (spiketrains_b_l_t,
@@ -1069,7 +1310,11 @@ class AbstractSNN:
             self._spiketrains_container_counter += 1
 
         # Use spike trains to compute the number of synaptic operations.
-        if self.synaptic_operations_b_t is not None:
+        if self.synaptic_operations_b_t is not None and \
+                isinstance(spiketrains_b_l_t, SpikeEvents):
+            self.synaptic_operations_b_t += \
+                spiketrains_b_l_t.get_spikecounts_b_t(self.fanout[i + 1])
+        elif self.synaptic_operations_b_t is not None:
             for t in range(self._num_timesteps):
                 self.synaptic_operations_b_t[:, t] += \
                     get_layer_synaptic_operations(
@@ -1081,7 +1326,8 @@ class AbstractSNN:
                 self.neuron_operations_b_t[:, t] += \
                     self.num_neurons_with_bias[i + 1]
 
-    def reshape_flattened_spiketrains(self, spiketrains, shape, is_list=True):
+    def reshape_flattened_spiketrains(self, spiketrains, shape, is_list=True,
+                                      sparse=False):
         """
         Convert list of spike times into array where nonzero entries
         (indicating spike times) are properly spread out across array. Then
@@ -1099,33 +1345,51 @@ class AbstractSNN:
             In this case, we distribute the spike times across a numpy array.
             If ``False``, ``spiketrains`` is already a 2D array of shape
             (num_neurons, num_timesteps).
+        sparse: Optional[bool]
+            If ``True``, return the spike trains as `SpikeEvents` instead of a
+            dense array.
 
         Returns
         -------
 
-        spiketrains_b_l_t: ndarray
+        spiketrains_b_l_t: Union[ndarray, SpikeEvents]
             A batch of spikes for a layer over the simulation time.
             Shape: (`batch_size`, ``shape``, ``num_timesteps``)
         """
 
-        if is_list:
-            spiketrains_flat = np.zeros((np.prod(shape[:-1]), shape[-1]))
-            for k, spiketrain in enumerate(spiketrains):
-                for t in spiketrain:
-                    spiketrains_flat[k, int(t / self._dt)] = t
-        else:
-            spiketrains_flat = np.reshape(spiketrains, (-1, shape[-1]))
-
-        # For Conv layers with 'channels_last', need to (1) reshape so that the
-        # channel comes first; (2) move the channel axis to the back again;
-        # (3) flatten the array, so it can be reshaped later according to the
-        # data_format. If this is not done, the spikerates plot is scrambled.
-        if self.data_format == 'channels_last' and len(shape) == 5:
-            spiketrains_flat = np.reshape(np.moveaxis(np.reshape(
-                spiketrains_flat, [shape[i] for i in [0, 3, 1, 2, 4]]), 1, 3),
-                (-1, shape[-1]))
-
-        spiketrains_b_l_t = np.reshape(spiketrains_flat, shape)
+        # For Conv layers with 'channels_last', the simulator enumerates the
+        # neurons with the channel axis first. Need to move the channel axis
+        # to the back, otherwise the spikerates plot is scrambled.
+        is_permuted = self.data_format == 'channels_last' and len(shape) == 5
+
+        if not is_list:
+            if is_permuted:
+                spiketrains = np.reshape(spiketrains, [
+                    shape[i] for i in [0, 3, 1, 2, 4]]).transpose(
+                    (0, 2, 3, 1, 4))
+            spiketrains_b_l_t = np.reshape(spiketrains, shape)
+            return SpikeEvents.from_dense(spiketrains_b_l_t) if sparse \
+                else spiketrains_b_l_t
+
+        # Concatenate the spike times of all neurons and label each spike with
+        # the index of the neuron that emitted it.
+        num_spikes = np.fromiter(map(len, spiketrains), int, len(spiketrains))
+        neuron_idxs = np.repeat(np.arange(len(num_spikes)), num_spikes)
+        spiketimes = np.asarray(np.concatenate(spiketrains), float) \
+            if len(num_spikes) else np.zeros(0)
+        timesteps = (spiketimes / self._dt).astype(int)
+
+        if is_permuted:
+            b, c, h, w = np.unravel_index(
+                neuron_idxs, [shape[i] for i in [0, 3, 1, 2]])
+            neuron_idxs = np.ravel_multi_index((b, h, w, c), shape[:-1])
+
+        if sparse:
+            return SpikeEvents(shape, neuron_idxs, timesteps, spiketimes)
+
+        spiketrains_b_l_t = np.zeros(shape)
+        np.reshape(spiketrains_b_l_t, (-1, shape[-1]))[
+            neuron_idxs, timesteps] = spiketimes
 
         return spiketrains_b_l_t
 
@@ -1140,8 +1404,11 @@ class AbstractSNN:
             return
 
         avg_rate = 0
-        for i in range(len(self.spiketrains_n_b_l_t)):
-            avg_rate += np.count_nonzero(self.spiketrains_n_b_l_t[i][0])
+        for spiketrains_b_l_t, _ in self.spiketrains_n_b_l_t:
+            if isinstance(spiketrains_b_l_t, SpikeEvents):
+                avg_rate += spiketrains_b_l_t.num_events
+            else:
+                avg_rate += np.count_nonzero(spiketrains_b_l_t)
 
         avg_rate /= np.sum(self.num_neurons) * self.batch_size * \
             self._num_timesteps
@@ -1157,6 +1424,292 @@ class AbstractSNN:
         pass
 
 
+class SpikeEvents:
+    """Sparse event-list representation of the spike trains of a layer.
+
+    Instead of a dense array of shape
+    (`batch_size`, ``layer_shape``, ``num_timesteps``) where most entries are
+    zero, only the spike events are stored. Each event is described by the
+    flat index of the neuron (counting across the batch dimension, i.e. into
+    ``shape[:-1]``), the time step, and the value the dense array would hold
+    at this position (the spike time, which carries a negative sign in case of
+    negative spikes). Events are not required to be sorted.
+
+    This class is used for the entries of ``AbstractSNN.spiketrains_n_b_l_t``
+    if ``sparse_spiketrains`` is set in the ``[output]`` section of the
+    config. It provides the reductions needed to compute operation counts,
+    spike rates and plots without ever allocating the dense array.
+
+    Parameters
+    ----------
+
+    shape: tuple
+        Shape of the corresponding dense array.
+    neuron_idxs: Optional[ndarray]
+        Flat neuron index of each event.
+    timesteps: Optional[ndarray]
+        Time step of each event.
+    values: Optional[ndarray]
+        Value of each event.
+    """
+
+    def __init__(self, shape, neuron_idxs=None, timesteps=None, values=None):
+
+        self.shape = tuple(int(s) for s in shape)
+        self._neuron_idxs = np.asarray(
+            [] if neuron_idxs is None else neuron_idxs, 'int64')
+        self._timesteps = np.asarray(
+            [] if timesteps is None else timesteps, 'int32')
+        self._values = np.asarray([] if values is None else values, 'float32')
+        # Events added with ``__setitem__`` are collected in chunks and
+        # concatenated only when the events are read.
+        self._chunks = []
+        self._written_timesteps = None
+
+    def _consolidate(self):
+        """Concatenate the pending chunks of events."""
+
+        if not self._chunks:
+            return
+        neuron_idxs, timesteps, values = zip(*self._chunks)
+        self._neuron_idxs = np.concatenate((self._neuron_idxs,) + neuron_idxs)
+        self._timesteps = np.concatenate((self._timesteps,) + timesteps)
+        self._values = np.concatenate((self._values,) + values)
+        self._chunks = []
+
+    @property
+    def neuron_idxs(self):
+        self._consolidate()
+        return self._neuron_idxs
+
+    @property
+    def timesteps(self):
+        self._consolidate()
+        return self._timesteps
+
+    @property
+    def values(self):
+        self._consolidate()
+        return self._values
+
+    @classmethod
+    def from_dense(cls, spiketrains):
+        """Extract the events from a dense array of spike trains.
+
+        Parameters
+        ----------
+
+        spiketrains: ndarray
+            Spike trains of shape (``shape``, ``num_timesteps``).
+
+        Returns
+        -------
+
+        : SpikeEvents
+        """
+
+        spiketrains_flat = np.reshape(spiketrains,
+                                      (-1, np.shape(spiketrains)[-1]))
+        neuron_idxs, timesteps = np.nonzero(spiketrains_flat)
+        return cls(np.shape(spiketrains), neuron_idxs, timesteps,
+                   spiketrains_flat[neuron_idxs, timesteps])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def num_events(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        """Return the events of the samples ``idx`` along the first axis.
+
+        ``idx`` can be an integer, which removes the first axis like indexing
+        the dense array would, or a slice, an integer array, or a boolean
+        mask, which select samples along the first axis.
+        """
+
+        stride = int(np.prod(self.shape[1:-1]))
+        batch_idxs = self.neuron_idxs // stride
+
+        if isinstance(idx, (int, np.integer)):
+            mask = batch_idxs == range(self.shape[0])[idx]
+            return SpikeEvents(self.shape[1:], self.neuron_idxs[mask] % stride,
+                               self.timesteps[mask], self.values[mask])
+
+        if isinstance(idx, slice):
+            idx = np.arange(self.shape[0])[idx]
+        elif isinstance(idx, (list, np.ndarray)) and np.ndim(idx) == 1 and \
+                np.asarray(idx).dtype.kind in 'biu':
+            idx = np.arange(self.shape[0])[np.asarray(idx)]
+        else:
+            raise IndexError("SpikeEvents can only be indexed along the first "
+                             "axis, with an integer, a slice, an integer "
+                             "array or a boolean mask; got {}.".format(idx))
+
+        # Gather the events of each selected sample, which may occur several
+        # times.
+        order = np.argsort(batch_idxs, kind='stable')
+        starts = np.searchsorted(batch_idxs[order], idx, 'left')
+        stops = np.searchsorted(batch_idxs[order], idx, 'right')
+        events = np.concatenate([order[start:stop] for start, stop
+                                 in zip(starts, stops)] + [[]]).astype(int)
+        positions = np.repeat(np.arange(len(idx)), stops - starts)
+        return SpikeEvents(
+            (len(idx),) + self.shape[1:],
+            positions * stride + self.neuron_idxs[events] % stride,
+            self.timesteps[events], self.values[events])
+
+    def __setitem__(self, key, value):
+        """Write dense spike trains into the event list.
+
+        Supports the two assignment patterns used by the simulators when
+        recording into ``spiketrains_n_b_l_t``: ``events[..., t] = spikes_b_l``
+        adds the spikes of a single time step ``t``, and
+        ``events[:] = spikes_b_l_t`` replaces all events.
+        """
+
+        if key == slice(None):
+            other = SpikeEvents.from_dense(np.broadcast_to(value, self.shape))
+            self._neuron_idxs = other.neuron_idxs
+            self._timesteps = other.timesteps
+            self._values = other.values
+            self._chunks = []
+            self._written_timesteps = None
+            return
+
+        if not (isinstance(key, tuple) and len(key) == 2 and
+                key[0] is Ellipsis and isinstance(key[1], (int, np.integer))):
+            raise IndexError("Unsupported assignment to SpikeEvents: {}"
+                             "".format(key))
+
+        t = range(self.shape[-1])[key[1]]
+        if self._written_timesteps is None:
+            self._written_timesteps = set(np.unique(self.timesteps).tolist())
+        if t in self._written_timesteps:
+            # Overwriting a time step requires removing its previous events.
+            keep = self.timesteps != t
+            self._neuron_idxs = self._neuron_idxs[keep]
+            self._timesteps = self._timesteps[keep]
+            self._values = self._values[keep]
+        self._written_timesteps.add(t)
+
+        value = np.asarray(value)
+        if value.shape != self.shape[:-1]:
+            value = np.broadcast_to(value, self.shape[:-1])
+        neuron_idxs = np.flatnonzero(value)
+        self._chunks.append((
+            neuron_idxs.astype('int64'), np.full(len(neuron_idxs), t, 'int32'),
+            value.reshape(-1)[neuron_idxs].astype('float32')))
+
+    def to_dense(self):
+        """Return the spike trains as dense array of shape ``shape``."""
+
+        spiketrains = np.zeros(self.shape, 'float32')
+        spiketrains.reshape((-1, self.shape[-1]))[
+            self.neuron_idxs, self.timesteps] = self.values
+        return spiketrains
+
+    def get_spikecounts(self):
+        """Return the number of spikes of each neuron.
+
+        Returns
+        -------
+
+        : ndarray
+            Shape: ``shape[:-1]``.
+        """
+
+        return np.reshape(np.bincount(
+            self.neuron_idxs, minlength=int(np.prod(self.shape[:-1]))),
+            self.shape[:-1])
+
+    def get_spikecounts_b_t(self, weights=None):
+        """Return the number of spikes per sample and time step.
+
+        Parameters
+        ----------
+
+        weights: Optional[Union[int, ndarray]]
+            If given, each spike of a neuron is counted with this weight
+            instead of one. Can be a scalar or an array of the layer shape,
+            e.g. the fanout of the neurons.
+
+        Returns
+        -------
+
+        : ndarray
+            Shape: (``shape[0]``, ``shape[-1]``).
+        """
+
+        stride = int(np.prod(self.shape[1:-1]))
+        batch_idxs = self.neuron_idxs // stride
+        if weights is not None and not np.isscalar(weights):
+            weights = np.ravel(weights)[self.neuron_idxs % stride]
+        counts = np.bincount(batch_idxs * self.shape[-1] + self.timesteps,
+                             None if np.isscalar(weights) else weights,
+                             self.shape[0] * self.shape[-1])
+        if np.isscalar(weights):
+            counts = counts * weights
+        return np.reshape(counts, (self.shape[0], self.shape[-1]))
+
+    def _get_ordered_values(self, last=False):
+        """Return the value of the first (or last) spike of each neuron."""
+
+        order = np.lexsort((self.timesteps, self.neuron_idxs))
+        neuron_idxs = self.neuron_idxs[order]
+        is_boundary = np.ones(len(order), bool)
+        if last:
+            is_boundary[:-1] = neuron_idxs[1:] != neuron_idxs[:-1]
+        else:
+            is_boundary[1:] = neuron_idxs[1:] != neuron_idxs[:-1]
+        values = np.zeros(int(np.prod(self.shape[:-1])), 'float32')
+        values[neuron_idxs[is_boundary]] = self.values[order][is_boundary]
+        return np.reshape(values, self.shape[:-1])
+
+    def get_rates(self, duration, spike_code):
+        """Convert the spike events to spike rates.
+
+        Equivalent to applying :py:func:`spiketrains_to_rates` to the dense
+        array, but computed directly from the events.
+
+        Parameters
+        ----------
+
+        duration: int
+            Duration of simulation.
+        spike_code: str
+            Spike encoding mechanism. With 'ttfs' and 'ttfs_dyn_thresh', the
+            rate is the inverse of the time to first spike; with
+            'ttfs_corrective', the inverse of the last spike time if a neuron
+            fired an odd number of times. Otherwise the mean rate is
+            returned.
+
+        Returns
+        -------
+
+        : ndarray
+            Shape: ``shape[:-1]``.
+        """
+
+        spikecounts = self.get_spikecounts()
+
+        if spike_code in {'ttfs', 'ttfs_dyn_thresh'}:
+            t = self._get_ordered_values()
+        elif spike_code == 'ttfs_corrective':
+            t = self._get_ordered_values(last=True) * (spikecounts % 2)
+        else:
+            # Multiplication with sign is for possible negative spikes
+            # (e.g. BinaryNet)
+            sums = np.reshape(np.bincount(
+                self.neuron_idxs, self.values,
+                int(np.prod(self.shape[:-1]))), self.shape[:-1])
+            return spikecounts / duration * np.sign(sums)
+
+        return np.divide(1., t, out=np.zeros(t.shape), where=t != 0)
+
+
 def get_samples_from_list(x_test, y_test, dataflow, config):
     """
     If user specified a list of samples to test with
@@ -1193,321 +1746,1164 @@ def get_samples_from_list(x_test, y_test, dataflow, config):
     return x_test, y_test
 
 
-def build_1d_convolution(layer, delay):
-    """Build convolution layer.
+def get_sample_stream(x_test, y_test, dataflow, num_to_test):
+    """Iterate over the test set sample by sample.
 
     Parameters
     ----------
 
-    layer: keras.layers.Conv1D
-        Parsed model layer.
-    delay: float
-        Synaptic delay.
+    x_test: Optional[ndarray]
+        The input samples to test.
+    y_test: Optional[ndarray]
+        Ground truth of test data. Required if ``x_test`` is given.
+    dataflow: Optional[keras.DataFlowGenerator]
+        Loads images from disk and processes them on the fly. Only used if
+        ``x_test`` is ``None``.
+    num_to_test: int
+        How many samples to test.
 
     Returns
     -------
 
-    connections: List[tuple]
-        A list where each entry is a tuple containing the source neuron index,
-        the target neuron index, the connection strength (weight), and the
-        synaptic ``delay``.
-    i_offset: ndarray
-        Flattened array containing the biases of all neurons in the ``layer``.
+    samples: Iterator
+        Yields tuples ``(x, y)`` of an input sample and its label.
     """
 
-    weights, biases = layer.get_weights()
+    if x_test is not None:
+        if y_test is None:
+            raise ValueError("The test samples need to be passed together "
+                             "with their labels (y_test).")
+        samples = zip(x_test, y_test)
+    elif dataflow is not None:
+        samples = (sample for _ in itertools.count()
+                   for sample in zip(*dataflow.next()))
+    else:
+        samples = iter(())
 
-    # Biases.
+    return itertools.islice(samples, num_to_test)
 
-    n = int(np.prod(layer.output_shape[1:]) / len(biases))
-    i_offset = np.repeat(biases, n).astype('float64')
 
-    ii = 0 if layer.data_format == 'channels_first' else 1
+def get_flatten_permutation(shape, data_format):
+    """Get the order of the neurons of a feature map after flattening.
 
-    nx = layer.input_shape[-1 - ii]  # Width of feature map
+    Keras flattens feature maps in ``channels_last`` order, while the neurons
+    of a spiking layer are arranged in ``channels_first`` order. This function
+    assumes that each consecutive input neuron lies in a different channel,
+    which is the case for ``channels_last``.
 
-    # Assumes symmetric padding ((1, 1), (1, 1)). Need to reduce dimensions of
-    # input here because the layer.input_shape refers to the ZeroPadding layer
-    # contained in the parsed model, which is removed when building the SNN.
+    Parameters
+    ----------
 
-    if layer.padding == 'ZeroPadding':
-        print("Applying ZeroPadding.")
-        nx -= 2
-        layer.padding = 'same'
+    shape: tuple
+        Shape of the feature map before flattening.
+    data_format: str
+        Data format of the feature map.
 
-    kx = layer.kernel_size[0]  # Width of kernel
-    px = int((kx - 1) / 2)  # Zero-padding
+    Returns
+    -------
 
-    sx = layer.strides[0]
+    idxs: ndarray
+        For each flattened neuron, the index of the corresponding neuron in the
+        spiking layer.
+    """
 
-    if layer.padding == 'valid':
-        # In padding 'valid', the original sidelength is
-        # reduced by one less than the kernel size.
-        mx = (nx - kx + 1) // sx  # Number of output filters
-        x0 = px
-    elif layer.padding == 'same':
-        mx = nx // sx
-        x0 = 0
+    if data_format == 'channels_last':
+        y_in, x_in, f_in = shape
     else:
-        raise NotImplementedError("Border_mode {} not supported".format(
-            layer.padding))
-
-    connections = []
-    # Loop over output filters 'fout'
-    for fout in range(weights.shape[2]):
-        for x in range(x0, nx - x0, sx):
-            target = int((x - x0) / sx +
-                         fout * mx)
-            for fin in range(weights.shape[1]):
-                source = x + (fin * nx)
-                for p in range(-px, px + 1):
-                    if not 0 <= x + p < nx:
-                        continue
-                    connections.append((source + p, target,
-                                        weights[px - p, fin, fout], delay))
-        echo('.')
-    print('')
+        f_in, y_in, x_in = shape
 
-    return connections, i_offset
+    return np.arange(f_in * y_in * x_in).reshape(
+        (f_in, y_in, x_in)).transpose((1, 2, 0)).ravel()
 
 
-def build_convolution(layer, delay, transpose_kernel=False):
-    """Build convolution layer.
+def get_dense_connections(weights, delay, source_idxs=None, split_sign=False,
+                          chunk_size=None):
+    """Build connections of a fully-connected layer.
 
     Parameters
     ----------
 
-    layer: keras.layers.Conv2D
-        Parsed model layer.
+    weights: ndarray
+        Weight matrix of shape (``num_inputs``, ``num_outputs``).
     delay: float
         Synaptic delay.
-    transpose_kernel: bool
-        Whether or not to convert kernels from Tensorflow to Theano format
-        (correlation instead of convolution).
+    source_idxs: Optional[ndarray]
+        Index of the source neuron for each row of ``weights``, e.g. to undo
+        the permutation of a Flatten layer (see `get_flatten_permutation`).
+    split_sign: bool
+        If ``True``, return the connections with positive and negative weights
+        separately, omitting those with zero weight (e.g. removed by the mask
+        of a ``Sparse`` layer). Memory then scales with the number of nonzero
+        weights.
+    chunk_size: Optional[int]
+        If given, return a generator that yields the connections in arrays of
+        at most ``chunk_size`` rows (but at least one row of ``weights``), so
+        that the complete connection list never has to be held in memory.
+        Cannot be combined with ``split_sign``.
 
     Returns
     -------
 
-    connections: List[tuple]
-        A list where each entry is a tuple containing the source neuron index,
-        the target neuron index, the connection strength (weight), and the
-        synaptic ``delay``.
-    i_offset: ndarray
-        Flattened array containing the biases of all neurons in the ``layer``.
+    connections: Union[ndarray, tuple[ndarray, ndarray], Iterator[ndarray]]
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic ``delay``. If ``split_sign`` is set, a
+        tuple of such arrays for the excitatory and inhibitory connections.
+        If ``chunk_size`` is set, a generator of consecutive blocks of rows.
     """
 
-    weights, biases = get_weights(layer)
-
-    if transpose_kernel:
-        print("Transposing kernels.")
-        weights = convert_kernel(weights)
+    num_inputs, num_outputs = weights.shape
+    if source_idxs is None:
+        source_idxs = np.arange(num_inputs)
+
+    if chunk_size:
+        return iter_dense_connections(weights, delay, source_idxs, chunk_size)
+
+    if split_sign:
+        signed_connections = []
+        for mask in (weights > 0, weights < 0):
+            i, j = np.nonzero(mask)
+            connections = np.empty((len(i), 4), order='F')
+            connections[:, 0] = source_idxs[i]
+            connections[:, 1] = j
+            connections[:, 2] = weights[i, j]
+            connections[:, 3] = delay
+            signed_connections.append(connections)
+        return tuple(signed_connections)
+
+    connections = np.empty((weights.size, 4), order='F')
+    connections[:, 0] = np.repeat(source_idxs, num_outputs)
+    connections[:, 1] = np.tile(np.arange(num_outputs), num_inputs)
+    connections[:, 2] = weights.ravel()
+    connections[:, 3] = delay
 
-    # Biases.
-    n = int(np.prod(layer.output_shape[1:]) / len(biases))
-    i_offset = np.repeat(biases, n).astype('float64')
+    return connections
 
-    ii = 1 if keras.backend.image_data_format() == 'channels_first' else 0
 
-    ny = layer.input_shape[1 + ii]  # Height of feature map
-    nx = layer.input_shape[2 + ii]  # Width of feature map
-    ky, kx = layer.kernel_size  # Width and height of kernel
-    sy, sx = layer.strides  # Convolution strides
-    py = (ky - 1) // 2  # Zero-padding rows
-    px = (kx - 1) // 2  # Zero-padding columns
+def iter_dense_connections(weights, delay, source_idxs, chunk_size):
+    """Generate the connections of a fully-connected layer in chunks.
 
-    if layer.padding == 'valid':
-        # In padding 'valid', the original sidelength is reduced by one less
-        # than the kernel size.
-        mx = (nx - kx + 1) // sx  # Number of columns in output filters
-        my = (ny - ky + 1) // sy  # Number of rows in output filters
-        x0 = px
-        y0 = py
-    elif layer.padding == 'same':
-        mx = nx // sx
-        my = ny // sy
-        x0 = 0
-        y0 = 0
-    else:
-        raise NotImplementedError("Border_mode {} not supported".format(
-            layer.padding))
-
-    connections = []
-
-    # Loop over output filters 'fout'
-    for fout in range(weights.shape[3]):
-        for y in range(y0, ny - y0, sy):
-            for x in range(x0, nx - x0, sx):
-                target = int((x - x0) / sx + (y - y0) / sy * mx +
-                             fout * mx * my)
-                # Loop over input filters 'fin'
-                for fin in range(weights.shape[2]):
-                    for k in range(-py, py + 1):
-                        if not 0 <= y + k < ny:
-                            continue
-                        for p in range(-px, px + 1):
-                            if not 0 <= x + p < nx:
-                                continue
-                            source = p + x + (y + k) * nx + fin * nx * ny
-                            connections.append((source, target,
-                                                weights[py - k, px - p, fin,
-                                                        fout], delay))
-        echo('.')
-    print('')
+    See `get_dense_connections` for a description of the parameters.
+    """
 
-    return connections, i_offset
+    rows_per_chunk = max(1, chunk_size // max(1, weights.shape[1]))
+    for start in range(0, len(weights), rows_per_chunk):
+        rows = slice(start, start + rows_per_chunk)
+        yield get_dense_connections(weights[rows], delay, source_idxs[rows])
 
 
-def build_depthwise_convolution(layer, delay, transpose_kernel=False):
-    """Build convolution layer.
+def get_kernel_connections(input_shape, start, strides, padding,
+                           num_cols_out, kernel_shape=None):
+    """Connectivity of a kernel sliding over a single feature map.
 
     Parameters
     ----------
 
-    layer: keras.layers.DepthwiseConv2D
-        Parsed model layer.
-    delay: float
-        Synaptic delay.
-    transpose_kernel: bool
-        Whether or not to convert kernels from Tensorflow to Theano format
-        (correlation instead of convolution).
+    input_shape: tuple[int, int]
+        Number of rows and columns of the input feature map.
+    start: tuple[int, int]
+        Row and column of the first kernel center.
+    strides: tuple[int, int]
+        Convolution strides.
+    padding: tuple[int, int]
+        Number of kernel rows and columns on either side of the center.
+    num_cols_out: int
+        Number of columns of the output feature map.
+    kernel_shape: Optional[tuple[int, int]]
+        Shape of the kernel weights, used to compute ``kernel_idxs``. Defaults
+        to a kernel of ``2 * padding + 1`` rows and columns.
 
     Returns
     -------
 
-    connections: List[tuple]
-        A list where each entry is a tuple containing the source neuron index,
-        the target neuron index, the connection strength (weight), and the
-        synaptic ``delay``.
-    i_offset: ndarray
-        Flattened array containing the biases of all neurons in the ``layer``.
+    source: ndarray
+        Index of the source neuron within the input feature map, for each
+        output position and kernel element. Shape: (``num_positions``,
+        ``num_kernel_elements``). Output positions are ordered by row and
+        column, kernel elements likewise.
+    target: ndarray
+        Index of the target neuron within the output feature map, for each
+        output position.
+    valid: ndarray
+        Boolean mask of the same shape as ``source``, which is ``False`` where
+        the kernel element lies outside of the input.
+    kernel_idxs: ndarray
+        Flat index of each kernel element into the (flipped) kernel weights.
     """
 
-    weights, biases = get_weights(layer)
+    (ny, nx), (y0, x0), (sy, sx), (py, px) = \
+        input_shape, start, strides, padding
+    if kernel_shape is None:
+        kernel_shape = (2 * py + 1, 2 * px + 1)
+
+    y = np.arange(y0, ny - y0, sy)
+    x = np.arange(x0, nx - x0, sx)
+    k = np.arange(-py, py + 1)
+    p = np.arange(-px, px + 1)
+    y_in = y[:, None] + k[None, :]
+    x_in = x[:, None] + p[None, :]
+
+    source = y_in[:, None, :, None] * nx + x_in[None, :, None, :]
+    valid = ((0 <= y_in) & (y_in < ny))[:, None, :, None] & \
+        ((0 <= x_in) & (x_in < nx))[None, :, None, :]
+    target = ((y - y0) // sy * num_cols_out)[:, None] + \
+        ((x - x0) // sx)[None, :]
+    kernel_idxs = np.ravel_multi_index(
+        np.meshgrid(py - k, px - p, indexing='ij'), kernel_shape)
+
+    num_positions = len(y) * len(x)
+    return (source.reshape(num_positions, -1), target.ravel(),
+            valid.reshape(num_positions, -1), kernel_idxs.ravel())
+
+
+def get_channel_kernel_connections(input_shape, start, strides, padding,
+                                   num_cols_out, kernel_shape, num_fin):
+    """Connectivity of a kernel sliding over all input channels.
+
+    Extends `get_kernel_connections` to the connections from ``num_fin``
+    input feature maps to one output channel, and removes the connections
+    of kernel elements that lie outside of the input. The parameters are the
+    same as for `get_kernel_connections`, plus the number of input channels
+    ``num_fin``.
 
-    if transpose_kernel:
-        print("Transposing kernels.")
-        weights = convert_kernel(weights)
+    Returns
+    -------
 
-    # Biases.
-    n = int(np.prod(layer.output_shape[1:]) / len(biases))
-    i_offset = np.repeat(biases, n).astype('float64')
+    source: ndarray
+        Source neuron index of each connection. Connections are ordered by
+        output position, input channel, and kernel element.
+    target: ndarray
+        Target neuron index (within the output channel) of each connection.
+    kernel_idxs: ndarray
+        Row of the kernel weights (with the input channels flattened into the
+        kernel elements) for each connection.
+    """
 
-    ii = 0 if layer.data_format == 'channels_first' else 1
+    source, target, valid, kernel_idxs = get_kernel_connections(
+        input_shape, start, strides, padding, num_cols_out, kernel_shape)
+    source = source[:, None, :] + \
+        np.arange(num_fin)[None, :, None] * int(np.prod(input_shape))
+    kernel_idxs = kernel_idxs[None, None, :] * num_fin + \
+        np.arange(num_fin)[None, :, None]
+    valid = np.broadcast_to(valid[:, None, :], source.shape)
+    source = source[valid]
+    kernel_idxs = np.broadcast_to(kernel_idxs, valid.shape)[valid]
+    target = np.broadcast_to(target[:, None, None], valid.shape)[valid]
 
-    nx = layer.input_shape[-1 - ii]  # Width of feature map
-    ny = layer.input_shape[-2 - ii]  # Height of feature map
+    return source, target, kernel_idxs
 
-    # Assumes symmetric padding ((1, 1), (1, 1)). Need to reduce dimensions of
-    # input here because the layer.input_shape refers to the ZeroPadding layer
-    # contained in the parsed model, which is removed when building the SNN.
-    if layer.padding == 'ZeroPadding':
-        print("Applying ZeroPadding.")
-        nx -= 2
-        ny -= 2
-        layer.padding = 'same'
 
-    kx, ky = layer.kernel_size  # Width and height of kernel
-    px = int((kx - 1) / 2)  # Zero-padding columns
-    py = int((ky - 1) / 2)  # Zero-padding rows
+# Part of the key of the connectivity cache. Increment whenever the arrays
+# returned by a connectivity function change for the same arguments.
+CONNECTIVITY_CACHE_VERSION = 1
 
-    sx = layer.strides[1]
-    sy = layer.strides[0]
 
-    dm = layer.depth_multiplier
+def get_cached_connectivity(cache_dir, get_connectivity, *args):
+    """Compute the connectivity of a layer, or load it from an on-disk cache.
 
-    if layer.padding == 'valid':
-        # In padding 'valid', the original sidelength is
-        # reduced by one less than the kernel size.
-        mx = (nx - kx + 1) // sx  # Number of columns in output filters
-        my = (ny - ky + 1) // sy  # Number of rows in output filters
-        x0 = px
-        y0 = py
-    elif layer.padding == 'same':
-        mx = nx // sx
-        my = ny // sy
-        x0 = 0
-        y0 = 0
-    else:
-        raise NotImplementedError("Border_mode {} not supported".format(
-            layer.padding))
-    connections = []
-    for fin in range(weights.shape[-2]):
-        for d in range(weights.shape[-1]):
-            for y in range(y0, ny - y0, sy):
-                for x in range(x0, nx - x0, sx):
-                    target = ((x - x0) // sx) + ((y - y0) // sy * mx) + \
-                        (d * mx * my) + (fin * dm * mx * my)
-                    for k in range(-py, py + 1):
-                        if not 0 <= y + k < ny:
-                            continue
-                        for p in range(-px, px + 1):
-                            if not 0 <= x + p < nx:
-                                continue
-                            source = x + p + ((y + k) * nx) + (fin * nx * ny)
-                            connections.append((source, target,
-                                                weights[py - k, px - p, fin,
-                                                        d], delay))
+    The connectivity (i.e. the index arrays of pre- and post-synaptic neurons)
+    of convolution and pooling layers depends only on the layer geometry, not
+    on the weights. When rebuilding a network, e.g. after renormalization or
+    during a parameter sweep, the index arrays can thus be reused.
+
+    Parameters
+    ----------
+
+    cache_dir: Optional[str]
+        Directory of the cache. If ``None`` or empty, the connectivity is
+        computed without caching.
+    get_connectivity: Callable
+        Function returning a tuple of arrays.
+    args:
+        Arguments to ``get_connectivity``, describing the layer geometry.
+        Together with the module and name of ``get_connectivity`` and
+        `CONNECTIVITY_CACHE_VERSION`, they form the cache key, so they should
+        consist of plain Python numbers and tuples.
+
+    Returns
+    -------
+
+    arrays: tuple[ndarray]
+        The result of ``get_connectivity(*args)``.
+    """
+
+    if not cache_dir:
+        return get_connectivity(*args)
+
+    key = repr((CONNECTIVITY_CACHE_VERSION, get_connectivity.__module__,
+                get_connectivity.__name__) + args)
+    filepath = os.path.join(cache_dir,
+                            hashlib.sha1(key.encode()).hexdigest() + '.npz')
+    if os.path.isfile(filepath):
+        with np.load(filepath) as f:
+            return tuple(f['arr_{}'.format(i)] for i in range(len(f.files)))
+
+    arrays = get_connectivity(*args)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first, so that concurrent builds never read a
+    # partially written cache entry.
+    tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(tmp_filepath, 'wb') as f:
+        np.savez(f, *arrays)
+    os.replace(tmp_filepath, filepath)
+
+    return arrays
+
+
+def get_connections_per_channel(weights, source, target, kernel_idxs,
+                                num_neurons_out, delay, source_offsets=None,
+                                split_sign=False, chunk_size=None):
+    """Assemble the connections of a layer, one output channel at a time.
+
+    Parameters
+    ----------
+
+    weights: ndarray
+        Weights of the layer, with the output channels in the second axis and
+        all other axes flattened into the first.
+    source: ndarray
+        Source neuron index of each connection to an output channel.
+    target: ndarray
+        Target neuron index (within the output channel) of each connection.
+    kernel_idxs: ndarray
+        Row of ``weights`` for each connection.
+    num_neurons_out: int
+        Number of neurons per output channel.
+    delay: float
+        Synaptic delay.
+    source_offsets: Optional[ndarray]
+        Offset to add to ``source`` for each output channel.
+    split_sign: bool
+        If ``True``, return the connections with positive and negative weights
+        separately, omitting those with zero weight (e.g. removed by the mask
+        of a ``SparseConv2D`` layer). Memory then scales with the number of
+        nonzero weights.
+    chunk_size: Optional[int]
+        If given, return a generator that yields the connections in arrays of
+        at most ``chunk_size`` rows, so that the complete connection list
+        never has to be held in memory. Cannot be combined with
+        ``split_sign``.
+
+    Returns
+    -------
+
+    connections: Union[ndarray, tuple[ndarray, ndarray], Iterator[ndarray]]
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic ``delay``. If ``split_sign`` is set, a
+        tuple of such arrays for the excitatory and inhibitory connections.
+        If ``chunk_size`` is set, a generator of consecutive blocks of rows.
+    """
+
+    if chunk_size:
+        return iter_connections_per_channel(
+            weights, source, target, kernel_idxs, num_neurons_out, delay,
+            source_offsets, chunk_size)
+
+    if split_sign:
+        return tuple(get_masked_connections_per_channel(
+            weights, source, target, kernel_idxs, num_neurons_out, delay,
+            source_offsets, mask) for mask in (weights > 0, weights < 0))
+
+    connections = fill_connections_per_channel(
+        weights, source, target, kernel_idxs, num_neurons_out, delay,
+        source_offsets, progress=True)
+    print('')
+
+    return connections
+
+
+def fill_connections_per_channel(weights, source, target, kernel_idxs,
+                                 num_neurons_out, delay, source_offsets,
+                                 progress=False):
+    """Write the connections of all output channels into one array.
+
+    See `get_connections_per_channel` for a description of the parameters.
+    If ``progress`` is set, a dot is printed after each channel.
+    """
+
+    num_channels = weights.shape[1]
+    n = len(source)
+    # Column-major, so that each column is written contiguously.
+    connections = np.empty((n * num_channels, 4), order='F')
+    connections[:, 3] = delay
+    for c in range(num_channels):
+        rows = connections[c * n:(c + 1) * n]
+        rows[:, 0] = source if source_offsets is None \
+            else source + source_offsets[c]
+        rows[:, 1] = target + c * num_neurons_out
+        rows[:, 2] = weights[kernel_idxs, c]
+        if progress:
+            echo('.')
+
+    return connections
+
+
+def iter_connections_per_channel(weights, source, target, kernel_idxs,
+                                 num_neurons_out, delay, source_offsets,
+                                 chunk_size):
+    """Generate the connections of a layer in chunks.
+
+    Several output channels are combined into one chunk if they fit;
+    otherwise the connections of a single channel are split. The chunks are
+    yielded in the same order as the rows returned by
+    `get_connections_per_channel`. See there for a description of the
+    parameters. A dot is printed after each chunk.
+
+    Only the yielded chunks are bounded by ``chunk_size``. The index arrays
+    ``source``, ``target`` and ``kernel_idxs`` of a single output channel
+    are passed in complete.
+    """
+
+    n = len(source)
+    rows_per_chunk = max(1, min(n, chunk_size))
+    channels_per_chunk = max(1, chunk_size // max(1, n))
+    for c in range(0, weights.shape[1], channels_per_chunk):
+        channels = slice(c, c + channels_per_chunk)
+        offsets = None if source_offsets is None else source_offsets[channels]
+        for start in range(0, n, rows_per_chunk):
+            rows = slice(start, start + rows_per_chunk)
+            yield fill_connections_per_channel(
+                weights[:, channels], source[rows],
+                target[rows] + c * num_neurons_out, kernel_idxs[rows],
+                num_neurons_out, delay, offsets)
             echo('.')
     print('')
 
-    return connections, i_offset
 
+def get_connection_chunk_size(max_memory):
+    """Get the number of connections that fit into a memory budget.
 
-def build_pooling(layer, delay):
-    """Build average pooling layer.
+    Parameters
+    ----------
+
+    max_memory: float
+        Memory (in MB) available to hold connections while building a layer.
+        If zero, the connections are not chunked.
+
+    Returns
+    -------
+
+    chunk_size: Optional[int]
+        Maximum number of rows per array of connections, or ``None`` if the
+        connections should not be chunked.
+    """
+
+    if max_memory <= 0:
+        return None
+
+    # Each connection is a row of four float64 values.
+    return max(1, int(max_memory * 2 ** 20) // (4 * 8))
+
+
+def get_masked_connections_per_channel(weights, source, target, kernel_idxs,
+                                       num_neurons_out, delay, source_offsets,
+                                       mask):
+    """Assemble the connections of a layer for the nonzero entries of a mask.
+
+    Same as `get_connections_per_channel`, but only connections whose kernel
+    element is set in ``mask`` (a boolean array of the same shape as
+    ``weights``) are included. The size of the result is computed upfront
+    from the number of occurrences of each kernel element, so that no
+    intermediate array of all connections is allocated.
+    """
+
+    num_channels = weights.shape[1]
+    counts = np.bincount(kernel_idxs, minlength=len(weights)).dot(mask)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    connections = np.empty((offsets[-1], 4), order='F')
+    connections[:, 3] = delay
+    for c in range(num_channels):
+        keep = mask[kernel_idxs, c]
+        rows = connections[offsets[c]:offsets[c + 1]]
+        rows[:, 0] = source[keep] if source_offsets is None \
+            else source[keep] + source_offsets[c]
+        rows[:, 1] = target[keep] + c * num_neurons_out
+        rows[:, 2] = weights[kernel_idxs[keep], c]
+        echo('.')
+    print('')
+
+    return connections
+
+
+def get_convolution_connectivity(layer, kernel_shape, padding=None):
+    """Geometry of the connections of a convolution layer.
 
     Parameters
     ----------
 
-    layer: keras.layers.Pool2D
+    layer: Union[keras.layers.Conv1D, keras.layers.Conv2D,
+                 keras.layers.DepthwiseConv2D]
+        Parsed model layer. If its ``padding`` is ``'ZeroPadding'`` (set by
+        the simulators when removing a ZeroPadding layer of the parsed model),
+        the layer is treated as having ``'same'`` padding on the unpadded
+        input.
+    kernel_shape: tuple
+        Shape of the layer weights.
+    padding: Optional[str]
+        Padding to use instead of the ``padding`` attribute of the layer.
+
+    Returns
+    -------
+
+    args: tuple
+        Arguments to `get_channel_kernel_connections`, which describe the
+        connections from the input channels to one output channel.
+    num_neurons_out: int
+        Number of neurons per output channel.
+    """
+
+    layer_type = get_type(layer)
+    if padding is None:
+        padding = layer.padding
+
+    if layer_type == 'Conv1D':
+        ii = 0 if layer.data_format == 'channels_first' else 1
+
+        nx = layer.input_shape[-1 - ii]  # Width of feature map
+        ny = ky = sy = 1
+
+        # Assumes symmetric padding ((1, 1), (1, 1)). Need to reduce
+        # dimensions of input here because the layer.input_shape refers to the
+        # ZeroPadding layer contained in the parsed model, which is removed
+        # when building the SNN.
+        if padding == 'ZeroPadding':
+            nx -= 2
+            padding = 'same'
+
+        kx = layer.kernel_size[0]  # Width of kernel
+        sx = layer.strides[0]
+    elif 'Depthwise' in layer_type:
+        ii = 0 if layer.data_format == 'channels_first' else 1
+
+        nx = layer.input_shape[-1 - ii]  # Width of feature map
+        ny = layer.input_shape[-2 - ii]  # Height of feature map
+
+        # Assumes symmetric padding ((1, 1), (1, 1)), see above.
+        if padding == 'ZeroPadding':
+            nx -= 2
+            ny -= 2
+            padding = 'same'
+
+        kx, ky = layer.kernel_size  # Width and height of kernel
+        sy, sx = layer.strides
+    else:
+        ii = 1 if keras.backend.image_data_format() == 'channels_first' else 0
+
+        ny = layer.input_shape[1 + ii]  # Height of feature map
+        nx = layer.input_shape[2 + ii]  # Width of feature map
+        ky, kx = layer.kernel_size  # Width and height of kernel
+        sy, sx = layer.strides  # Convolution strides
+
+    px = (kx - 1) // 2  # Zero-padding columns
+    py = (ky - 1) // 2  # Zero-padding rows
+
+    if padding == 'valid':
+        # In padding 'valid', the original sidelength is reduced by one less
+        # than the kernel size.
+        mx = (nx - kx + 1) // sx  # Number of columns in output filters
+        my = (ny - ky + 1) // sy  # Number of rows in output filters
+        x0 = px
+        y0 = py
+    elif padding == 'same':
+        mx = nx // sx
+        my = ny // sy
+        x0 = 0
+        y0 = 0
+    else:
+        raise NotImplementedError("Border_mode {} not supported".format(
+            padding))
+
+    if layer_type == 'Conv1D':
+        # Input channels are in the second axis of the kernel.
+        args = ((1, nx), (0, x0), (1, sx), (0, px), mx, None,
+                kernel_shape[1])
+    elif 'Depthwise' in layer_type:
+        # Each output channel is connected to a single input channel.
+        args = ((ny, nx), (y0, x0), (sy, sx), (py, px), mx,
+                tuple(kernel_shape[:2]), 1)
+    else:
+        args = ((ny, nx), (y0, x0), (sy, sx), (py, px), mx,
+                tuple(kernel_shape[:2]), kernel_shape[2])
+
+    return args, mx * my
+
+
+def get_connectivity_args(layer, padding=None):
+    """Get the function and arguments that compute a layer's connectivity.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.Layer
+        Parsed model layer.
+    padding: Optional[str]
+        Padding that a convolution layer is built with, if it differs from
+        the ``padding`` attribute of the layer (e.g. ``'ZeroPadding'``, see
+        `get_convolution_connectivity`).
+
+    Returns
+    -------
+
+    : Optional[tuple]
+        The function computing the connectivity of a convolution or pooling
+        layer, followed by its arguments (see `get_cached_connectivity`).
+        ``None`` for other layer types.
+    """
+
+    layer_type = get_type(layer)
+    if layer_type in {'Conv1D', 'Conv2D', 'DepthwiseConv2D', 'SparseConv2D',
+                      'SparseDepthwiseConv2D'}:
+        args, _ = get_convolution_connectivity(
+            layer, layer.get_weights()[0].shape, padding)
+        return (get_channel_kernel_connections,) + args
+    if layer_type in {'MaxPooling2D', 'AveragePooling2D'}:
+        return (get_pooling_connections,) + get_pooling_connectivity(layer)
+
+
+def cache_connectivity(cache_dir, get_connectivity, *args):
+    """Compute the connectivity of a layer and write it to the cache.
+
+    Used by `prefetch_connectivity` in worker processes, so that the arrays
+    are passed on via the cache instead of being sent back to the parent.
+    """
+
+    get_cached_connectivity(cache_dir, get_connectivity, *args)
+
+
+def prefetch_connectivity(layers, cache_dir, num_workers=None,
+                          paddings=None):
+    """Compute the connectivity of several layers in parallel.
+
+    The connectivity of each convolution and pooling layer is computed in a
+    process pool and written to the cache. The simulator-specific ``build_*``
+    methods then only load the index arrays from the cache when building the
+    layers in order, and gather the weights.
+
+    Parameters
+    ----------
+
+    layers: list[keras.layers.Layer]
+        Parsed model layers.
+    cache_dir: str
+        Directory of the connectivity cache (see `get_cached_connectivity`).
+    num_workers: Optional[int]
+        Number of worker processes. Defaults to the number of CPUs.
+    paddings: Optional[list[Optional[str]]]
+        The padding that each layer is built with (see
+        `get_connectivity_args`). Must match the build, because the padding
+        is part of the cache key.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if paddings is None:
+        paddings = [None] * len(layers)
+
+    # Layers with the same geometry share their connectivity.
+    jobs = []
+    for layer, padding in zip(layers, paddings):
+        try:
+            job = get_connectivity_args(layer, padding)
+        except NotImplementedError:
+            # Reported when the layer is built.
+            continue
+        if job is not None and job not in jobs:
+            jobs.append(job)
+    if not jobs:
+        return
+
+    print("Generating connectivity of {} layers in parallel...".format(
+        len(jobs)))
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(cache_connectivity, cache_dir, *job)
+                   for job in jobs]
+        for future in futures:
+            future.result()
+
+
+def build_1d_convolution(layer, delay, cache_dir=None, split_sign=False,
+                         chunk_size=None):
+    """Build convolution layer.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.Conv1D
         Parsed model layer.
     delay: float
         Synaptic delay.
+    cache_dir: Optional[str]
+        Directory in which to cache the connectivity of the layer (see
+        `get_cached_connectivity`).
+    split_sign: bool
+        If ``True``, return the excitatory and inhibitory connections
+        separately, omitting those with zero weight (see
+        `get_connections_per_channel`).
+    chunk_size: Optional[int]
+        If given, generate the connections in arrays of at most
+        ``chunk_size`` rows (see `get_connections_per_channel`).
 
     Returns
     -------
 
-    connections: List[tuple]
-        A list where each entry is a tuple containing the source neuron index,
-        the target neuron index, the connection strength (weight), and the
-        synaptic ``delay``. The weight is given by :math:`\\frac{1}{k_x k_y}`,
-        where :math:`k_x, k_y` are the dimensions of the pooling kernel.
+    connections: Union[ndarray, tuple[ndarray, ndarray], Iterator[ndarray]]
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic ``delay``. If ``split_sign`` is set, a
+        tuple of such arrays for the excitatory and inhibitory connections.
+        If ``chunk_size`` is set, a generator of consecutive blocks of rows.
+    i_offset: ndarray
+        Flattened array containing the biases of all neurons in the ``layer``.
     """
 
-    if layer.__class__.__name__ == 'MaxPooling2D':
+    weights, biases = layer.get_weights()
 
-        warnings.warn("Layer type 'MaxPooling' not supported yet. " +
-                      "Falling back on 'AveragePooling'.", RuntimeWarning)
+    # Biases.
+
+    n = int(np.prod(layer.output_shape[1:]) / len(biases))
+    i_offset = np.repeat(biases, n).astype('float64')
+
+    args, num_neurons_out = get_convolution_connectivity(layer,
+                                                         weights.shape)
+    if layer.padding == 'ZeroPadding':
+        print("Applying ZeroPadding.")
+        layer.padding = 'same'
+
+    # The connections from all input channels to one output channel, ordered
+    # by output column, input channel and kernel column.
+    source, target, kernel_idxs = get_cached_connectivity(
+        cache_dir, get_channel_kernel_connections, *args)
+
+    return get_connections_per_channel(
+        weights.reshape(-1, weights.shape[-1]), source, target, kernel_idxs,
+        num_neurons_out, delay, split_sign=split_sign,
+        chunk_size=chunk_size), i_offset
+
+
+def build_convolution(layer, delay, transpose_kernel=False,
+                      cache_dir=None, split_sign=False, chunk_size=None):
+    """Build convolution layer.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.Conv2D
+        Parsed model layer.
+    delay: float
+        Synaptic delay.
+    transpose_kernel: bool
+        Whether or not to convert kernels from Tensorflow to Theano format
+        (correlation instead of convolution).
+    cache_dir: Optional[str]
+        Directory in which to cache the connectivity of the layer (see
+        `get_cached_connectivity`).
+    split_sign: bool
+        If ``True``, return the excitatory and inhibitory connections
+        separately, omitting those with zero weight (see
+        `get_connections_per_channel`).
+    chunk_size: Optional[int]
+        If given, generate the connections in arrays of at most
+        ``chunk_size`` rows (see `get_connections_per_channel`).
+
+    Returns
+    -------
+
+    connections: Union[ndarray, tuple[ndarray, ndarray], Iterator[ndarray]]
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic ``delay``. If ``split_sign`` is set, a
+        tuple of such arrays for the excitatory and inhibitory connections.
+        If ``chunk_size`` is set, a generator of consecutive blocks of rows.
+    i_offset: ndarray
+        Flattened array containing the biases of all neurons in the ``layer``.
+    """
+
+    weights, biases = get_weights(layer)
+
+    if transpose_kernel:
+        print("Transposing kernels.")
+        weights = convert_kernel(weights)
+
+    # Biases.
+    n = int(np.prod(layer.output_shape[1:]) / len(biases))
+    i_offset = np.repeat(biases, n).astype('float64')
+
+    args, num_neurons_out = get_convolution_connectivity(layer,
+                                                         weights.shape)
+
+    # The connections from all input channels to one output channel, ordered
+    # by output row and column, input channel, and kernel row and column.
+    source, target, kernel_idxs = get_cached_connectivity(
+        cache_dir, get_channel_kernel_connections, *args)
+
+    return get_connections_per_channel(
+        weights.reshape(-1, weights.shape[-1]), source, target, kernel_idxs,
+        num_neurons_out, delay, split_sign=split_sign,
+        chunk_size=chunk_size), i_offset
+
+
+def build_depthwise_convolution(layer, delay, transpose_kernel=False,
+                                cache_dir=None, split_sign=False,
+                                chunk_size=None):
+    """Build convolution layer.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.DepthwiseConv2D
+        Parsed model layer.
+    delay: float
+        Synaptic delay.
+    transpose_kernel: bool
+        Whether or not to convert kernels from Tensorflow to Theano format
+        (correlation instead of convolution).
+    cache_dir: Optional[str]
+        Directory in which to cache the connectivity of the layer (see
+        `get_cached_connectivity`).
+    split_sign: bool
+        If ``True``, return the excitatory and inhibitory connections
+        separately, omitting those with zero weight (see
+        `get_connections_per_channel`).
+    chunk_size: Optional[int]
+        If given, generate the connections in arrays of at most
+        ``chunk_size`` rows (see `get_connections_per_channel`).
+
+    Returns
+    -------
+
+    connections: Union[ndarray, tuple[ndarray, ndarray], Iterator[ndarray]]
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic ``delay``. If ``split_sign`` is set, a
+        tuple of such arrays for the excitatory and inhibitory connections.
+        If ``chunk_size`` is set, a generator of consecutive blocks of rows.
+    i_offset: ndarray
+        Flattened array containing the biases of all neurons in the ``layer``.
+    """
+
+    weights, biases = get_weights(layer)
+
+    if transpose_kernel:
+        print("Transposing kernels.")
+        weights = convert_kernel(weights)
+
+    # Biases.
+    n = int(np.prod(layer.output_shape[1:]) / len(biases))
+    i_offset = np.repeat(biases, n).astype('float64')
+
+    args, num_neurons_out = get_convolution_connectivity(layer,
+                                                         weights.shape)
+    if layer.padding == 'ZeroPadding':
+        print("Applying ZeroPadding.")
+        layer.padding = 'same'
+    (ny, nx), dm = args[0], layer.depth_multiplier
+
+    # The connections of one kernel, ordered by output row and column, and
+    # kernel row and column. Output channel ``fin * dm + d`` is connected to
+    # input channel ``fin``.
+    source, target, kernel_idxs = get_cached_connectivity(
+        cache_dir, get_channel_kernel_connections, *args)
+    num_fin = weights.shape[-2]
+    connections = get_connections_per_channel(
+        weights.reshape(-1, num_fin * dm), source, target, kernel_idxs,
+        num_neurons_out, delay, np.repeat(np.arange(num_fin), dm) * nx * ny,
+        split_sign, chunk_size)
+
+    return connections, i_offset
+
+
+def get_pooling_connections(input_shape, pool_size, strides):
+    """Connectivity of a pooling layer.
+
+    Parameters
+    ----------
+
+    input_shape: tuple[int, int, int]
+        Number of feature maps, rows and columns of the input.
+    pool_size: tuple[int, int]
+        Height and width of the pool.
+    strides: tuple[int, int]
+        Pooling strides.
+
+    Returns
+    -------
+
+    source: ndarray
+        Source neuron index of each connection. Connections are ordered by
+        feature map, output row, output column, and then the rows and columns
+        of the pool.
+    target: ndarray
+        Target neuron index of each connection.
+    """
+
+    (nz, ny, nx), (dy, dx), (sy, sx) = input_shape, pool_size, strides
+
+    # Input rows and columns covered by each pooling window.
+    y = np.arange(0, ny - dy + 1, sy)
+    x = np.arange(0, nx - dx + 1, sx)
+    y_in = y[:, None] + np.arange(dy)
+    x_in = x[:, None] + np.arange(dx)
+
+    source = y_in[:, None, :, None] * nx + x_in[None, :, None, :]
+    source = source.reshape(1, -1) + np.arange(nz)[:, None] * nx * ny
+    num_neurons_out = nz * len(y) * len(x)
+    target = np.repeat(np.arange(num_neurons_out), dy * dx)
+
+    return source.ravel(), target
+
+
+def get_pooling_connectivity(layer):
+    """Geometry of the connections of a pooling layer.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.Pool2D
+        Parsed model layer.
+
+    Returns
+    -------
+
+    args: tuple
+        Arguments to `get_pooling_connections`.
+    """
 
     ii = 1 if keras.backend.image_data_format() == 'channels_first' else 0
 
     nx = layer.input_shape[2 + ii]  # Width of feature map
     ny = layer.input_shape[1 + ii]  # Height of feature map
     nz = layer.input_shape[3 - 2 * ii]  # Number of feature maps
-    dx = layer.pool_size[1]  # Width of pool
-    dy = layer.pool_size[0]  # Height of pool
-    sx = layer.strides[1]
-    sy = layer.strides[0]
-
-    weight = 1 / (dx * dy)
-
-    connections = []
-
-    for fout in range(nz):
-        for y in range(0, ny - dy + 1, sy):
-            for x in range(0, nx - dx + 1, sx):
-                target = int(x / sx + y / sy * ((nx - dx) / sx + 1) +
-                             fout * nx * ny / (dx * dy))
-                for k in range(dy):
-                    source = x + (y + k) * nx + fout * nx * ny
-                    for j in range(dx):
-                        connections.append((source + j, target, weight, delay))
-        echo('.')
-    print('')
+    dy, dx = layer.pool_size  # Height and width of pool
+    sy, sx = layer.strides
+
+    return (nz, ny, nx), (dy, dx), (sy, sx)
+
+
+def build_pooling(layer, delay, weight=None, cache_dir=None):
+    """Build average pooling layer.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.Pool2D
+        Parsed model layer.
+    delay: float
+        Synaptic delay.
+    weight: Optional[float]
+        Connection strength. Defaults to :math:`\\frac{1}{k_x k_y}`, where
+        :math:`k_x, k_y` are the dimensions of the pooling kernel. Simulators
+        that approximate max pooling by gating the input spikes use a weight
+        of 1 instead.
+    cache_dir: Optional[str]
+        Directory in which to cache the connectivity of the layer (see
+        `get_cached_connectivity`).
+
+    Returns
+    -------
+
+    connections: ndarray
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic ``delay``.
+    """
+
+    if weight is None and layer.__class__.__name__ == 'MaxPooling2D':
+        warnings.warn("Layer type 'MaxPooling' not supported yet. " +
+                      "Falling back on 'AveragePooling'.", RuntimeWarning)
+
+    if weight is None:
+        weight = 1 / np.prod(layer.pool_size)
+
+    source, target = get_cached_connectivity(
+        cache_dir, get_pooling_connections, *get_pooling_connectivity(layer))
+
+    connections = np.empty((len(source), 4), order='F')
+    connections[:, 0] = source
+    connections[:, 1] = target
+    connections[:, 2] = weight
+    connections[:, 3] = delay
 
     return connections
 
 
+def build_max_pooling(layer, delay, inhibition=1., cache_dir=None):
+    """Build a winner-take-all circuit that approximates max pooling.
+
+    Each connection of a pooling window gets a relay neuron, which passes on
+    the spikes of its input neuron to the output neuron of the window. The
+    relays of a window inhibit each other, so that the relay of the most
+    active input suppresses the others, and the output neuron fires at about
+    the maximum rate of its inputs.
+
+    Parameters
+    ----------
+
+    layer: keras.layers.MaxPooling2D
+        Parsed model layer.
+    delay: float
+        Synaptic delay.
+    inhibition: float
+        Strength of the lateral inhibition between the relays of a window.
+    cache_dir: Optional[str]
+        Directory in which to cache the connectivity of the layer (see
+        `get_cached_connectivity`).
+
+    Returns
+    -------
+
+    input_connections: ndarray
+        Connections from the input neurons to the relays.
+    lateral_connections: ndarray
+        Inhibitory connections between the relays of each window. The
+        weights are positive and have to be applied to an inhibitory
+        receptor.
+    output_connections: ndarray
+        Connections from the relays to the output neurons.
+
+    Each array has shape (``num_connections``, 4), where each row contains
+    the source neuron index, the target neuron index, the connection strength
+    (weight), and the synaptic ``delay``.
+    """
+
+    source, target = get_cached_connectivity(
+        cache_dir, get_pooling_connections, *get_pooling_connectivity(layer))
+
+    def get_connections(pre, post, weight):
+        return np.column_stack([pre, post, np.full(len(pre), weight),
+                                np.full(len(pre), delay)])
+
+    # The connections of a window, and hence its relays, are consecutive.
+    num_relays = len(source)
+    window_size = int(np.prod(layer.pool_size))
+    relays = np.arange(num_relays)
+    pre, post = np.nonzero(np.logical_not(np.eye(window_size, dtype=bool)))
+    windows = np.arange(0, num_relays, window_size)[:, None]
+
+    return (get_connections(source, relays, 1),
+            get_connections((windows + pre).ravel(), (windows + post).ravel(),
+                            inhibition),
+            get_connections(relays, target, 1))
+
+
+# Record layout of connections in binary export format.
+CONNECTION_DTYPE = np.dtype([('i', 'int32'), ('j', 'int32'),
+                             ('weight', 'float32'), ('delay', 'float32')])
+
+CONNECTION_MANIFEST = 'connections_manifest.json'
+
+
+def write_connections_npy(filepath, connections):
+    """Write connections to a binary ``.npy`` file.
+
+    Parameters
+    ----------
+
+    filepath: str
+        Path of the ``.npy`` file.
+    connections: Union[ndarray, list[tuple]]
+        Array of shape (``num_connections``, 4), or list of tuples, containing
+        the source neuron index, the target neuron index, the connection
+        strength (weight), and the synaptic delay of each connection.
+    """
+
+    connections = np.asarray(connections)
+    records = np.empty(len(connections), CONNECTION_DTYPE)
+    if len(connections):
+        for k, name in enumerate(CONNECTION_DTYPE.names):
+            records[name] = connections[:, k]
+    np.save(filepath, records)
+
+
+def read_connections_npy(filepath):
+    """Read connections written by `write_connections_npy`.
+
+    Parameters
+    ----------
+
+    filepath: str
+        Path of the ``.npy`` file.
+
+    Returns
+    -------
+
+    connections: ndarray
+        Array of shape (``num_connections``, 4), where each row contains the
+        source neuron index, the target neuron index, the connection strength
+        (weight), and the synaptic delay.
+    """
+
+    records = np.load(filepath)
+    return np.column_stack([records[name] for name in records.dtype.names])
+
+
+def update_connection_manifest(path, label, **entry):
+    """Register a projection in the connection manifest of a directory.
+
+    The manifest is a json file mapping the label of each projection exported
+    with `write_connections_npy` to its properties, e.g. the labels of the
+    pre- and post-synaptic layers.
+
+    Parameters
+    ----------
+
+    path: str
+        Directory containing the exported connections.
+    label: str
+        Label of the projection.
+    entry:
+        Properties of the projection.
+    """
+
+    manifest = read_connection_manifest(path)
+    manifest[label] = entry
+    with open(os.path.join(path, CONNECTION_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def reset_connection_manifest(path):
+    """Start a new, empty connection manifest in a directory.
+
+    Must be called before exporting the connections of a model, so that the
+    manifest does not list projections of a previous export (see
+    `update_connection_manifest`).
+
+    Parameters
+    ----------
+
+    path: str
+        Directory containing the exported connections.
+    """
+
+    with open(os.path.join(path, CONNECTION_MANIFEST), 'w') as f:
+        json.dump({}, f)
+
+
+def read_connection_manifest(path):
+    """Read the connection manifest of a directory.
+
+    Parameters
+    ----------
+
+    path: str
+        Directory containing the exported connections.
+
+    Returns
+    -------
+
+    manifest: dict
+        The manifest (see `update_connection_manifest`). Empty if the
+        directory contains none.
+    """
+
+    filepath = os.path.join(path, CONNECTION_MANIFEST)
+    if not os.path.isfile(filepath):
+        return {}
+    with open(filepath) as f:
+        return json.load(f)
+
+
 def spikecounts_to_rates(spikecounts_n_b_l_t):
     """Convert spiketrains to spikerates.
 
@@ -1543,7 +2939,7 @@ def spiketrains_to_rates(spiketrains_n_b_l_t, duration, spike_code):
     Parameters
     ----------
 
-    spiketrains_n_b_l_t: list[tuple[np.array, str]]
+    spiketrains_n_b_l_t: list[tuple[Union[np.array, SpikeEvents], str]]
 
     duration: int
         Duration of simulation.
@@ -1581,13 +2977,49 @@ def spiketrains_to_rates(spiketrains_n_b_l_t, duration, spike_code):
     else:
         f = t2r_mean_rate
 
+    def to_rates(spiketrains_b_l_t, func, code):
+        if isinstance(spiketrains_b_l_t, SpikeEvents):
+            return spiketrains_b_l_t.get_rates(duration, code)
+        return np.apply_along_axis(func, -1, spiketrains_b_l_t)
+
     # For output layer, we always have multiple spikes (even with ttfs), so use
     # ``t2r_mean_rate``.
-    return [(np.apply_along_axis(f, -1, spiketrains_b_l_t), label)
+    return [(to_rates(spiketrains_b_l_t, f, spike_code), label)
             for spiketrains_b_l_t, label in spiketrains_n_b_l_t[:-1]] + \
-           [(np.apply_along_axis(
-               t2r_mean_rate, -1, spiketrains_n_b_l_t[-1][0]),
-             spiketrains_n_b_l_t[-1][1])]
+           [(to_rates(spiketrains_n_b_l_t[-1][0], t2r_mean_rate,
+                      'temporal_mean_rate'), spiketrains_n_b_l_t[-1][1])]
+
+
+def get_cumulative_spikecounts(spiketrains_b_l_t):
+    """Count the spikes of each neuron up to each time step.
+
+    This is used to decode the output of a spiking network: The guessed class
+    at time step ``t`` is the neuron in the output layer with the highest
+    number of spikes in ``[0, t]``.
+
+    Parameters
+    ----------
+
+    spiketrains_b_l_t: Union[ndarray, SpikeEvents]
+        Spike trains, where nonzero entries denote spikes.
+        Shape: (`batch_size`, ``layer_shape``, ``num_timesteps``)
+
+    Returns
+    -------
+
+    spikecounts_b_l_t: ndarray
+        Cumulative number of spikes. Same shape as ``spiketrains_b_l_t``.
+    """
+
+    if isinstance(spiketrains_b_l_t, SpikeEvents):
+        spikes_b_l_t = np.zeros(spiketrains_b_l_t.shape, 'int32')
+        np.add.at(spikes_b_l_t.reshape((-1, spiketrains_b_l_t.shape[-1])),
+                  (spiketrains_b_l_t.neuron_idxs,
+                   spiketrains_b_l_t.timesteps), 1)
+    else:
+        spikes_b_l_t = np.not_equal(spiketrains_b_l_t, 0)
+
+    return np.cumsum(spikes_b_l_t, -1, 'int32')
 
 
 def get_sample_activity_from_batch(activity_batch, idx=0):
@@ -1656,10 +3088,11 @@ def get_layer_synaptic_operations(spiketrains_b_l, fanout):
     """
 
     if np.isscalar(fanout):
-        return np.array([np.count_nonzero(s) for s in spiketrains_b_l]) * \
-            fanout
+        return np.count_nonzero(np.reshape(
+            spiketrains_b_l, (len(spiketrains_b_l), -1)), 1) * fanout
     elif hasattr(fanout, 'shape'):  # For conv layers with stride > 1
-        return np.array([np.sum(fanout[s != 0]) for s in spiketrains_b_l])
+        return np.sum(np.not_equal(spiketrains_b_l, 0) * fanout,
+                      tuple(range(1, np.ndim(spiketrains_b_l))))
     else:
         raise TypeError("The 'fanout' parameter should either be integer or "
                         "ndarray.")
@@ -3,6 +3,7 @@
 @author: rbodo
 """
 
+import hashlib
 import importlib
 import pkgutil
 
@@ -70,6 +71,40 @@ def confirm_overwrite(filepath):
     return True
 
 
+def get_input_model_hash(config):
+    """Compute a hash of the files that make up the input model.
+
+    These are all files in ``path_wd`` named ``filename_ann``, with any
+    extension (e.g. ``.h5``, or ``.json`` and ``.h5``).
+
+    Parameters
+    ----------
+
+    config: configparser.ConfigParser
+        Settings.
+
+    Returns
+    -------
+
+    : str
+        SHA1 hex digest.
+    """
+
+    path_wd = config.get('paths', 'path_wd')
+    filename_ann = config.get('paths', 'filename_ann')
+    sha1 = hashlib.sha1()
+    for filename in sorted(os.listdir(path_wd)):
+        filepath = os.path.join(path_wd, filename)
+        if os.path.splitext(filename)[0] != filename_ann or \
+                not os.path.isfile(filepath):
+            continue
+        sha1.update(filename.encode())
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def to_json(data, path):
     """Write ``data`` dictionary to ``path``.
 
@@ -0,0 +1,175 @@
+# coding=utf-8
+import os
+
+import numpy as np
+import pytest
+from tensorflow import keras
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+from snntoolbox.conversion.utils import get_activations_layer, \
+    get_activations_layers, iter_activations_layers, PercentileEstimator, \
+    update_percentile_estimators, load_activations, get_model_hash, \
+    get_dataset_hash, read_activations_manifest, write_activations_manifest
+from snntoolbox.datasets.utils import DataflowBatches
+
+
+@pytest.fixture(scope='module')
+def _model():
+    return keras.models.Sequential([
+        keras.layers.InputLayer((8, 8, 2)),
+        keras.layers.Conv2D(4, 3, activation='relu'),
+        keras.layers.Flatten(),
+        keras.layers.Dense(5, activation='relu'),
+        keras.layers.Dense(3, activation='softmax')])
+
+
+@pytest.fixture(scope='module')
+def _x_norm():
+    return np.random.RandomState(0).random_sample((20, 8, 8, 2))
+
+
+class TestActivations:
+    """Test computing the layer activations used for normalization."""
+
+    def test_get_activations_layers(self, _model, _x_norm):
+
+        layers = [layer for layer in _model.layers if len(layer.weights)]
+        activations = get_activations_layers(
+            _model.input, [layer.output for layer in layers], _x_norm, 10)
+
+        assert len(activations) == len(layers)
+        for layer, a in zip(layers, activations):
+            target = get_activations_layer(_model.input, layer.output,
+                                           _x_norm, 10)
+            assert np.allclose(a, target)
+
+        activations = get_activations_layers(
+            _model.input, [layers[0].output], _x_norm, 10)
+        assert len(activations) == 1
+        assert activations[0].shape == (20,) + layers[0].output_shape[1:]
+
+    def test_iter_activations_layers(self, _model, _x_norm):
+
+        layers = [layer for layer in _model.layers if len(layer.weights)]
+        layers_out = [layer.output for layer in layers]
+        target = get_activations_layers(_model.input, layers_out, _x_norm, 5)
+        batches = list(iter_activations_layers(_model.input, layers_out,
+                                               _x_norm, 5))
+        assert len(batches) == 4
+        for k, a in enumerate(zip(*batches)):
+            assert np.allclose(np.concatenate(a), target[k])
+
+        # The last batch holds the remaining samples.
+        batches = list(iter_activations_layers(_model.input, layers_out,
+                                               _x_norm, 8))
+        assert [len(a[0]) for a in batches] == [8, 8, 4]
+        for k, a in enumerate(zip(*batches)):
+            assert np.allclose(np.concatenate(a), target[k])
+
+    def test_activation_store(self, _model, _x_norm, tmpdir):
+
+        activ_dir = str(tmpdir)
+        layers = [layer for layer in _model.layers if len(layer.weights)]
+        target = get_activations_layers(
+            _model.input, [layer.output for layer in layers], _x_norm, 10)
+
+        stored = {}
+        estimators = {layer.name: PercentileEstimator() for layer in layers}
+        # The last batch is incomplete.
+        update_percentile_estimators(estimators, layers, _model, _x_norm, 8,
+                                     activ_dir, stored)
+        for layer, a in zip(layers, target):
+            activations = load_activations(activ_dir, stored[layer.name])
+            assert isinstance(activations, np.memmap)
+            assert np.allclose(activations, a)
+
+        write_activations_manifest(activ_dir, get_model_hash(_model),
+                                   get_dataset_hash(_x_norm), stored)
+        manifest = read_activations_manifest(activ_dir)
+        assert manifest['model_hash'] == get_model_hash(_model)
+        assert manifest['dataset_hash'] == get_dataset_hash(_x_norm)
+        assert manifest['layers'] == stored
+        assert get_dataset_hash(_x_norm[:10]) != manifest['dataset_hash']
+
+        # Reloading the stored activations gives the same estimates.
+        reloaded = {layer.name: PercentileEstimator() for layer in layers}
+        update_percentile_estimators(reloaded, layers, _model, None, 10,
+                                     activ_dir, manifest['layers'])
+        for layer in layers:
+            assert reloaded[layer.name].percentile(99) == \
+                estimators[layer.name].percentile(99)
+
+
+    def test_dataset_hash_of_shuffled_dataflow(self, _model, tmpdir):
+        """The activation store of a shuffled dataflow is valid next run."""
+
+        plt = pytest.importorskip('matplotlib.pyplot')
+
+        datapath = str(tmpdir.join('dataset'))
+        classpath = os.path.join(datapath, 'class_0')
+        os.makedirs(classpath)
+        rng = np.random.RandomState(0)
+        for i in range(8):
+            plt.imsave(os.path.join(classpath, 'image_{}.png'.format(i)),
+                       rng.random_sample((10, 10, 3)))
+
+        def get_x_norm():
+            # Each run draws the samples in a different order.
+            dataflow = ImageDataGenerator().flow_from_directory(
+                datapath, target_size=(10, 10), batch_size=3, shuffle=True)
+            return DataflowBatches(dataflow, 8)
+
+        activ_dir = str(tmpdir.join('activations'))
+        os.makedirs(activ_dir)
+        write_activations_manifest(activ_dir, get_model_hash(_model),
+                                   get_dataset_hash(get_x_norm()), {})
+        manifest = read_activations_manifest(activ_dir)
+        assert manifest['dataset_hash'] == get_dataset_hash(get_x_norm())
+
+
+class TestPercentileEstimator:
+    """Test estimating the percentile of activations batch by batch."""
+
+    @staticmethod
+    def get_batches():
+        rng = np.random.RandomState(0)
+        # The range grows in both directions from batch to batch.
+        batches = [rng.standard_normal((100, 7)) * 2 ** k for k in range(5)]
+        for batch in batches:
+            batch[rng.random_sample(batch.shape) < 0.5] = 0
+        return batches
+
+    @pytest.mark.parametrize('percentile', [0, 50, 99, 99.9, 100])
+    def test_percentile(self, percentile):
+
+        batches = self.get_batches()
+        activations = np.concatenate(batches)
+        nonzero_activations = activations[np.nonzero(activations)]
+        target = np.percentile(nonzero_activations, percentile)
+
+        estimator = PercentileEstimator(1024)
+        exact_estimator = PercentileEstimator(0)
+        for batch in batches:
+            estimator.update(batch)
+            exact_estimator.update(batch)
+
+        assert exact_estimator.percentile(percentile) == target
+        assert abs(estimator.percentile(percentile) - target) <= \
+            estimator.width
+        assert estimator.width < 4 * np.ptp(nonzero_activations) / 1024
+        assert estimator.counts.sum() == nonzero_activations.size
+        assert estimator.sparsity == 1 - nonzero_activations.size / \
+            activations.size
+
+    def test_no_activations(self):
+
+        estimator = PercentileEstimator(16)
+        estimator.update(np.zeros((10, 3)))
+        assert estimator.percentile(99) == 1
+        assert estimator.sparsity == 1
+
+    @pytest.mark.parametrize('num_bins', [0, 16])
+    def test_empty(self, num_bins):
+
+        with pytest.raises(ValueError):
+            PercentileEstimator(num_bins).percentile(99)
@@ -6,11 +6,13 @@ from importlib import import_module
 
 from tensorflow.keras import models
 import numpy as np
+import pytest
 
 from snntoolbox.bin.utils import initialize_simulator
 from snntoolbox.bin.utils import run_pipeline
 from snntoolbox.conversion.utils import normalize_parameters
 from snntoolbox.datasets.utils import get_dataset
+from snntoolbox.parsing.model_libs.keras_input_lib import load
 from snntoolbox.simulation.utils import spiketrains_to_rates
 from snntoolbox.utils.utils import import_configparser, \
     get_pearson_coefficients
@@ -105,30 +107,43 @@ class TestInputModel:
 class TestOutputModel:
     """Test building, saving and running the converted SNN model."""
 
-    def test_inisim(self, _model_2, _config):
+    @pytest.mark.parametrize('updates', [
+        {},
+        {'simulation': {'fused_simulation': True}},
+        {'output': {'sparse_spiketrains': True}},
+        {'simulation': {'num_to_test': 120,  # Last batch is partially filled.
+                        'batch_refill': True,
+                        'early_exit_margin': 5},
+         'output': {'log_vars': {'latency_b'}}},
+        {'simulation': {'state_dtype': 'int16', 'float_reference': True}}],
+        ids=['default', 'fused', 'sparse_spiketrains', 'batch_refill',
+             'fixed_point_state'])
+    def test_inisim(self, _model_2, _config, updates):
 
         path_wd = _config.get('paths', 'path_wd')
         model_name = _config.get('paths', 'filename_ann')
         models.save_model(_model_2, os.path.join(path_wd, model_name + '.h5'))
 
-        updates = {
+        log_vars = {'activations_n_b_l', 'spiketrains_n_b_l_t'}
+        _config.read_dict({
             'tools': {'evaluate_ann': False},
             'simulation': {
                 'duration': 100,
                 'num_to_test': 100,
                 'batch_size': 50},
             'output': {
-                'log_vars': {'activations_n_b_l', 'spiketrains_n_b_l_t'}}}
-
+                'log_vars': log_vars}})
         _config.read_dict(updates)
 
         acc = run_pipeline(_config)
 
         assert acc[0] >= 0.95
 
-        corr = get_correlations(_config)
-        assert np.all(corr[:-1] > 0.99)
-        assert corr[-1] > 0.90
+        # The correlation requires the spike trains and activations.
+        if 'log_vars' not in updates.get('output', {}):
+            corr = get_correlations(_config)
+            assert np.all(corr[:-1] > 0.99)
+            assert corr[-1] > 0.90
 
     @brian2_skip_if_dependency_missing
     def test_brian2(self, _model_1, _config):
@@ -161,6 +176,32 @@ class TestOutputModel:
         assert np.all(corr[:-1] > 0.97)
         assert corr[-1] > 0.5
 
+    @brian2_skip_if_dependency_missing
+    def test_brian2_replicate_batch(self, _model_1, _config):
+
+        path_wd = _config.get('paths', 'path_wd')
+        model_name = _config.get('paths', 'filename_ann')
+        models.save_model(_model_1, os.path.join(path_wd, model_name + '.h5'))
+
+        updates = {
+            'tools': {'evaluate_ann': False},
+            'input': {'poisson_input': True},
+            'simulation': {
+                'simulator': 'brian2',
+                'duration': 200,
+                'num_to_test': 100,
+                'batch_size': 10,
+                'dt': 0.1},
+            'brian2': {'replicate_batch': True}}
+
+        _config.read_dict(updates)
+
+        initialize_simulator(_config)
+
+        acc = run_pipeline(_config)
+
+        assert acc[0] >= 0.95
+
     @nest_skip_if_dependency_missing
     def test_nest(self, _model_1, _config):
 
@@ -195,6 +236,47 @@ class TestOutputModel:
         assert np.all(corr[:-1] > 0.97)
         assert corr[-1] > 0.5
 
+    @nest_skip_if_dependency_missing
+    def test_nest_chunked_save_load(self, _model_1, _config):
+
+        path_wd = _config.get('paths', 'path_wd')
+        model_name = _config.get('paths', 'filename_ann')
+        models.save_model(_model_1, os.path.join(path_wd, model_name + '.h5'))
+
+        updates = {
+            'tools': {'evaluate_ann': False, 'normalize': False,
+                      'convert': False, 'simulate': False},
+            'simulation': {
+                'simulator': 'nest',
+                'max_connection_memory': 0.01,
+                'batch_size': 1}}
+
+        _config.read_dict(updates)
+
+        initialize_simulator(_config)
+
+        run_pipeline(_config)
+
+        # Building the network requires the projections.
+        _config.set('tools', 'simulate', 'True')
+        parsed_model = load(
+            path_wd, _config.get('paths', 'filename_parsed_model'))['model']
+        target_sim = import_module('snntoolbox.simulation.target_simulators.'
+                                   'pyNN_target_sim')
+        spiking_model = target_sim.SNN(_config)
+        spiking_model.build(parsed_model)
+        # The layers are connected in more than one chunk.
+        assert len(spiking_model.connections) > \
+            len(spiking_model.layers) - 1
+        filename_snn = _config.get('paths', 'filename_snn')
+        spiking_model.save(path_wd, filename_snn)
+
+        loaded_model = target_sim.SNN(_config)
+        loaded_model.load(path_wd, filename_snn)
+        assert len(loaded_model.connections) == len(loaded_model.layers) - 1
+        assert sum(p.size() for p in loaded_model.connections) == \
+            sum(p.size() for p in spiking_model.connections)
+
     @spinnaker_skip_if_dependency_missing
     def test_spinnaker(self, _model_1, _config):
 
@@ -0,0 +1,98 @@
+# coding=utf-8
+import json
+import os
+
+import numpy as np
+import pytest
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+from snntoolbox.datasets.utils import DataflowBatches, \
+    try_get_normset_from_scalefacs
+from snntoolbox.utils.utils import get_input_model_hash
+
+
+class TestDataflowBatches:
+    """Test loading the batches of a dataflow in parallel."""
+
+    @pytest.mark.parametrize('num_workers', [1, 3])
+    @pytest.mark.parametrize('num_samples', [5, 8, 100])
+    def test_iter(self, num_workers, num_samples):
+
+        x = np.random.RandomState(0).random_sample((18, 4, 4, 1))
+        dataflow = ImageDataGenerator().flow(x, batch_size=4, shuffle=True,
+                                             seed=1)
+        batches = DataflowBatches(dataflow, num_samples, num_workers,
+                                  max_queue_size=2)
+
+        target = [dataflow[i] for i in range(batches.num_batches)]
+        assert len(batches) == sum(len(x_batch) for x_batch in target)
+        assert len(batches) == min(4 * int(np.ceil(num_samples / 4)), 18)
+        # Every pass yields the same samples in the same order.
+        for _ in range(2):
+            x_norm = list(batches)
+            assert len(x_norm) == len(target)
+            for x_batch, target_batch in zip(x_norm, target):
+                assert np.array_equal(x_batch, target_batch)
+
+        # Samples of a numpy array are not identified by file paths.
+        assert batches.get_description() is None
+
+
+def test_scale_facs_of_other_model_are_not_reused(_config):
+    """Scale factors computed for a different input model must be ignored."""
+
+    path = os.path.join(_config.get('paths', 'log_dir_of_current_run'),
+                        'normalization')
+    os.makedirs(path)
+    filepath = os.path.join(path, _config.get('normalization', 'percentile'))
+    scale_facs = {'input': 1., 'dense': 2.}
+    with open(filepath + '.json', 'w') as f:
+        json.dump(scale_facs, f)
+    with open(filepath + '.sha1', 'w') as f:
+        f.write(get_input_model_hash(_config))
+
+    normset = try_get_normset_from_scalefacs(_config)
+    assert normset == {'scale_facs': scale_facs}
+
+    # Changing the input model invalidates the scale factors.
+    with open(os.path.join(_config.get('paths', 'path_wd'),
+                           _config.get('paths', 'filename_ann') + '.h5'),
+              'w') as f:
+        f.write('retrained')
+    assert try_get_normset_from_scalefacs(_config) == {}
+
+
+@pytest.mark.parametrize('seed, num_samples', [(None, 6), (0, 4)])
+def test_description_of_changed_images(tmpdir, seed, num_samples):
+    """The description identifies the images, not the order they are drawn.
+
+    A shuffled dataflow draws the images in a different order in every run.
+    If only a subset is used, a seed pins the selection.
+    """
+
+    plt = pytest.importorskip('matplotlib.pyplot')
+
+    classpath = os.path.join(str(tmpdir), 'class_0')
+    os.mkdir(classpath)
+    rng = np.random.RandomState(0)
+    for i in range(6):
+        plt.imsave(os.path.join(classpath, 'image_{}.png'.format(i)),
+                   rng.random_sample((10, 10, 3)))
+
+    def get_description():
+        dataflow = ImageDataGenerator().flow_from_directory(
+            str(tmpdir), target_size=(10, 10), batch_size=2, shuffle=True,
+            seed=seed)
+        return DataflowBatches(dataflow, num_samples).get_description()
+
+    description = get_description()
+    assert description is not None
+    assert description == get_description()
+
+    # Modifying an image changes the description.
+    for i in range(6):
+        filepath = os.path.join(classpath, 'image_{}.png'.format(i))
+        plt.imsave(filepath, rng.random_sample((10, 10, 3)))
+        stat = os.stat(filepath)
+        os.utime(filepath, (stat.st_atime, stat.st_mtime + 10))
+    assert get_description() != description
@@ -0,0 +1,43 @@
+# coding=utf-8
+import numpy as np
+import pytest
+
+from snntoolbox.parsing.utils import get_fanout_per_axis
+
+
+def get_fanout_per_axis_loop(n_pre, n_post, k, stride, padding):
+    """Reference implementation of `get_fanout_per_axis` using loops."""
+
+    fanout = []
+    for x_pre in range(n_pre):
+        x_post = [int((x_pre + padding) / stride)]
+        wx = (x_pre + padding) % stride
+        i = 1
+        while wx + i * stride < k:
+            x = x_post[0] - i
+            if 0 <= x < n_post:
+                x_post.append(x)
+            i += 1
+        fanout.append(len(x_post))
+    return fanout
+
+
+class TestFanout:
+    """Test computing the fan-out of neurons projecting to convolutions."""
+
+    @pytest.mark.parametrize('padding', ['valid', 'same'])
+    @pytest.mark.parametrize('stride', [1, 2, 3])
+    @pytest.mark.parametrize('k', [1, 3, 5])
+    def test_get_fanout_per_axis(self, padding, stride, k):
+
+        n_pre = 11
+        if padding == 'same':
+            p = (k - 1) // 2
+            n_post = n_pre // stride
+        else:
+            p = 0
+            n_post = (n_pre - k) // stride + 1
+
+        assert np.array_equal(
+            get_fanout_per_axis(n_pre, n_post, k, stride, p),
+            get_fanout_per_axis_loop(n_pre, n_post, k, stride, p))
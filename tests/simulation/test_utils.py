@@ -0,0 +1,459 @@
+# coding=utf-8
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras
+
+from snntoolbox.simulation.utils import get_cumulative_spikecounts, \
+    SpikeEvents, build_convolution, build_depthwise_convolution, \
+    build_1d_convolution, build_pooling, build_max_pooling, \
+    get_dense_connections, get_flatten_permutation, write_connections_npy, \
+    read_connections_npy, update_connection_manifest, \
+    read_connection_manifest, reset_connection_manifest, \
+    prefetch_connectivity, get_sample_stream
+
+
+class TestOutputDecoding:
+    """Test decoding the output spikes of a spiking network."""
+
+    @staticmethod
+    def get_spiketrains(shape=(5, 10, 50)):
+        rng = np.random.RandomState(0)
+        spiketimes = np.arange(1, shape[-1] + 1, dtype='float32')
+        return (rng.random_sample(shape) < 0.1) * spiketimes
+
+    def test_cumulative_spikecounts(self):
+
+        spiketrains_b_l_t = self.get_spiketrains()
+        target = np.zeros(spiketrains_b_l_t.shape, 'int32')
+        for b in range(target.shape[0]):
+            for ll in range(target.shape[1]):
+                for t in range(target.shape[2]):
+                    target[b, ll, t] = np.count_nonzero(
+                        spiketrains_b_l_t[b, ll, :t + 1])
+
+        assert np.array_equal(get_cumulative_spikecounts(spiketrains_b_l_t),
+                              target)
+        assert np.array_equal(get_cumulative_spikecounts(
+            SpikeEvents.from_dense(spiketrains_b_l_t)), target)
+
+    @pytest.mark.parametrize('idx', [2, -1, slice(1, 4), slice(None, None, -2),
+                                     [3, 0, 3], np.array([], int),
+                                     np.arange(5) % 2 == 0])
+    def test_spike_events_getitem(self, idx):
+
+        spiketrains_b_l_t = self.get_spiketrains()
+        events = SpikeEvents.from_dense(spiketrains_b_l_t)
+        assert np.array_equal(events[idx].to_dense(), spiketrains_b_l_t[idx])
+
+    def test_spike_events_getitem_unsupported(self):
+
+        events = SpikeEvents.from_dense(self.get_spiketrains())
+        with pytest.raises(IndexError):
+            _ = events[0, 1]
+
+    def test_spike_events_setitem(self):
+
+        spiketrains_b_l_t = self.get_spiketrains()
+        events = SpikeEvents(spiketrains_b_l_t.shape)
+        for t in range(spiketrains_b_l_t.shape[-1]):
+            events[Ellipsis, t] = np.ones(spiketrains_b_l_t.shape[:-1])
+        # Overwrite time steps that were written already.
+        for t in range(spiketrains_b_l_t.shape[-1]):
+            events[Ellipsis, t] = spiketrains_b_l_t[Ellipsis, t]
+        assert events.num_events == np.count_nonzero(spiketrains_b_l_t)
+        assert np.array_equal(events.to_dense(), spiketrains_b_l_t)
+
+
+def build_convolution_loop(weights, ny, nx, y0, x0, sy, sx, py, px, mx, my,
+                           delay):
+    """Reference implementation of `build_convolution` using loops."""
+
+    connections = []
+    for fout in range(weights.shape[3]):
+        for y in range(y0, ny - y0, sy):
+            for x in range(x0, nx - x0, sx):
+                target = int((x - x0) / sx + (y - y0) / sy * mx +
+                             fout * mx * my)
+                for fin in range(weights.shape[2]):
+                    for k in range(-py, py + 1):
+                        if not 0 <= y + k < ny:
+                            continue
+                        for p in range(-px, px + 1):
+                            if not 0 <= x + p < nx:
+                                continue
+                            source = p + x + (y + k) * nx + fin * nx * ny
+                            connections.append((source, target,
+                                                weights[py - k, px - p, fin,
+                                                        fout], delay))
+    return connections
+
+
+def build_depthwise_convolution_loop(weights, ny, nx, y0, x0, sy, sx, py, px,
+                                     mx, my, delay):
+    """Reference implementation of `build_depthwise_convolution`."""
+
+    dm = weights.shape[-1]
+    connections = []
+    for fin in range(weights.shape[-2]):
+        for d in range(weights.shape[-1]):
+            for y in range(y0, ny - y0, sy):
+                for x in range(x0, nx - x0, sx):
+                    target = ((x - x0) // sx) + ((y - y0) // sy * mx) + \
+                        (d * mx * my) + (fin * dm * mx * my)
+                    for k in range(-py, py + 1):
+                        if not 0 <= y + k < ny:
+                            continue
+                        for p in range(-px, px + 1):
+                            if not 0 <= x + p < nx:
+                                continue
+                            source = x + p + ((y + k) * nx) + (fin * nx * ny)
+                            connections.append((source, target,
+                                                weights[py - k, px - p, fin,
+                                                        d], delay))
+    return connections
+
+
+def build_1d_convolution_loop(weights, nx, x0, sx, px, mx, delay):
+    """Reference implementation of `build_1d_convolution`."""
+
+    connections = []
+    for fout in range(weights.shape[2]):
+        for x in range(x0, nx - x0, sx):
+            target = int((x - x0) / sx + fout * mx)
+            for fin in range(weights.shape[1]):
+                source = x + (fin * nx)
+                for p in range(-px, px + 1):
+                    if not 0 <= x + p < nx:
+                        continue
+                    connections.append((source + p, target,
+                                        weights[px - p, fin, fout], delay))
+    return connections
+
+
+def build_pooling_loop(ny, nx, nz, dy, dx, sy, sx, delay):
+    """Reference implementation of `build_pooling`."""
+
+    connections = []
+    for fout in range(nz):
+        for y in range(0, ny - dy + 1, sy):
+            for x in range(0, nx - dx + 1, sx):
+                target = int(x / sx + y / sy * ((nx - dx) / sx + 1) +
+                             fout * nx * ny / (dx * dy))
+                for k in range(dy):
+                    source = x + (y + k) * nx + fout * nx * ny
+                    for j in range(dx):
+                        connections.append((source + j, target,
+                                            1 / (dx * dy), delay))
+    return connections
+
+
+def get_geometry(n, k, s, padding):
+    p = (k - 1) // 2
+    if padding == 'valid':
+        return p, (n - k + 1) // s, p
+    return 0, n // s, p
+
+
+def build_dense_loop(weights, shape, delay):
+    """Reference implementation of `get_dense_connections` after Flatten."""
+
+    y_in, x_in, f_in = shape
+    connections = []
+    for i in range(weights.shape[0]):
+        f = i % f_in
+        y = i // (f_in * x_in)
+        x = (i // f_in) % x_in
+        new_i = f * x_in * y_in + x_in * y + x
+        for j in range(weights.shape[1]):
+            connections.append((new_i, j, weights[i, j], delay))
+    return connections
+
+
+class TestConnectivity:
+    """Test building the connections of spiking layers."""
+
+    delay = 1.
+
+    @staticmethod
+    def get_layer(layer, input_shape):
+        model = keras.models.Sequential([keras.layers.InputLayer(input_shape),
+                                         layer])
+        rng = np.random.RandomState(0)
+        layer.set_weights([rng.standard_normal(w.shape).astype(w.dtype)
+                           for w in model.get_weights()])
+        return layer
+
+    @pytest.mark.parametrize('padding', ['valid', 'same'])
+    @pytest.mark.parametrize('strides', [(1, 1), (2, 2), (1, 2)])
+    @pytest.mark.parametrize('kernel_size', [(3, 3), (1, 1), (5, 3)])
+    def test_build_convolution(self, padding, strides, kernel_size):
+
+        ny, nx = 9, 8
+        layer = self.get_layer(
+            keras.layers.Conv2D(4, kernel_size, strides, padding),
+            (ny, nx, 3))
+        connections, biases = build_convolution(layer, self.delay)
+
+        weights = layer.get_weights()[0]
+        y0, my, py = get_geometry(ny, kernel_size[0], strides[0], padding)
+        x0, mx, px = get_geometry(nx, kernel_size[1], strides[1], padding)
+        target = build_convolution_loop(weights, ny, nx, y0, x0, *strides,
+                                        py, px, mx, my, self.delay)
+
+        assert np.array_equal(connections, np.array(target))
+        assert len(biases) == np.prod(layer.output_shape[1:])
+
+    @pytest.mark.parametrize('padding', ['valid', 'same'])
+    @pytest.mark.parametrize('strides', [(1, 1), (2, 2)])
+    @pytest.mark.parametrize('depth_multiplier', [1, 2])
+    def test_build_depthwise_convolution(self, padding, strides,
+                                         depth_multiplier):
+
+        ny, nx = 7, 8
+        layer = self.get_layer(keras.layers.DepthwiseConv2D(
+            3, strides, padding, depth_multiplier), (ny, nx, 3))
+        connections, _ = build_depthwise_convolution(layer, self.delay)
+
+        weights = layer.get_weights()[0]
+        y0, my, py = get_geometry(ny, 3, strides[0], padding)
+        x0, mx, px = get_geometry(nx, 3, strides[1], padding)
+        target = build_depthwise_convolution_loop(
+            weights, ny, nx, y0, x0, *strides, py, px, mx, my, self.delay)
+
+        assert np.array_equal(connections, np.array(target))
+
+    @pytest.mark.parametrize('padding', ['valid', 'same'])
+    @pytest.mark.parametrize('strides', [1, 2])
+    @pytest.mark.parametrize('kernel_size', [1, 3])
+    def test_build_1d_convolution(self, padding, strides, kernel_size):
+
+        nx = 11
+        layer = self.get_layer(keras.layers.Conv1D(
+            4, kernel_size, strides, padding), (nx, 3))
+        connections, _ = build_1d_convolution(layer, self.delay)
+
+        weights = layer.get_weights()[0]
+        x0, mx, px = get_geometry(nx, kernel_size, strides, padding)
+        target = build_1d_convolution_loop(weights, nx, x0, strides, px, mx,
+                                           self.delay)
+
+        assert np.array_equal(connections, np.array(target))
+
+    @pytest.mark.parametrize('pool_size', [(2, 2), (3, 2)])
+    def test_build_pooling(self, pool_size):
+
+        ny, nx = 6, 8
+        layer = keras.layers.AveragePooling2D(pool_size)
+        keras.models.Sequential([keras.layers.InputLayer((ny, nx, 3)), layer])
+        connections = build_pooling(layer, self.delay)
+
+        target = build_pooling_loop(ny, nx, 3, *pool_size, *pool_size,
+                                    self.delay)
+
+        assert np.array_equal(connections, np.array(target))
+
+    def test_split_sign(self):
+
+        layer = self.get_layer(keras.layers.Conv2D(4, 3, padding='same'),
+                               (9, 8, 3))
+        weights, biases = layer.get_weights()
+        rng = np.random.RandomState(1)
+        weights[rng.random_sample(weights.shape) < 0.9] = 0
+        layer.set_weights([weights, biases])
+        connections, _ = build_convolution(layer, self.delay)
+        exc, inh = build_convolution(layer, self.delay, split_sign=True)[0]
+
+        assert np.array_equal(exc, connections[connections[:, 2] > 0])
+        assert np.array_equal(inh, connections[connections[:, 2] < 0])
+
+        weights = layer.get_weights()[0].reshape(-1, 4)
+        exc, inh = get_dense_connections(weights, self.delay, split_sign=True)
+        connections = get_dense_connections(weights, self.delay)
+
+        assert np.array_equal(exc, connections[connections[:, 2] > 0])
+        assert np.array_equal(inh, connections[connections[:, 2] < 0])
+
+    @pytest.mark.parametrize('chunk_size', [7, 100, 1000])
+    def test_chunked_connections(self, chunk_size):
+
+        layer = self.get_layer(keras.layers.DepthwiseConv2D(
+            3, padding='same', depth_multiplier=2), (9, 8, 3))
+        target, _ = build_depthwise_convolution(layer, self.delay)
+        chunks = list(build_depthwise_convolution(
+            layer, self.delay, chunk_size=chunk_size)[0])
+        assert max(len(chunk) for chunk in chunks) <= chunk_size
+        assert np.array_equal(np.concatenate(chunks), target)
+
+        weights = layer.get_weights()[0].reshape(-1, 6)
+        source_idxs = np.arange(len(weights))[::-1]
+        target = get_dense_connections(weights, self.delay, source_idxs)
+        chunks = list(get_dense_connections(weights, self.delay, source_idxs,
+                                            chunk_size=chunk_size))
+        assert max(len(chunk) for chunk in chunks) <= max(chunk_size, 6)
+        assert np.array_equal(np.concatenate(chunks), target)
+
+    def test_connectivity_cache(self, tmpdir):
+
+        cache_dir = str(tmpdir.join('connectivity_cache'))
+        layer = self.get_layer(keras.layers.Conv2D(4, 3, padding='same'),
+                               (9, 8, 3))
+        target, _ = build_convolution(layer, self.delay)
+        connections, _ = build_convolution(layer, self.delay,
+                                           cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # A cache hit only gathers the new weights.
+        layer.set_weights([-w for w in layer.get_weights()])
+        connections, _ = build_convolution(layer, self.delay,
+                                           cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        assert np.array_equal(connections[:, :2], target[:, :2])
+        assert np.array_equal(connections[:, 2], -target[:, 2])
+
+    def test_build_max_pooling(self):
+
+        layer = keras.layers.MaxPooling2D()
+        keras.models.Sequential([keras.layers.InputLayer((6, 4, 3)), layer])
+        pooling = build_pooling(layer, self.delay, 1)
+        input_connections, lateral_connections, output_connections = \
+            build_max_pooling(layer, self.delay, 0.5)
+
+        # Each connection of the pooling layer is routed through a relay.
+        relays = np.arange(len(pooling))
+        assert np.array_equal(input_connections[:, 0], pooling[:, 0])
+        assert np.array_equal(input_connections[:, 1], relays)
+        assert np.array_equal(output_connections[:, 0], relays)
+        assert np.array_equal(output_connections[:, 1], pooling[:, 1])
+        assert np.all(input_connections[:, 2:] == [1, self.delay])
+        assert np.all(output_connections[:, 2:] == [1, self.delay])
+
+        # The relays inhibit all other relays of the same window.
+        target = [(i, j, 0.5, self.delay) for i in relays for j in relays
+                  if i != j and pooling[i, 1] == pooling[j, 1]]
+        assert np.array_equal(
+            lateral_connections[np.lexsort(lateral_connections[:, 1::-1].T)],
+            np.array(target))
+
+    def test_prefetch_connectivity(self, tmpdir):
+
+        cache_dir = str(tmpdir.join('connectivity_cache'))
+        model = keras.models.Sequential([
+            keras.layers.InputLayer((9, 8, 3)),
+            keras.layers.Conv2D(4, 3, padding='same'),
+            keras.layers.AveragePooling2D(),
+            keras.layers.DepthwiseConv2D(3)])
+        prefetch_connectivity(model.layers, cache_dir, 2)
+        assert len(os.listdir(cache_dir)) == 3
+
+        for layer in model.layers:
+            if 'pool' in layer.name:
+                connections = build_pooling(layer, self.delay)
+                cached = build_pooling(layer, self.delay, cache_dir=cache_dir)
+            elif 'depthwise' in layer.name:
+                connections, _ = build_depthwise_convolution(layer,
+                                                             self.delay)
+                cached, _ = build_depthwise_convolution(
+                    layer, self.delay, cache_dir=cache_dir)
+            else:
+                connections, _ = build_convolution(layer, self.delay)
+                cached, _ = build_convolution(layer, self.delay,
+                                              cache_dir=cache_dir)
+            assert np.array_equal(connections, cached)
+        assert len(os.listdir(cache_dir)) == 3
+
+    def test_prefetch_connectivity_with_zero_padding(self, tmpdir):
+
+        cache_dir = str(tmpdir.join('connectivity_cache'))
+        model = keras.models.Sequential([
+            keras.layers.InputLayer((9, 8, 3)),
+            keras.layers.ZeroPadding2D(),
+            keras.layers.DepthwiseConv2D(3)])
+        layer = model.layers[-1]
+        prefetch_connectivity([layer], cache_dir, 1, ['ZeroPadding'])
+        assert len(os.listdir(cache_dir)) == 1
+
+        # The simulators mark a convolution that follows a removed
+        # ZeroPadding layer like this before building it.
+        layer.padding = 'ZeroPadding'
+        cached, _ = build_depthwise_convolution(layer, self.delay,
+                                                cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        layer.padding = 'ZeroPadding'
+        connections, _ = build_depthwise_convolution(layer, self.delay)
+        assert np.array_equal(connections, cached)
+
+    def test_build_dense(self):
+
+        shape = (3, 4, 5)
+        rng = np.random.RandomState(0)
+        weights = rng.standard_normal((np.prod(shape), 6)).astype('float32')
+        source_idxs = get_flatten_permutation(shape, 'channels_last')
+        connections = get_dense_connections(weights, self.delay, source_idxs)
+
+        target = build_dense_loop(weights, shape, self.delay)
+
+        assert np.array_equal(connections, np.array(target))
+
+
+class TestConnectionExport:
+    """Test writing connections to disk in binary format."""
+
+    def test_write_read_connections(self, tmpdir):
+
+        path = str(tmpdir)
+        rng = np.random.RandomState(0)
+        connections = np.column_stack([
+            rng.randint(0, 100, (50, 2)),
+            rng.standard_normal(50).astype('float32'),
+            np.ones(50)])
+        filepath = os.path.join(path, 'conv_excitatory.npy')
+        write_connections_npy(filepath, connections)
+        update_connection_manifest(path, 'conv_excitatory',
+                                   filename='conv_excitatory.npy',
+                                   pre='input', post='conv',
+                                   receptor_type='excitatory')
+
+        assert np.array_equal(read_connections_npy(filepath), connections)
+        assert read_connection_manifest(path)['conv_excitatory']['pre'] == \
+            'input'
+
+        # A new export starts with an empty manifest.
+        reset_connection_manifest(path)
+        assert read_connection_manifest(path) == {}
+
+
+def test_sample_stream():
+
+    x_test = np.arange(12).reshape(6, 2)
+    y_test = np.eye(6)
+    samples = list(get_sample_stream(x_test, y_test, None, 4))
+    assert len(samples) == 4
+    assert np.array_equal(samples[3][0], x_test[3])
+    assert np.array_equal(samples[3][1], y_test[3])
+
+    with pytest.raises(ValueError):
+        get_sample_stream(x_test, None, None, 4)
+
+
+def test_shift_time(_config):
+    """Moving the time origin of a layer leaves the sample times unchanged."""
+
+    from snntoolbox.simulation.backends.inisim.temporal_mean_rate_tensorflow \
+        import SpikeDense
+
+    layer = SpikeDense(3, config=_config)
+    layer.build(tf.TensorShape([4, 5]))
+
+    # Refill the first and third slot of the batch at time 10.
+    layer.set_time(10.)
+    layer.reset_spikevars(tf.zeros(4, 'int32'),
+                          tf.constant([True, False, True, False]))
+    layer.set_time(13.)
+    sample_time = layer.get_sample_time().numpy()
+
+    layer.shift_time(10.)
+    assert layer.time.numpy() == 3
+    assert np.array_equal(layer.get_sample_time().numpy(), sample_time)